@@ -0,0 +1,97 @@
+"""
+Microbenchmark of cache key generation.
+
+Compares the keys derived by a cache lookup (see `lookup_cached_response()`)
+with the previous implementation, which built a Starlette URL and hashed it
+with MD5 for each key.
+
+Usage: python benchmarks/cache_keys.py
+"""
+
+import hashlib
+import timeit
+import typing
+
+from caches import Cache
+from starlette.requests import Request
+
+from asgi_caches.utils.cache import _make_cache_keys, _make_varying_headers_cache_key
+from asgi_caches.utils.keys import hash_url
+
+SCOPE = {
+    "type": "http",
+    "method": "GET",
+    "scheme": "https",
+    "server": ("example.org", 443),
+    "root_path": "",
+    "path": "/articles/42",
+    "query_string": b"page=2&sort=date",
+    "headers": [
+        (b"host", b"example.org"),
+        (b"user-agent", b"Mozilla/5.0 (X11; Linux x86_64)"),
+        (b"accept", b"text/html,application/xhtml+xml"),
+        (b"accept-encoding", b"gzip, deflate, br"),
+        (b"accept-language", b"en-US,en;q=0.5"),
+    ],
+}
+VARYING_HEADERS = ["accept-encoding"]
+
+
+def legacy_generate_cache_key(
+    request: Request, method: str, varying_headers: typing.List[str], cache: Cache
+) -> str:
+    ctx = hashlib.md5()
+    for header in varying_headers:
+        value = request.headers.get(header)
+        if value is not None:
+            ctx.update(value.encode())
+    url = hashlib.md5(str(request.url).encode("ascii"))
+    return cache.make_key(f"cache_page.{method}.{url.hexdigest()}.{ctx.hexdigest()}")
+
+
+def legacy_generate_varying_headers_cache_key(request: Request, cache: Cache) -> str:
+    url_hash = hashlib.md5(request.url.path.encode("ascii"))
+    return cache.make_key(f"varying_headers.{url_hash.hexdigest()}")
+
+
+def legacy_lookup_keys() -> typing.Callable[[], None]:
+    cache = Cache("locmem://null")
+
+    def run() -> None:
+        # What a cache lookup computed: varying headers key, GET and HEAD keys.
+        # NOTE: a new request is built each time, so that nothing is cached
+        # on the request object.
+        request = Request(SCOPE)
+        legacy_generate_varying_headers_cache_key(request, cache)
+        for method in ("GET", "HEAD"):
+            legacy_generate_cache_key(request, method, VARYING_HEADERS, cache)
+
+    return run
+
+
+def lookup_keys() -> typing.Callable[[], None]:
+    cache = Cache("locmem://null")
+
+    def run() -> None:
+        # Same as 'lookup_cached_response()': the URL is hashed once, and the
+        # varying headers key and GET and HEAD keys are derived from it.
+        url_hash = hash_url(SCOPE)
+        _make_varying_headers_cache_key(url_hash, cache)
+        _make_cache_keys(SCOPE, url_hash, VARYING_HEADERS, cache, None)
+
+    return run
+
+
+def main() -> None:
+    number = 20000
+    results = {}
+    for name, run in (("legacy", legacy_lookup_keys()), ("current", lookup_keys())):
+        best = min(timeit.repeat(run, number=number, repeat=5))
+        results[name] = best / number * 1e6
+        print(f"{name:>8}: {results[name]:.2f} µs per lookup")
+
+    print(f" speedup: {results['legacy'] / results['current']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
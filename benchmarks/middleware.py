@@ -0,0 +1,314 @@
+"""
+Benchmarks of the caching middleware, driven through raw ASGI calls.
+
+Measures:
+
+* Cache hit latency, using `CacheMiddleware` and `@cached()`.
+* Cache miss overhead, compared to calling the application directly.
+* Cache hit throughput for various body sizes, `Vary` cardinalities and
+numbers of concurrent requests.
+
+Results are written as JSON, and can be compared with the results of a
+previous run (e.g. of another version) using `--compare`.
+
+Usage:
+
+    python benchmarks/middleware.py [--output results.json] [--compare baseline.json]
+
+By default, the `locmem` backend is used. Pass `--latency` to add a round-trip
+delay to each cache operation, which stands in for a remote backend such as
+Redis, or pass `--cache-url` to use an actual backend.
+"""
+
+import argparse
+import asyncio
+import functools
+import itertools
+import json
+import platform
+import statistics
+import sys
+import time
+import typing
+
+from caches import Cache
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from asgi_caches import __version__
+from asgi_caches.decorators import cached
+from asgi_caches.middleware import CacheMiddleware
+
+KIB = 1024
+BODY_SIZES = (KIB, 64 * KIB, 1024 * KIB)
+VARY_CARDINALITIES = (1, 10, 100)
+CONCURRENCY_LEVELS = (1, 10, 100)
+
+Result = typing.Dict[str, typing.Any]
+Run = typing.Callable[[], typing.Awaitable[None]]
+
+
+def make_app(body_size: int = KIB, vary: typing.Optional[str] = None) -> ASGIApp:
+    body = b"x" * body_size
+    headers = [
+        (b"content-type", b"text/plain"),
+        (b"content-length", str(body_size).encode("latin-1")),
+        (b"cache-control", b"max-age=3600"),
+    ]
+    if vary is not None:
+        headers.append((b"vary", vary.encode("latin-1")))
+
+    async def app(scope: Scope, receive: Receive, send: Send) -> None:
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+    return app
+
+
+def make_scope(
+    path: str,
+    query_string: bytes = b"",
+    headers: typing.Sequence[typing.Tuple[bytes, bytes]] = (),
+) -> Scope:
+    return {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "server": ("testserver", 80),
+        "client": ("127.0.0.1", 12345),
+        "root_path": "",
+        "path": path,
+        "raw_path": path.encode("latin-1"),
+        "query_string": query_string,
+        "headers": [(b"host", b"testserver"), *headers],
+    }
+
+
+async def receive() -> Message:
+    return {"type": "http.request", "body": b"", "more_body": False}
+
+
+async def send(message: Message) -> None:
+    pass
+
+
+async def call(app: ASGIApp, scope: Scope) -> None:
+    # NOTE: copy the scope, as the middleware marks scopes it has seen.
+    await app({**scope}, receive, send)
+
+
+async def call_next(app: ASGIApp, scopes: typing.Iterator[Scope]) -> None:
+    await call(app, next(scopes))
+
+
+async def call_concurrently(app: ASGIApp, scope: Scope, concurrency: int) -> None:
+    await asyncio.gather(*(call(app, scope) for _ in range(concurrency)))
+
+
+def add_latency(cache: Cache, latency: float) -> None:
+    """Delay each operation of a cache by `latency` seconds."""
+
+    def delayed(method: typing.Callable) -> typing.Callable:
+        async def wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+            await asyncio.sleep(latency)
+            return await method(*args, **kwargs)
+
+        return wrapper
+
+    for name in ("get", "get_many", "set", "set_many", "delete", "delete_many"):
+        setattr(cache, name, delayed(getattr(cache, name)))
+
+
+async def measure(
+    run: Run, *, number: int, repeat: int, batch: int = 1
+) -> typing.Dict[str, float]:
+    """
+    Time `number` sequential calls of `run`, `repeat` times. Each call performs
+    `batch` requests.
+    """
+    await run()  # Warm up.
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            await run()
+        timings.append((time.perf_counter() - start) / (number * batch))
+    median = statistics.median(timings)
+    return {
+        "best_us": min(timings) * 1e6,
+        "median_us": median * 1e6,
+        "requests_per_second": 1 / median,
+    }
+
+
+class Suite:
+    def __init__(self, *, cache_url: str, latency: float, number: int, repeat: int):
+        self.cache_url = cache_url
+        self.latency = latency
+        self.number = number
+        self.repeat = repeat
+        self.results: typing.List[Result] = []
+
+    def make_cache(self) -> Cache:
+        cache = Cache(self.cache_url)
+        if self.latency:
+            add_latency(cache, self.latency)
+        return cache
+
+    async def record(
+        self, name: str, params: typing.Dict[str, typing.Any], run: Run, batch: int = 1
+    ) -> None:
+        timings = await measure(
+            run, number=self.number, repeat=self.repeat, batch=batch
+        )
+        result: Result = {"name": name, "params": params, **timings}
+        self.results.append(result)
+        line = f"{format_name(result):<40} {result['median_us']:>10.1f} µs"
+        print(line, file=sys.stderr)
+
+    async def run(self) -> None:
+        await self.bench_hit()
+        await self.bench_miss()
+        await self.bench_body_size()
+        await self.bench_vary()
+        await self.bench_concurrency()
+
+    async def bench_hit(self) -> None:
+        scope = make_scope("/hit")
+        async with self.make_cache() as cache:
+            for entrypoint, app in (
+                ("middleware", CacheMiddleware(make_app(), cache=cache)),
+                ("decorator", cached(cache)(make_app())),
+            ):
+                await self.record(
+                    "hit",
+                    {"entrypoint": entrypoint},
+                    functools.partial(call, app, scope),
+                )
+
+    async def bench_miss(self) -> None:
+        await self.record("bare", {}, lambda: call(make_app(), make_scope("/bare")))
+
+        # Each request has a new query string, so that it misses.
+        counter = itertools.count()
+        async with self.make_cache() as cache:
+            app = CacheMiddleware(make_app(), cache=cache)
+            await self.record(
+                "miss",
+                {},
+                lambda: call(
+                    app, make_scope("/miss", str(next(counter)).encode("latin-1"))
+                ),
+            )
+
+    async def bench_body_size(self) -> None:
+        for body_size in BODY_SIZES:
+            scope = make_scope(f"/body_size/{body_size}")
+            async with self.make_cache() as cache:
+                app = CacheMiddleware(make_app(body_size), cache=cache)
+                await self.record(
+                    "hit", {"body_size": body_size}, functools.partial(call, app, scope)
+                )
+
+    async def bench_vary(self) -> None:
+        for cardinality in VARY_CARDINALITIES:
+            scopes = itertools.cycle(
+                [
+                    make_scope(
+                        f"/vary/{cardinality}",
+                        headers=[(b"accept-language", f"lang-{index}".encode())],
+                    )
+                    for index in range(cardinality)
+                ]
+            )
+            async with self.make_cache() as cache:
+                app = CacheMiddleware(make_app(vary="Accept-Language"), cache=cache)
+                for _ in range(cardinality):
+                    await call(app, next(scopes))
+                await self.record(
+                    "hit",
+                    {"vary_cardinality": cardinality},
+                    functools.partial(call_next, app, scopes),
+                )
+
+    async def bench_concurrency(self) -> None:
+        for concurrency in CONCURRENCY_LEVELS:
+            scope = make_scope(f"/concurrency/{concurrency}")
+            async with self.make_cache() as cache:
+                app = CacheMiddleware(make_app(), cache=cache)
+                run = functools.partial(call_concurrently, app, scope, concurrency)
+                await self.record(
+                    "hit", {"concurrency": concurrency}, run, batch=concurrency
+                )
+
+    def to_json(self) -> Result:
+        return {
+            "version": __version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cache_url": self.cache_url,
+            "latency": self.latency,
+            "results": self.results,
+        }
+
+
+def format_name(result: Result) -> str:
+    params = ", ".join(f"{key}={value}" for key, value in result["params"].items())
+    return f"{result['name']}({params})"
+
+
+def compare(results: typing.List[Result], baseline: Result) -> None:
+    """Print the relative change of median timings compared to a baseline."""
+    baseline_timings = {
+        format_name(result): result["median_us"] for result in baseline["results"]
+    }
+    print(f"\nCompared to {baseline['version']} (positive is slower):")
+    for result in results:
+        name = format_name(result)
+        if name not in baseline_timings:
+            continue
+        change = result["median_us"] / baseline_timings[name] - 1
+        print(f"{name:<40} {change:>+10.1%}")
+
+
+def main(argv: typing.Optional[typing.Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--cache-url", default="locmem://benchmarks")
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0,
+        help="Round-trip delay added to cache operations, in milliseconds.",
+    )
+    parser.add_argument("--number", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="Path of the JSON file to write results to.")
+    parser.add_argument("--compare", help="Path of JSON results to compare with.")
+    args = parser.parse_args(argv)
+
+    suite = Suite(
+        cache_url=args.cache_url,
+        latency=args.latency / 1000,
+        number=args.number,
+        repeat=args.repeat,
+    )
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(suite.run())
+    finally:
+        loop.close()
+
+    if args.output is None:
+        json.dump(suite.to_json(), sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as output:
+            json.dump(suite.to_json(), output, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as baseline:
+            compare(suite.results, json.load(baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -34,6 +34,7 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=["async-caches==0.*", "starlette==0.*"],
+    entry_points={"console_scripts": ["asgi-caches-warm=asgi_caches.warming:main"]},
     python_requires=">=3.6",
     license="MIT",
     classifiers=[
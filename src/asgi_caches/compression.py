@@ -0,0 +1,158 @@
+"""
+Compression of response bodies stored in the cache.
+
+Codecs are named after the HTTP content coding they produce, so that bodies
+compressed at rest can be sent as-is to clients that accept this coding.
+`gzip` and `deflate` are built in, and `br` and `zstd` are available if the
+`brotli` and `zstandard` packages are installed, respectively.
+"""
+
+import functools
+import typing
+import zlib
+
+from .policies import match_token, negotiate
+
+Headers = typing.Iterable[typing.Tuple[bytes, bytes]]
+
+# Bodies smaller than this are not worth compressing, in bytes.
+DEFAULT_MIN_SIZE = 1024
+
+
+class Codec:
+    """
+    Base class for codecs.
+    """
+
+    # Name of the HTTP content coding of compressed data.
+    name = ""
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError  # pragma: no cover
+
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError  # pragma: no cover
+
+
+class GzipCodec(Codec):
+    name = "gzip"
+    # NOTE: zlib writes a gzip header and trailer for these window bits.
+    wbits = 16 + zlib.MAX_WBITS
+
+    def __init__(self, level: int = 6) -> None:
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, self.wbits)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data, self.wbits)
+
+
+class DeflateCodec(GzipCodec):
+    # NOTE: the 'deflate' content coding is actually the zlib format.
+    name = "deflate"
+    wbits = zlib.MAX_WBITS
+
+
+class BrotliCodec(Codec):
+    """Requires the `brotli` package."""
+
+    name = "br"
+
+    def __init__(self, quality: int = 5) -> None:
+        import brotli
+
+        self.brotli = brotli
+        self.quality = quality
+
+    def compress(self, data: bytes) -> bytes:
+        return self.brotli.compress(data, quality=self.quality)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self.brotli.decompress(data)
+
+
+class ZstdCodec(Codec):
+    """Requires the `zstandard` package."""
+
+    name = "zstd"
+
+    def __init__(self, level: int = 3) -> None:
+        import zstandard
+
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self.decompressor.decompress(data)
+
+
+CODECS: typing.Dict[str, typing.Callable[[], Codec]] = {
+    codec.name: codec for codec in (GzipCodec, DeflateCodec, BrotliCodec, ZstdCodec)
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_codec(name: str) -> typing.Optional[Codec]:
+    """
+    Return a codec for decompressing data of the given content coding, or `None`
+    if the coding is unknown or its dependencies are not installed.
+    """
+    try:
+        return CODECS[name]()
+    except (KeyError, ImportError):
+        return None
+
+
+def is_compressible(headers: Headers) -> bool:
+    """
+    Return whether the body of a response may be compressed, i.e. it isn't
+    compressed already and the response doesn't forbid transformations.
+    """
+    for key, value in headers:
+        key = key.lower()
+        if key == b"content-encoding" and value.strip().lower() != b"identity":
+            return False
+        if key == b"cache-control" and b"no-transform" in value.lower():
+            return False
+    return True
+
+
+def select_codec(
+    codecs: typing.Sequence[Codec],
+    headers: Headers,
+    preferred: typing.Optional[str] = None,
+) -> typing.Optional[Codec]:
+    """
+    Return the codec of the encoding a client prefers as per its `Accept-Encoding`
+    request header, or `None` if it doesn't accept any of them.
+
+    Ties are broken using the order of `codecs`, except that the `preferred`
+    encoding (e.g. that of a body compressed already) wins ties.
+    """
+    accept_encoding = next(
+        (value for key, value in headers if key == b"accept-encoding"), None
+    )
+    if accept_encoding is None:
+        return None
+
+    codecs_by_name = {codec.name: codec for codec in codecs}
+    names = list(codecs_by_name)
+    if preferred in codecs_by_name:
+        names.remove(preferred)
+        names.insert(0, preferred)
+    name = negotiate(accept_encoding, names, match_token)
+    return None if name is None else codecs_by_name[name]
+
+
+def accepts_encoding(headers: Headers, encoding: str) -> bool:
+    """Return whether the `Accept-Encoding` request header accepts an encoding."""
+    for key, value in headers:
+        if key == b"accept-encoding":
+            return negotiate(value, [encoding], match_token) is not None
+    return False
@@ -8,20 +8,21 @@ from .middleware import CacheControlMiddleware, CacheMiddleware
 from .utils.misc import is_asgi3
 
 
-def cached(cache: Cache) -> typing.Callable:
+def cached(cache: Cache, **kwargs: typing.Any) -> typing.Callable:
     """
     Decorator for ASGI endpoints that tries to get the response from the cache,
     or populates the cache if the response isn't cached yet.
 
     This decorator provides the same behavior than `CacheMiddleware`,
-    but at an endpoint level.
+    but at an endpoint level. Extra keyword arguments (e.g. `single_flight=True`)
+    are passed to `CacheMiddleware`.
 
     Raises 'ValueError' if the wrapped callable isn't an ASGI application.
     """
 
     def wrap(app: ASGIApp) -> ASGIApp:
         _validate_asgi3(app)
-        middleware = CacheMiddleware(app, cache=cache)
+        middleware = CacheMiddleware(app, cache=cache, **kwargs)
         return _wrap_in_middleware(app, middleware)
 
     return wrap
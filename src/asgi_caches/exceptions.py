@@ -1,7 +1,11 @@
+import typing
+
 from caches import Cache
 from starlette.requests import Request
 from starlette.responses import Response
 
+from .responses import CachedResponse
+
 
 class ASGICachesException(Exception):
     pass
@@ -16,11 +20,14 @@ class RequestNotCachable(ASGICachesException):
 
 
 class ResponseNotCachable(ASGICachesException):
-    """Raised when a response cannot be cached."""
+    """Raised when a response cannot be cached, for the given `reason`."""
 
-    def __init__(self, response: Response) -> None:
+    def __init__(
+        self, response: typing.Union[Response, CachedResponse], reason: str = ""
+    ) -> None:
         super().__init__()
         self.response = response
+        self.reason = reason
 
 
 class DuplicateCaching(ASGICachesException):
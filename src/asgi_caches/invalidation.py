@@ -0,0 +1,178 @@
+"""
+Invalidation of cached responses by tag or by path.
+
+Cached responses are registered in indexes stored in the cache, which list the
+cache keys of responses for a given tag or path prefix. Invalidating a tag or
+a path prefix deletes all responses listed in the corresponding index.
+
+Each index is split into shards stored under separate keys, and a response is only
+registered in one of them (depending on its cache key). This way, storing a response
+only rewrites a fraction of the index, even if all responses share the same tag.
+"""
+
+import hashlib
+import math
+import time
+import typing
+
+from caches import Cache
+from starlette.datastructures import MutableHeaders
+from starlette.requests import Request
+
+from .local import LocalCache
+from .responses import CachedResponse
+from .utils.keys import get_path
+from .utils.logging import get_logger
+
+logger = get_logger(__name__)
+
+# Response header listing the tags of a response, separated by commas.
+TAG_HEADER = "Cache-Tag"
+
+# Number of shards each index is split into.
+INDEX_SHARDS = 32
+
+
+def get_tags(response: CachedResponse) -> typing.List[str]:
+    """Return the tags declared by a response using the `Cache-Tag` header."""
+    header = MutableHeaders(raw=response.headers).get(TAG_HEADER, "")
+    return [tag.strip() for tag in header.split(",") if tag.strip()]
+
+
+def get_path_prefixes(path: str) -> typing.List[str]:
+    """
+    Return the prefixes of a path, segment by segment.
+
+    For example, the prefixes of `/articles/1` are `/`, `/articles` and `/articles/1`.
+    """
+    segments = [segment for segment in path.split("/") if segment]
+    return ["/"] + [
+        "/" + "/".join(segments[: index + 1]) for index in range(len(segments))
+    ]
+
+
+def generate_tag_index_key(tag: str) -> str:
+    tag_hash = hashlib.md5(tag.encode("utf-8"))
+    return f"tag_index.{tag_hash.hexdigest()}"
+
+
+def generate_path_index_key(path_prefix: str) -> str:
+    path_prefix = get_path_prefixes(path_prefix)[-1]
+    path_hash = hashlib.md5(path_prefix.encode("utf-8"))
+    return f"path_index.{path_hash.hexdigest()}"
+
+
+def get_index_shard(cache_key: str) -> int:
+    """Return the shard of indexes in which `cache_key` is registered."""
+    return int(hashlib.md5(cache_key.encode("utf-8")).hexdigest(), 16) % INDEX_SHARDS
+
+
+def generate_index_shard_key(index_key: str, shard: int) -> str:
+    return f"{index_key}.{shard}"
+
+
+def get_index_shard_keys(index_key: str) -> typing.List[str]:
+    """Return the keys of all shards of an index."""
+    return [generate_index_shard_key(index_key, shard) for shard in range(INDEX_SHARDS)]
+
+
+async def index_cached_response(
+    cache_key: str,
+    response: CachedResponse,
+    *,
+    request: Request,
+    cache: Cache,
+    tags: typing.Sequence[str] = (),
+    index_paths: bool = False,
+) -> None:
+    """
+    Register a response stored at `cache_key` in the indexes of its tags and,
+    if `index_paths` is true, of the prefixes of the requested path.
+
+    Responses are not registered under `/`, which would list every cached response
+    (see `invalidate()`).
+
+    NOTE: index shards are updated using a read-modify-write cycle, so concurrent
+    updates of the same shard may result in some responses not being registered.
+    """
+    index_keys = [generate_tag_index_key(tag) for tag in tags]
+    if index_paths:
+        index_keys += [
+            generate_path_index_key(prefix)
+            for prefix in get_path_prefixes(get_path(request.scope))[1:]
+        ]
+    if not index_keys:
+        return
+    shard = get_index_shard(cache_key)
+    index_keys = [generate_index_shard_key(key, shard) for key in index_keys]
+
+    logger.trace_event("index_cached_response", cache_key=cache_key, tags=list(tags))
+
+    # Indexes map cache keys to their expiry, so that expired keys can be pruned.
+    now = time.time()
+    expires_at = response.get_expiry()
+    indexes: typing.Dict[str, typing.Dict[str, float]] = {}
+    for index_key, index in (await cache.get_many(index_keys)).items():
+        index = {key: expiry for key, expiry in (index or {}).items() if expiry > now}
+        index[cache_key] = expires_at
+        indexes[index_key] = index
+
+    # Keep indexes for as long as any of the responses they list.
+    max_expires_at = max(max(index.values()) for index in indexes.values())
+    ttl: typing.Optional[int] = None
+    if not math.isinf(max_expires_at):
+        ttl = max(math.ceil(max_expires_at - now), 1)
+    await cache.set_many(indexes, ttl=ttl)
+
+
+async def invalidate(
+    cache: Cache,
+    *,
+    tags: typing.Sequence[str] = (),
+    path_prefix: typing.Optional[str] = None,
+    local_cache: typing.Optional[LocalCache] = None,
+) -> int:
+    """
+    Delete all cached responses that have any of the given `tags`, or whose path
+    starts with the given `path_prefix` (segment by segment).
+
+    Responses are only registered by path prefix if `index_paths` was enabled
+    when storing them. They are not registered under `/`, so `path_prefix` must
+    contain at least one path segment: to delete all cached responses, clear the
+    cache backend explicitly instead.
+
+    Return the number of cache keys listed in the matching indexes. (These may
+    include keys of responses that have been invalidated or replaced already.)
+    """
+    if path_prefix is not None:
+        if not path_prefix:
+            raise ValueError("path_prefix must not be empty")
+        if get_path_prefixes(path_prefix) == ["/"]:
+            raise ValueError(
+                f"Cannot invalidate path_prefix={path_prefix!r}, as responses are "
+                "not indexed under '/'. HINT: use `await cache.clear()` to delete "
+                "all cached responses, if the cache isn't shared with other data."
+            )
+
+    index_keys = [generate_tag_index_key(tag) for tag in tags]
+    if path_prefix is not None:
+        index_keys.append(generate_path_index_key(path_prefix))
+    if not index_keys:
+        return 0
+    index_keys = [shard for key in index_keys for shard in get_index_shard_keys(key)]
+
+    cache_keys: typing.Set[str] = set()
+    for index in (await cache.get_many(index_keys)).values():
+        if index is not None:
+            cache_keys.update(index)
+
+    await cache.delete_many([*cache_keys, *index_keys])
+
+    if local_cache is not None:
+        for cache_key in cache_keys:
+            local_cache.delete(cache.make_key(cache_key))
+
+    logger.debug_event(
+        "invalidate", tags=list(tags), path_prefix=path_prefix, count=len(cache_keys)
+    )
+    return len(cache_keys)
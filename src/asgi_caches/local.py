@@ -0,0 +1,98 @@
+import math
+import time
+import typing
+from collections import OrderedDict
+
+from .responses import CachedResponse
+
+# Rough estimate of the memory used by an entry on top of its contents, in bytes.
+ENTRY_OVERHEAD = 256
+
+# How long entries are kept locally by default, in seconds.
+DEFAULT_TTL = 5
+
+
+class LocalCache:
+    """
+    A bounded in-process cache of already-decoded entries, meant to be placed in
+    front of a shared cache backend to serve hot resources without a network hop.
+
+    Least recently used entries are evicted once the estimated size of all
+    entries exceeds `max_size` bytes.
+
+    Entries expire at the same time as in the shared cache, or after `ttl`
+    seconds if sooner (pass `ttl=None` to disable this limit).
+
+    Each process has its own local cache, which is not notified when entries are
+    updated or invalidated by other processes: these may keep serving outdated
+    entries for up to `ttl` seconds.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_size: int = 64 * 1024 * 1024,
+        ttl: typing.Optional[float] = DEFAULT_TTL,
+    ) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size = 0
+        self._entries: "OrderedDict[str, typing.Tuple[typing.Any, float, int]]" = (
+            OrderedDict()
+        )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> typing.Any:
+        """Return the value stored at `key`, or `None` if missing or expired."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        value, expires_at, _ = entry
+        if expires_at <= time.time():
+            self.delete(key)
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: typing.Any, *, expires_at: float = math.inf) -> None:
+        """Store `value` at `key` until the `expires_at` timestamp."""
+        self.delete(key)
+
+        if self.ttl is not None:
+            expires_at = min(expires_at, time.time() + self.ttl)
+
+        size = get_size(value)
+        if size > self.max_size:
+            return
+
+        self._entries[key] = (value, expires_at, size)
+        self.size += size
+
+        while self.size > self.max_size:
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def delete(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.size = 0
+
+
+def get_size(value: typing.Any) -> int:
+    """Estimate the memory used by a cached value, in bytes."""
+    if isinstance(value, CachedResponse):
+        return (
+            ENTRY_OVERHEAD
+            + len(value.body)
+            + sum(len(name) + len(header) for name, header in value.headers)
+        )
+    assert isinstance(value, list)
+    return ENTRY_OVERHEAD + sum(len(item) for item in value)
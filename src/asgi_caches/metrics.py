@@ -0,0 +1,227 @@
+"""
+Metrics about cache lookups and writes.
+
+`CacheMiddleware` reports events to a `Metrics` collector, labeled by route:
+
+* Counters: `hits`, `stale_hits`, `misses`, `bypasses` (labeled by `reason`),
+`stores` and `store_errors`.
+* Histograms: `lookup_seconds`, `store_seconds` and `entry_size_bytes`.
+"""
+
+import bisect
+import typing
+
+from starlette.routing import BaseRoute, Match, Mount
+from starlette.types import ASGIApp, Scope
+
+Labels = typing.Dict[str, str]
+
+COUNTERS = ("hits", "stale_hits", "misses", "bypasses", "stores", "store_errors")
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+)
+SIZE_BUCKETS = tuple(1024 * 4 ** exponent for exponent in range(9))  # 1 KiB - 64 MiB
+HISTOGRAMS: typing.Dict[str, typing.Tuple[float, ...]] = {
+    "lookup_seconds": LATENCY_BUCKETS,
+    "store_seconds": LATENCY_BUCKETS,
+    "entry_size_bytes": SIZE_BUCKETS,
+}
+
+# Label used for requests that don't match any route.
+UNKNOWN_ROUTE = "<unknown>"
+MAX_MEMOIZED_ROUTES = 1024
+
+
+class Metrics:
+    """
+    Base class for metrics collectors.
+
+    Methods are called while requests are being processed, so they should
+    return quickly.
+    """
+
+    def __init__(self) -> None:
+        self._routes: typing.Dict[str, str] = {}
+
+    def increment(self, name: str, labels: Labels) -> None:
+        """Increment the counter `name`."""
+        raise NotImplementedError  # pragma: no cover
+
+    def observe(self, name: str, value: float, labels: Labels) -> None:
+        """Record a `value` in the histogram `name`."""
+        raise NotImplementedError  # pragma: no cover
+
+    def get_route(self, scope: Scope, app: typing.Optional[ASGIApp] = None) -> str:
+        """
+        Return the route label of a request, i.e. the path template of the
+        matching route (such as `/users/{id}`) in the application `app` which
+        the request is passed to.
+
+        Override this method to label requests differently.
+        """
+        path = scope["path"]
+        route = self._routes.get(path)
+        if route is None:
+            route = get_route_template(scope, app) or UNKNOWN_ROUTE
+            if len(self._routes) >= MAX_MEMOIZED_ROUTES:
+                self._routes.clear()
+            self._routes[path] = route
+        return route
+
+
+class Histogram:
+    """
+    A distribution of values, counted in `buckets` of values less than or equal
+    to each of the given bounds.
+    """
+
+    def __init__(self, bounds: typing.Sequence[float]) -> None:
+        self.bounds = bounds
+        # NOTE: the last bucket counts values greater than all bounds.
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class InMemoryMetrics(Metrics):
+    """
+    Keep metrics in memory, e.g. to expose them using a custom endpoint.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.counters: typing.Dict[
+            typing.Tuple[str, typing.Tuple[typing.Tuple[str, str], ...]], int
+        ] = {}
+        self.histograms: typing.Dict[
+            typing.Tuple[str, typing.Tuple[typing.Tuple[str, str], ...]], Histogram
+        ] = {}
+
+    def increment(self, name: str, labels: Labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + 1
+
+    def observe(self, name: str, value: float, labels: Labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(HISTOGRAMS[name])
+        histogram.observe(value)
+
+    def get_count(self, name: str, **labels: str) -> int:
+        """
+        Return the value of the counter `name`, summed over all label values
+        except the given ones.
+        """
+        return sum(
+            count
+            for (counter_name, counter_labels), count in self.counters.items()
+            if counter_name == name and labels.items() <= dict(counter_labels).items()
+        )
+
+    def get_histogram(self, name: str, **labels: str) -> typing.Optional[Histogram]:
+        """Return the histogram `name` for the given labels, if any."""
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+
+class PrometheusMetrics(Metrics):
+    """
+    Export metrics to Prometheus, using `prometheus_client`.
+
+    Metrics are prefixed with the `namespace`, and registered in the given
+    `registry` (defaults to the global registry).
+    """
+
+    def __init__(
+        self, *, namespace: str = "asgi_caches", registry: typing.Any = None
+    ) -> None:
+        super().__init__()
+        import prometheus_client
+
+        if registry is None:
+            registry = prometheus_client.REGISTRY
+
+        self.counters: typing.Dict[str, typing.Any] = {
+            name: prometheus_client.Counter(
+                name,
+                f"Cache {name.replace('_', ' ')}",
+                ["route", "reason"] if name == "bypasses" else ["route"],
+                namespace=namespace,
+                registry=registry,
+            )
+            for name in COUNTERS
+        }
+        self.histograms: typing.Dict[str, typing.Any] = {
+            name: prometheus_client.Histogram(
+                name,
+                f"Cache {name.replace('_', ' ')}",
+                ["route"],
+                namespace=namespace,
+                registry=registry,
+                buckets=buckets,
+            )
+            for name, buckets in HISTOGRAMS.items()
+        }
+
+    def increment(self, name: str, labels: Labels) -> None:
+        self.counters[name].labels(**labels).inc()
+
+    def observe(self, name: str, value: float, labels: Labels) -> None:
+        self.histograms[name].labels(**labels).observe(value)
+
+
+def get_routes(
+    app: typing.Optional[ASGIApp],
+) -> typing.Optional[typing.List[BaseRoute]]:
+    """
+    Return the routes of a Starlette application or router, looking through any
+    middleware wrapping it.
+    """
+    while app is not None:
+        routes = getattr(app, "routes", None)
+        if routes is not None:
+            return routes
+        app = getattr(app, "app", None)
+    return None
+
+
+def get_route_template(
+    scope: Scope, app: typing.Optional[ASGIApp] = None
+) -> typing.Optional[str]:
+    """
+    Return the path template of the route matching a request in the Starlette
+    application `app` (or the application being called, if not given), if any.
+    """
+    template = ""
+    # NOTE: `app` may be an endpoint, e.g. when using `@cached()`.
+    routes = get_routes(app) or get_routes(scope.get("app"))
+    while routes:
+        for route in routes:
+            match, child_scope = route.matches(scope)
+            if match != Match.NONE:
+                break
+        else:
+            return None
+
+        template += getattr(route, "path", "")
+        if not isinstance(route, Mount):
+            return template
+        scope = {**scope, **child_scope}
+        routes = route.routes
+    return template or None
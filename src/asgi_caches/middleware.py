@@ -1,23 +1,48 @@
+import asyncio
+import functools
+import time
 import typing
 
 from caches import Cache
-from starlette.datastructures import MutableHeaders
+from starlette.datastructures import URL, MutableHeaders
 from starlette.requests import Request
-from starlette.responses import Response
 from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
-from .exceptions import (
-    CacheNotConnected,
-    DuplicateCaching,
-    RequestNotCachable,
-    ResponseNotCachable,
+from .compression import DEFAULT_MIN_SIZE, Codec, is_compressible
+from .exceptions import CacheNotConnected, DuplicateCaching, ResponseNotCachable
+from .invalidation import invalidate
+from .local import LocalCache
+from .metrics import Metrics
+from .policies import AdmissionPolicy, KeyPolicy
+from .responses import CachedResponse, RawHeaders, add_vary_header
+from .serializers import DEFAULT_SERIALIZER, Serializer
+from .utils.cache import (
+    CACHABLE_METHODS,
+    CACHABLE_STATUS_CODES,
+    CacheLookup,
+    get_encoded_response,
+    is_not_modified,
+    lookup_cached_response,
+    patch_cache_control,
+    prepare_cached_response,
+    store_cached_response,
 )
-from .utils.cache import get_from_cache, patch_cache_control, store_in_cache
-from .utils.logging import HIT_EXTRA, MISS_EXTRA, get_logger
-from .utils.misc import kvformat
+from .utils.keys import hash_url
+from .utils.logging import HIT_EXTRA, MISS_EXTRA, STALE_EXTRA, get_logger
+from .writer import CacheWriter
 
 logger = get_logger(__name__)
 
+# Largest response body buffered for storing in the cache, in bytes.
+DEFAULT_MAX_BODY_SIZE = 1024 * 1024
+CACHE_CONTROL = b"cache-control"
+MAX_PATCHED_VALUES = 256
+# Scope key under which the outcome of caching is recorded for callers that own
+# the scope (see `asgi_caches.warming`): 'hit', 'stored', 'queued' (for storing by
+# the background writer), or the reason why the response was not stored, e.g.
+# 'write_dropped' if the queue of the background writer was full.
+CACHE_STATUS_KEY = "__asgi_caches_status__"
+
 
 async def unattached_receive() -> Message:
     raise RuntimeError("receive awaitable not set")  # pragma: no cover
@@ -28,11 +53,53 @@ async def unattached_send(message: Message) -> None:
 
 
 class CacheMiddleware:
-    def __init__(self, app: ASGIApp, *, cache: Cache) -> None:
+    def __init__(
+        self,
+        app: ASGIApp,
+        *,
+        cache: Cache,
+        single_flight: bool = False,
+        serializer: Serializer = DEFAULT_SERIALIZER,
+        max_body_size: typing.Optional[int] = DEFAULT_MAX_BODY_SIZE,
+        writer: typing.Optional[CacheWriter] = None,
+        local_cache: typing.Optional[LocalCache] = None,
+        tags: typing.Sequence[str] = (),
+        index_paths: bool = False,
+        key_policy: typing.Optional[KeyPolicy] = None,
+        metrics: typing.Optional[Metrics] = None,
+        encodings: typing.Sequence[Codec] = (),
+        min_encoding_size: int = DEFAULT_MIN_SIZE,
+        admission_policy: typing.Optional[AdmissionPolicy] = None,
+        cachable_status_codes: typing.Collection[int] = CACHABLE_STATUS_CODES,
+        status_ttls: typing.Optional[typing.Mapping[int, int]] = None,
+    ) -> None:
         self.app = app
         self.cache = cache
+        self.serializer = serializer
+        self.max_body_size = max_body_size
+        self.writer = writer
+        self.local_cache = local_cache
+        self.tags = tags
+        self.index_paths = index_paths
+        self.key_policy = key_policy
+        self.metrics = metrics
+        self.encodings = encodings
+        self.min_encoding_size = min_encoding_size
+        self.admission_policy = admission_policy
+        self.cachable_status_codes = cachable_status_codes
+        self.status_ttls = status_ttls
+        # Cache misses currently being computed, when single-flight is enabled.
+        self.inflight: typing.Optional[typing.Dict[str, asyncio.Event]] = (
+            {} if single_flight else None
+        )
+        # Background refreshes of stale responses currently running.
+        self.revalidating: typing.Dict[str, asyncio.Future] = {}
 
     async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "lifespan" and self.writer is not None:
+            await self.app(scope, self.make_lifespan_receive(receive), send)
+            return
+
         if scope["type"] != "http":
             await self.app(scope, receive, send)
             return
@@ -49,96 +116,499 @@ class CacheMiddleware:
 
         scope["__asgi_caches__"] = True
 
-        responder = CacheResponder(self.app, cache=self.cache)
+        if scope["method"] not in CACHABLE_METHODS:
+            # Don't make requests that can't be cached pay for caching.
+            logger.trace_event("request_not_cachable", reason="method")
+            scope[CACHE_STATUS_KEY] = "method"
+            if self.metrics is not None:
+                route = self.metrics.get_route(scope, self.app)
+                self.metrics.increment("bypasses", {"route": route, "reason": "method"})
+            await self.app(scope, receive, send)
+            return
+
+        responder = CacheResponder(self, writer=self.writer)
         await responder(scope, receive, send)
 
+    async def invalidate(
+        self,
+        *,
+        tags: typing.Sequence[str] = (),
+        path_prefix: typing.Optional[str] = None,
+    ) -> int:
+        """
+        Delete cached responses by tag or by path prefix.
+
+        See `asgi_caches.invalidation.invalidate()`.
+        """
+        return await invalidate(
+            self.cache,
+            tags=tags,
+            path_prefix=path_prefix,
+            local_cache=self.local_cache,
+        )
+
+    def make_lifespan_receive(self, receive: Receive) -> Receive:
+        """
+        Wrap a lifespan `receive` callable so that pending cache writes are
+        performed before the application shuts down.
+        """
+        assert self.writer is not None
+        writer = self.writer
+
+        async def lifespan_receive() -> Message:
+            message = await receive()
+            if message["type"] == "lifespan.shutdown":
+                logger.trace_event("drain_cache_writer", pending=writer.pending)
+                await writer.drain()
+            return message
+
+        return lifespan_receive
+
 
 class CacheResponder:
-    def __init__(self, app: ASGIApp, *, cache: Cache) -> None:
-        self.app = app
-        self.cache = cache
+    __slots__ = (
+        "middleware",
+        "writer",
+        "inflight_key",
+        "send",
+        "is_response_cachable",
+        "is_response_started",
+        "request",
+        "cached_response",
+        "body_parts",
+        "body_size",
+        "pending_write",
+        "fallback",
+        "use_fallback",
+        "labels",
+    )
+
+    def __init__(
+        self, middleware: CacheMiddleware, *, writer: typing.Optional[CacheWriter]
+    ) -> None:
+        # NOTE: options are read from the middleware, so that we only need to keep
+        # track of the state of the request being processed.
+        self.middleware = middleware
+        self.writer = writer
+        # The key under which concurrent requests wait for our response, if any.
+        self.inflight_key: typing.Optional[str] = None
         self.send: Send = unattached_send
-        self.initial_message: Message = {}
         self.is_response_cachable = True
+        self.is_response_started = False
+        # NOTE: only built on cache misses, as cache hits are served from the scope.
         self.request: typing.Optional[Request] = None
+        # The response being stored, and the chunks of its body received so far.
+        self.cached_response: typing.Optional[CachedResponse] = None
+        self.body_parts: typing.List[bytes] = []
+        self.body_size = 0
+        # Completes once the response has been stored by the background writer.
+        self.pending_write: typing.Optional[asyncio.Future] = None
+        # A stale response to serve in case the application fails.
+        self.fallback: typing.Optional[CachedResponse] = None
+        self.use_fallback = False
+        # Labels of metrics about this request.
+        self.labels: typing.Dict[str, str] = {}
 
     async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
         assert scope["type"] == "http"
+        middleware = self.middleware
 
-        if not self.cache.is_connected:
-            raise CacheNotConnected(self.cache)
+        if not middleware.cache.is_connected:
+            raise CacheNotConnected(middleware.cache)
 
-        request = Request(scope)
+        if middleware.admission_policy is not None:
+            middleware.admission_policy.record_access(
+                scope, key_policy=middleware.key_policy
+            )
 
-        try:
-            response = await get_from_cache(request, cache=self.cache)
-        except RequestNotCachable:
-            await self.app(scope, receive, send)
-        else:
-            if response is not None:
+        if middleware.metrics is not None:
+            self.labels = {"route": middleware.metrics.get_route(scope, middleware.app)}
+            start = time.perf_counter()
+
+        lookup = await self.lookup(scope)
+        cached_response = lookup.response
+
+        if middleware.metrics is not None:
+            self.observe("lookup_seconds", time.perf_counter() - start)
+
+        if cached_response is not None:
+            staleness = cached_response.get_staleness()
+
+            if staleness <= 0:
                 logger.debug("cache_lookup %s", "HIT", extra=HIT_EXTRA)
-                await response(scope, receive, send)
+                self.increment("hits")
+                await self.serve(lookup, scope, receive, send)
                 return
+
+            if staleness <= cached_response.stale_while_revalidate:
+                logger.debug("cache_lookup %s", "STALE", extra=STALE_EXTRA)
+                self.increment("stale_hits")
+                await self.serve(lookup, scope, receive, send)
+                self.schedule_revalidation(scope)
+                return
+
+            # The response may only be served stale if the application fails.
+            self.fallback = cached_response
+
+        inflight = middleware.inflight
+        if inflight is None:
+            logger.debug("cache_lookup %s", "MISS", extra=MISS_EXTRA)
+            self.increment("misses")
+            await self.respond_and_store(scope, receive, send)
+            return
+
+        # NOTE: requests share cache keys if their URL is equivalent as per the
+        # key policy, in which case they should share the computed response too.
+        key = hash_url(scope, middleware.key_policy)
+        event = inflight.get(key)
+
+        if event is None:
+            # We're the first to miss on this resource: compute the response,
+            # and let concurrent requests know once it's done.
             logger.debug("cache_lookup %s", "MISS", extra=MISS_EXTRA)
-            self.request = request
-            self.send = send
-            await self.app(scope, receive, self.send_with_caching)
+            self.increment("misses")
+            inflight[key] = asyncio.Event()
+            self.inflight_key = key
+            try:
+                await self.respond_and_store(scope, receive, send)
+                if self.pending_write is not None:
+                    # Make sure waiting requests can be served from the cache.
+                    await self.pending_write
+            finally:
+                self.release_waiters()
+            return
+
+        logger.trace_event("wait_for_inflight_request", url_hash=key)
+        await event.wait()
+
+        # If the response could not be cached, there won't be anything to
+        # serve, in which case we must fall through to the application.
+        lookup = await self.lookup(scope)
+        if lookup.response is not None and lookup.response.get_staleness() <= 0:
+            logger.debug("cache_lookup %s", "HIT", extra=HIT_EXTRA)
+            self.increment("hits")
+            await self.serve(lookup, scope, receive, send)
+            return
+
+        logger.debug("cache_lookup %s", "MISS", extra=MISS_EXTRA)
+        self.increment("misses")
+        await self.respond_and_store(scope, receive, send)
+
+    async def lookup(self, scope: Scope) -> CacheLookup:
+        middleware = self.middleware
+        return await lookup_cached_response(
+            scope,
+            cache=middleware.cache,
+            serializer=middleware.serializer,
+            local_cache=middleware.local_cache,
+            key_policy=middleware.key_policy,
+            codecs=middleware.encodings,
+        )
+
+    async def serve(
+        self, lookup: CacheLookup, scope: Scope, receive: Receive, send: Send
+    ) -> None:
+        middleware = self.middleware
+        cached_response = lookup.response
+        assert cached_response is not None
+        assert lookup.cache_key is not None
+        scope[CACHE_STATUS_KEY] = "hit"
+        if is_not_modified(scope, cached_response):
+            logger.trace_event("not_modified")
+            cached_response = cached_response.to_not_modified()
+        elif middleware.encodings:
+            cached_response = await get_encoded_response(
+                scope,
+                cached_response,
+                middleware.encodings,
+                cache=middleware.cache,
+                cache_key=lookup.cache_key,
+                min_size=middleware.min_encoding_size,
+                local_cache=middleware.local_cache,
+                encoded_bodies=lookup.encoded_bodies,
+            )
+        await cached_response(scope, receive, send)
+
+    async def respond_and_store(
+        self, scope: Scope, receive: Receive, send: Send
+    ) -> None:
+        app = self.middleware.app
+        self.request = Request(scope)
+        self.send = send
+
+        if self.fallback is None:
+            await app(scope, receive, self.send_with_caching)
+            return
+
+        try:
+            await app(scope, receive, self.send_with_caching)
+        except Exception:
+            if self.is_response_started:
+                raise
+            logger.trace("serve_stale_response reason=%s", "exception", exc_info=True)
+            self.use_fallback = True
+
+        if self.use_fallback:
+            logger.debug("cache_lookup %s", "STALE", extra=STALE_EXTRA)
+            await self.fallback(scope, receive, send)
+
+    def schedule_revalidation(self, scope: Scope) -> None:
+        revalidating = self.middleware.revalidating
+        key = str(URL(scope=scope))
+        if key in revalidating:
+            logger.trace_event("revalidation_pending", url=key)
+            return
+        logger.trace_event("schedule_revalidation", url=key)
+        revalidating[key] = asyncio.ensure_future(self.revalidate(scope, key))
+
+    async def revalidate(self, scope: Scope, key: str) -> None:
+        """
+        Refresh a stale response by passing the request through the application
+        again, and storing the resulting response in the cache.
+        """
+        # Always refresh the GET response, as this is the one we look up first.
+        scope = {**scope, "method": "GET"}
+        # NOTE: we're running in the background already, so store the response
+        # right away.
+        responder = CacheResponder(self.middleware, writer=None)
+        responder.labels = self.labels
+        try:
+            await responder.respond_and_store(
+                scope, make_revalidation_receive(), discard_send
+            )
+        except Exception:
+            logger.exception("revalidation_failed url=%r", key)
+        finally:
+            del self.middleware.revalidating[key]
 
     async def send_with_caching(self, message: Message) -> None:
+        if self.use_fallback:
+            return
+
         if not self.is_response_cachable:
             await self.send(message)
             return
 
         if message["type"] == "http.response.start":
-            # Defer sending this message until we figured out
-            # whether the response can be cached.
-            self.initial_message = message
+            if self.fallback is not None and message["status"] >= 500:
+                logger.trace_event("serve_stale_response", reason="status_code")
+                self.use_fallback = True
+                return
+            # Cachability only depends on the status code and headers, so inject
+            # caching headers and send the response start right away.
+            self.is_response_started = True
+            self.prepare_response(message)
+            await self.send(message)
             return
 
         assert message["type"] == "http.response.body"
-        if message.get("more_body", False):
-            logger.trace("response_not_cachable reason=is_streaming")
-            self.is_response_cachable = False
-            await self.send(self.initial_message)
+
+        # Accumulate the body while passing it through, so that streaming responses
+        # are sent to the client as they are produced.
+        body = message.get("body", b"")
+        self.body_size += len(body)
+        max_body_size = self.middleware.max_body_size
+        if max_body_size is not None and self.body_size > max_body_size:
+            logger.trace_event("response_not_cachable", reason="body_too_large")
+            self.bypass("body_too_large")
+            self.body_parts = []
             await self.send(message)
             return
 
+        self.body_parts.append(body)
+        await self.send(message)
+
+        if not message.get("more_body", False):
+            # Store the response once it has been sent, so that writing to the cache
+            # doesn't delay the client.
+            assert self.request is not None
+            assert self.cached_response is not None
+            cached_response = self.cached_response._replace(
+                body=b"".join(self.body_parts)
+            )
+            admission_policy = self.middleware.admission_policy
+            if admission_policy is not None:
+                reason = admission_policy.check(
+                    self.request.scope,
+                    cached_response,
+                    key_policy=self.middleware.key_policy,
+                )
+                if reason is not None:
+                    logger.trace_event("response_not_cachable", reason=reason)
+                    self.bypass(reason)
+                    return
+            store = functools.partial(self.store, cached_response, self.request)
+            if self.writer is None:
+                await store()
+            else:
+                self.pending_write = self.writer.submit(store)
+                self.request.scope[CACHE_STATUS_KEY] = (
+                    "queued" if self.pending_write is not None else "write_dropped"
+                )
+
+    async def store(self, cached_response: CachedResponse, request: Request) -> None:
+        middleware = self.middleware
+        start = time.perf_counter()
+        try:
+            await store_cached_response(
+                cached_response,
+                request=request,
+                cache=middleware.cache,
+                serializer=middleware.serializer,
+                local_cache=middleware.local_cache,
+                tags=middleware.tags,
+                index_paths=middleware.index_paths,
+                key_policy=middleware.key_policy,
+            )
+        except Exception:
+            self.increment("store_errors")
+            raise
+        request.scope[CACHE_STATUS_KEY] = "stored"
+        if middleware.metrics is not None:
+            self.increment("stores")
+            self.observe("store_seconds", time.perf_counter() - start)
+            self.observe("entry_size_bytes", len(cached_response.body))
+
+    def bypass(self, reason: str) -> None:
+        """Don't store the response being sent, for the given reason."""
         assert self.request is not None
-        body = message["body"]
-        response = Response(content=body, status_code=self.initial_message["status"])
-        # NOTE: be sure not to mutate the original headers directly, as another Response
-        # object might be holding a reference to the same list.
-        response.raw_headers = list(self.initial_message["headers"])
+        self.increment("bypasses", reason=reason)
+        self.request.scope[CACHE_STATUS_KEY] = reason
+        self.is_response_cachable = False
+        # Don't keep concurrent requests waiting for the rest of a response
+        # which won't be cached anyway, e.g. an endless stream.
+        self.release_waiters()
+
+    def release_waiters(self) -> None:
+        """Let concurrent requests waiting for our response proceed."""
+        if self.inflight_key is None:
+            return
+        assert self.middleware.inflight is not None
+        self.middleware.inflight.pop(self.inflight_key).set()
+        self.inflight_key = None
+
+    def increment(self, name: str, **labels: str) -> None:
+        metrics = self.middleware.metrics
+        if metrics is not None:
+            metrics.increment(name, {**self.labels, **labels})
 
+    def observe(self, name: str, value: float) -> None:
+        metrics = self.middleware.metrics
+        if metrics is not None:
+            metrics.observe(name, value, self.labels)
+
+    def prepare_response(self, message: Message) -> None:
+        assert self.request is not None
+        middleware = self.middleware
         try:
-            await store_in_cache(response, request=self.request, cache=self.cache)
-        except ResponseNotCachable:
-            self.is_response_cachable = False
+            self.cached_response = prepare_cached_response(
+                message["status"],
+                # NOTE: be sure not to mutate the original headers directly, as another
+                # object might be holding a reference to the same list.
+                list(message["headers"]),
+                request=self.request,
+                cache=middleware.cache,
+                cachable_status_codes=middleware.cachable_status_codes,
+                status_ttls=middleware.status_ttls,
+            )
+        except ResponseNotCachable as exc:
+            self.bypass(exc.reason)
         else:
-            # Apply any headers added or modified by 'store_in_cache()'.
-            self.initial_message["headers"] = list(response.raw_headers)
+            # Apply any headers added or modified by 'prepare_cached_response()'.
+            # NOTE: send a copy of the headers we store, as outer middleware may
+            # edit the sent headers in place, e.g. to add a 'Set-Cookie' header.
+            headers = list(self.cached_response.headers)
+            if middleware.encodings and is_compressible(headers):
+                # Cache hits may be sent with a compressed body.
+                headers = add_vary_header(headers, b"Accept-Encoding")
+            message["headers"] = headers
 
-        await self.send(self.initial_message)
-        await self.send(message)
+
+def make_revalidation_receive() -> Receive:
+    """
+    Return a `receive` callable for background requests, which have an empty body
+    and don't have a client that could disconnect.
+    """
+    request_sent = False
+
+    async def receive() -> Message:
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        # There is no client that could disconnect, so wait forever.
+        await asyncio.Event().wait()
+        return {"type": "http.disconnect"}  # pragma: no cover
+
+    return receive
+
+
+async def discard_send(message: Message) -> None:
+    pass
 
 
 class CacheControlMiddleware:
     def __init__(self, app: ASGIApp, **kwargs: typing.Any) -> None:
         self.app = app
         self.kwargs = kwargs
+        # Patched `Cache-Control` header values, by initial value.
+        self.patched_values: typing.Dict[
+            typing.Optional[bytes], typing.Optional[bytes]
+        ] = {}
 
     async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
         if scope["type"] != "http":
             await self.app(scope, receive, send)
             return
-        responder = CacheControlResponder(self.app, **self.kwargs)
+        responder = CacheControlResponder(self.app, self)
         await responder(scope, receive, send)
 
+    def get_patched_value(
+        self, value: typing.Optional[bytes]
+    ) -> typing.Optional[bytes]:
+        """
+        Return the patched value of a `Cache-Control` header (`None` meaning that
+        the header is missing, or should be removed).
+        """
+        try:
+            return self.patched_values[value]
+        except KeyError:
+            pass
+
+        headers = MutableHeaders(raw=[] if value is None else [(CACHE_CONTROL, value)])
+        patch_cache_control(headers, **self.kwargs)
+        patched_value = headers.raw[0][1] if headers.raw else None
+        # Responses usually have one of a few `Cache-Control` values.
+        if len(self.patched_values) < MAX_PATCHED_VALUES:
+            self.patched_values[value] = patched_value
+        return patched_value
+
+    def patch_headers(self, headers: RawHeaders) -> RawHeaders:
+        """Return raw response headers with a patched `Cache-Control` header."""
+        value = next((value for key, value in headers if key == CACHE_CONTROL), None)
+        patched_value = self.get_patched_value(value)
+        if patched_value == value:
+            return headers
+
+        # NOTE: as with `MutableHeaders`, replace the first header and drop others.
+        patched_headers = []
+        for key, value in headers:
+            if key != CACHE_CONTROL:
+                patched_headers.append((key, value))
+            elif patched_value is not None:
+                patched_headers.append((key, patched_value))
+                patched_value = None
+        if patched_value is not None:
+            patched_headers.append((CACHE_CONTROL, patched_value))
+        return patched_headers
+
 
 class CacheControlResponder:
-    def __init__(self, app: ASGIApp, **kwargs: typing.Any) -> None:
+    __slots__ = ("app", "middleware", "send")
+
+    def __init__(self, app: ASGIApp, middleware: CacheControlMiddleware) -> None:
         self.app = app
-        self.kwargs = kwargs
+        self.middleware = middleware
         self.send: Send = unattached_send
 
     async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
@@ -148,9 +618,7 @@ class CacheControlResponder:
 
     async def send_with_caching(self, message: Message) -> None:
         if message["type"] == "http.response.start":
-            logger.trace(f"patch_cache_control {kvformat(**self.kwargs)}")
-            headers = MutableHeaders(raw=list(message["headers"]))
-            patch_cache_control(headers, **self.kwargs)
-            message["headers"] = headers.raw
+            logger.trace_event("patch_cache_control", **self.middleware.kwargs)
+            message["headers"] = self.middleware.patch_headers(message["headers"])
 
         await self.send(message)
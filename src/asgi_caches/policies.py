@@ -0,0 +1,357 @@
+"""
+Policies that fine-tune how requests are mapped to cached responses, and which
+responses are stored in the cache.
+"""
+
+import fnmatch
+import re
+import time
+import typing
+from collections import OrderedDict
+from urllib.parse import parse_qsl, urlencode
+
+from starlette.types import Scope
+
+from .utils.keys import DEFAULT_PORTS, hash_url
+
+if typing.TYPE_CHECKING:  # pragma: no cover
+    from .responses import CachedResponse
+
+# Convert the value of a request header into the value used in cache keys.
+Normalizer = typing.Callable[[bytes], bytes]
+
+
+class KeyPolicy:
+    """
+    Control which parts of the requested URL make up cache keys, so that
+    equivalent requests share the same cached response.
+
+    * `sort_query`: sort query parameters by name, so that their order doesn't matter.
+    (The order of repeated parameters is preserved.)
+    * `include_query`: if given, only keep query parameters whose name matches any
+    of these glob patterns.
+    * `exclude_query`: ignore query parameters whose name matches any of these glob
+    patterns, e.g. `["utm_*", "fbclid"]`.
+    * `normalize_host`: compare hosts case-insensitively, ignoring default ports and
+    trailing dots.
+    * `ignore_scheme`: share cached responses between HTTP and HTTPS requests.
+    * `vary_normalizers`: a mapping of request header names to normalizers, which
+    are applied to header values listed in the `Vary` header of responses. (See
+    e.g. `AcceptEncodingNormalizer`.)
+    """
+
+    def __init__(
+        self,
+        *,
+        sort_query: bool = True,
+        include_query: typing.Optional[typing.Sequence[str]] = None,
+        exclude_query: typing.Sequence[str] = (),
+        normalize_host: bool = False,
+        ignore_scheme: bool = False,
+        vary_normalizers: typing.Optional[typing.Mapping[str, Normalizer]] = None,
+    ) -> None:
+        self.sort_query = sort_query
+        self.include_query = include_query
+        self.exclude_query = exclude_query
+        self.normalize_host = normalize_host
+        self.ignore_scheme = ignore_scheme
+        self.vary_normalizers = {
+            name.lower(): normalizer
+            for name, normalizer in (vary_normalizers or {}).items()
+        }
+        self._include_pattern = compile_patterns(include_query or ())
+        self._exclude_pattern = compile_patterns(exclude_query)
+
+    def normalize_url(
+        self, scheme: str, host: bytes, query_string: bytes
+    ) -> typing.Tuple[str, bytes, bytes]:
+        """
+        Return the scheme, host and query string that identify a request URL.
+        """
+        if self.normalize_host:
+            host = normalize_host(host, scheme)
+        if self.ignore_scheme:
+            scheme = ""
+        return scheme, host, self.normalize_query_string(query_string)
+
+    def normalize_query_string(self, query_string: bytes) -> bytes:
+        if not query_string or not (
+            self.sort_query
+            or self.include_query is not None
+            or self._exclude_pattern is not None
+        ):
+            return query_string
+
+        # NOTE: decode escapes as latin-1, which maps bytes to characters one-to-one,
+        # so that distinct escapes (including invalid UTF-8) give distinct keys.
+        params = [
+            (name, value)
+            for name, value in parse_qsl(
+                query_string.decode("latin-1"),
+                keep_blank_values=True,
+                encoding="latin-1",
+            )
+            if self.is_param_included(
+                name.encode("latin-1").decode("utf-8", errors="replace")
+            )
+        ]
+        if self.sort_query:
+            params.sort(key=lambda param: param[0])
+        return urlencode(params, encoding="latin-1").encode("ascii")
+
+    def is_param_included(self, name: str) -> bool:
+        """Return whether the query parameter `name` is part of cache keys."""
+        if self.include_query is not None and (
+            self._include_pattern is None or not self._include_pattern.match(name)
+        ):
+            return False
+        if self._exclude_pattern is not None and self._exclude_pattern.match(name):
+            return False
+        return True
+
+    def normalize_header(self, name: str, value: bytes) -> bytes:
+        """
+        Return the value of the (lowercase) request header `name` used in cache keys.
+        """
+        normalizer = self.vary_normalizers.get(name)
+        return value if normalizer is None else normalizer(value)
+
+
+class AcceptEncodingNormalizer:
+    """
+    Collapse `Accept-Encoding` headers into the preferred encoding among the
+    given `encodings`, or `identity` if none of them is acceptable.
+
+    Ties are broken using the order of `encodings`.
+    """
+
+    def __init__(self, encodings: typing.Sequence[str] = ("br", "gzip")) -> None:
+        self.encodings = [encoding.lower() for encoding in encodings]
+
+    def __call__(self, value: bytes) -> bytes:
+        encoding = negotiate(value, self.encodings, match_token)
+        return b"identity" if encoding is None else encoding.encode("latin-1")
+
+
+class AcceptLanguageNormalizer:
+    """
+    Collapse `Accept-Language` headers into the preferred language among the
+    given `languages`, or the first one if none of them is acceptable.
+
+    Language ranges match languages they are a prefix of, and vice versa, e.g.
+    `en` matches `en-GB`, and `en-US` matches `en`.
+    """
+
+    def __init__(self, languages: typing.Sequence[str]) -> None:
+        assert languages, "At least one language is required"
+        self.languages = [language.lower() for language in languages]
+
+    def __call__(self, value: bytes) -> bytes:
+        language = negotiate(value, self.languages, match_language)
+        return (self.languages[0] if language is None else language).encode("latin-1")
+
+
+class AcceptNormalizer:
+    """
+    Collapse `Accept` headers into the preferred media type among the given
+    `media_types`, or an empty value if none of them is acceptable.
+
+    Requests without an `Accept` header accept any media type.
+    """
+
+    def __init__(self, media_types: typing.Sequence[str]) -> None:
+        self.media_types = [media_type.lower() for media_type in media_types]
+
+    def __call__(self, value: bytes) -> bytes:
+        media_type = negotiate(value or b"*/*", self.media_types, match_media_type)
+        return b"" if media_type is None else media_type.encode("latin-1")
+
+
+class AdmissionPolicy:
+    """
+    Base class for admission policies, which decide whether cachable responses
+    are stored in the cache, e.g. to keep rarely requested responses from
+    evicting popular ones.
+    """
+
+    def record_access(
+        self, scope: Scope, *, key_policy: typing.Optional[KeyPolicy] = None
+    ) -> None:
+        """
+        Record a request for a cachable resource, before looking it up.
+
+        `key_policy` is the key policy of the middleware, if any.
+        """
+
+    def check(
+        self,
+        scope: Scope,
+        response: "CachedResponse",
+        *,
+        key_policy: typing.Optional[KeyPolicy] = None,
+    ) -> typing.Optional[str]:
+        """
+        Return why a response to a request must not be stored in the cache,
+        or `None` to store it.
+
+        `key_policy` is the key policy of the middleware, if any.
+        """
+        raise NotImplementedError  # pragma: no cover
+
+
+class FrequencyAdmissionPolicy(AdmissionPolicy):
+    """
+    Only store responses to URLs that were requested at least `min_accesses`
+    times (including the current request) within the last `window` seconds.
+
+    Responses whose body is smaller than `min_size` bytes are always stored, so
+    that only large responses have to prove they are popular. Accesses are
+    tracked for up to `max_tracked` URLs, most recently requested first.
+
+    URLs are normalized as per the key policy of the middleware, so that
+    accesses to URLs sharing a cached response are counted together.
+    """
+
+    def __init__(
+        self,
+        min_accesses: int = 2,
+        *,
+        window: float = 60,
+        min_size: int = 0,
+        max_tracked: int = 10000,
+    ) -> None:
+        self.min_accesses = min_accesses
+        self.window = window
+        self.min_size = min_size
+        self.max_tracked = max_tracked
+        # Start of the current window and number of accesses within it, by URL.
+        self.accesses: typing.MutableMapping[
+            str, typing.Tuple[float, int]
+        ] = OrderedDict()
+
+    def record_access(
+        self, scope: Scope, *, key_policy: typing.Optional[KeyPolicy] = None
+    ) -> None:
+        key = hash_url(scope, key_policy)
+        now = time.time()
+        window_start, count = self.accesses.pop(key, (now, 0))
+        if now - window_start > self.window:
+            window_start, count = now, 0
+        self.accesses[key] = (window_start, count + 1)
+        if len(self.accesses) > self.max_tracked:
+            self.accesses.pop(next(iter(self.accesses)))
+
+    def check(
+        self,
+        scope: Scope,
+        response: "CachedResponse",
+        *,
+        key_policy: typing.Optional[KeyPolicy] = None,
+    ) -> typing.Optional[str]:
+        if len(response.body) < self.min_size:
+            return None
+        _, count = self.accesses.get(hash_url(scope, key_policy), (0.0, 0))
+        return "infrequent" if count < self.min_accesses else None
+
+
+def parse_accept_header(value: bytes) -> typing.List[typing.Tuple[str, float]]:
+    """
+    Parse a header listing values along with their quality, such as
+    `Accept-Encoding: gzip;q=0.8, br`, into a list of `(value, quality)` pairs.
+
+    Values are converted to lowercase, and parameters other than the quality
+    are dropped.
+    """
+    items = []
+    for item in value.decode("latin-1").split(","):
+        token, *params = item.split(";")
+        token = token.strip().lower()
+        if not token:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, param_value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(param_value)
+                except ValueError:
+                    quality = 0.0
+        items.append((token, quality))
+    return items
+
+
+def negotiate(
+    value: bytes,
+    candidates: typing.Sequence[str],
+    match: typing.Callable[[str, str], int],
+) -> typing.Optional[str]:
+    """
+    Return the candidate with the highest quality according to a header value,
+    or `None` if no candidate is acceptable.
+
+    `match(range, candidate)` must return how specific `range` is for `candidate`
+    (or `-1` if it doesn't match), as the quality of a candidate is given by the
+    most specific matching range.
+    """
+    ranges = parse_accept_header(value)
+    best: typing.Optional[str] = None
+    best_quality = 0.0
+    for candidate in candidates:
+        quality = 0.0
+        specificity = -1
+        for range_, range_quality in ranges:
+            range_specificity = match(range_, candidate)
+            if range_specificity > specificity:
+                quality, specificity = range_quality, range_specificity
+        if quality > best_quality:
+            best, best_quality = candidate, quality
+    return best
+
+
+def match_token(range_: str, candidate: str) -> int:
+    if range_ == candidate:
+        return 1
+    return 0 if range_ == "*" else -1
+
+
+def match_language(range_: str, candidate: str) -> int:
+    if range_ == candidate:
+        return 2
+    if candidate.startswith(range_ + "-") or range_.startswith(candidate + "-"):
+        return 1
+    return 0 if range_ == "*" else -1
+
+
+def match_media_type(range_: str, candidate: str) -> int:
+    if range_ == candidate:
+        return 2
+    if range_.endswith("/*") and candidate.startswith(range_[:-1]):
+        return 1
+    return 0 if range_ == "*/*" else -1
+
+
+def compile_patterns(
+    patterns: typing.Sequence[str],
+) -> typing.Optional[typing.Pattern[str]]:
+    """
+    Compile case-sensitive glob patterns into a single regular expression, or
+    return `None` if there are no patterns.
+    """
+    if not patterns:
+        return None
+    return re.compile("|".join(fnmatch.translate(pattern) for pattern in patterns))
+
+
+def normalize_host(host: bytes, scheme: str) -> bytes:
+    """
+    Return a host in lowercase, without a trailing dot nor the default port
+    of the given scheme.
+    """
+    name, sep, port = host.lower().rpartition(b":")
+    # NOTE: IPv6 addresses contain colons, but are enclosed in brackets.
+    if not sep or not port.isdigit():
+        return host.lower().rstrip(b".")
+    name = name.rstrip(b".")
+    if int(port) == DEFAULT_PORTS.get(scheme):
+        return name
+    return name + b":" + port
@@ -0,0 +1,157 @@
+import math
+import time
+import typing
+
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from .compression import accepts_encoding, get_codec
+
+RawHeaders = typing.List[typing.Tuple[bytes, bytes]]
+
+# Headers sent along with a '304 Not Modified' response (see RFC 7232, section 4.1).
+NOT_MODIFIED_HEADERS = {
+    b"cache-control",
+    b"content-location",
+    b"date",
+    b"etag",
+    b"expires",
+    b"last-modified",
+    b"vary",
+}
+
+# Size of body chunks sent when replaying cached responses, in bytes.
+CHUNK_SIZE = 64 * 1024
+
+
+class CachedResponse(typing.NamedTuple):
+    """
+    A response retrieved from the cache, along with its freshness information.
+
+    Cached responses are ASGI applications that replay the original response.
+
+    If the body was compressed before being stored, `encoding` is the content
+    coding it is compressed with. (Headers still describe the original response.)
+    """
+
+    status_code: int
+    headers: RawHeaders
+    body: bytes
+    fresh_until: float = math.inf
+    stale_while_revalidate: int = 0
+    stale_if_error: int = 0
+    encoding: typing.Optional[str] = None
+
+    def get_staleness(self) -> float:
+        """
+        Return for how many seconds the response has been stale.
+
+        A negative or zero value means the response is still fresh.
+        """
+        return time.time() - self.fresh_until
+
+    def get_max_staleness(self) -> int:
+        """Return for how many seconds the response may be served stale."""
+        return max(self.stale_while_revalidate, self.stale_if_error)
+
+    def get_expiry(self) -> float:
+        """Return the timestamp after which the response can't be served anymore."""
+        return self.fresh_until + self.get_max_staleness()
+
+    def to_not_modified(self) -> "CachedResponse":
+        """Build a '304 Not Modified' response out of this cached response."""
+        return self._replace(
+            status_code=304,
+            headers=[
+                (key, value)
+                for key, value in self.headers
+                if key.lower() in NOT_MODIFIED_HEADERS
+            ],
+            body=b"",
+        )
+
+    def decode(self) -> "CachedResponse":
+        """Return this response with its body decompressed, if needed."""
+        if self.encoding is None:
+            return self
+        codec = get_codec(self.encoding)
+        assert codec is not None, f"Unsupported encoding: {self.encoding}"
+        return self._replace(body=codec.decompress(self.body), encoding=None)
+
+    def to_response(self) -> Response:
+        """Build a Starlette response out of this cached response."""
+        response = Response(content=self.decode().body, status_code=self.status_code)
+        response.raw_headers = list(self.headers)
+        return response
+
+    def negotiate(self, scope: Scope) -> typing.Tuple[RawHeaders, bytes]:
+        """
+        Return the headers and body to send in response to a request.
+
+        A compressed body is sent as-is if the client accepts its encoding, and
+        decompressed otherwise.
+        """
+        if self.encoding is None:
+            # NOTE: downstream middleware may mutate headers in place.
+            return list(self.headers), self.body
+
+        accepted = accepts_encoding(scope["headers"], self.encoding)
+        body = self.body if accepted or not self.body else self.decode().body
+
+        headers = []
+        has_vary = False
+        for key, value in self.headers:
+            lower_key = key.lower()
+            if lower_key == b"vary":
+                has_vary = True
+                value = add_vary(value, b"Accept-Encoding")
+            elif accepted and lower_key == b"content-length":
+                value = str(len(body)).encode("latin-1")
+            elif accepted and lower_key == b"etag" and not value.startswith(b"W/"):
+                # The compressed body is a different representation.
+                value = b"W/" + value
+            headers.append((key, value))
+
+        # Other clients may get another representation.
+        if not has_vary:
+            headers.append((b"vary", b"Accept-Encoding"))
+        if accepted and self.status_code != 304:
+            headers.append((b"content-encoding", self.encoding.encode("latin-1")))
+        return headers, body
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        headers, body = self.negotiate(scope)
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": headers,
+            }
+        )
+        # Large bodies (e.g. of streaming responses) are sent in chunks.
+        for start in range(0, max(len(body), 1), CHUNK_SIZE):
+            end = start + CHUNK_SIZE
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": body[start:end],
+                    "more_body": end < len(body),
+                }
+            )
+
+
+def add_vary_header(headers: RawHeaders, name: bytes) -> RawHeaders:
+    """Return a copy of raw headers, with a header name added to the `Vary` header."""
+    for index, (key, value) in enumerate(headers):
+        if key.lower() == b"vary":
+            vary = (key, add_vary(value, name))
+            return [*headers[:index], vary, *headers[index + 1 :]]
+    return [*headers, (b"vary", name)]
+
+
+def add_vary(value: bytes, name: bytes) -> bytes:
+    """Add a header name to the value of a `Vary` header, unless listed already."""
+    names = {item.strip().lower() for item in value.split(b",")}
+    if b"*" in names or name.lower() in names:
+        return value
+    return value + b", " + name if value.strip() else name
@@ -0,0 +1,203 @@
+"""
+Serializers convert cached responses to and from values that can be stored
+in the cache.
+
+(Note that `async-caches` dumps values to JSON before storing them, so serialized
+responses must be JSON-serializable.)
+"""
+
+import base64
+import binascii
+import math
+import struct
+import typing
+
+from .compression import DEFAULT_MIN_SIZE, Codec, get_codec, is_compressible
+from .responses import CachedResponse
+from .utils.misc import bytes_to_json_string, json_string_to_bytes
+
+
+class Serializer:
+    """
+    Base class for response serializers.
+    """
+
+    def dumps(self, response: CachedResponse) -> typing.Any:
+        """Convert a response to a JSON-serializable value."""
+        raise NotImplementedError  # pragma: no cover
+
+    def loads(self, value: typing.Any) -> typing.Optional[CachedResponse]:
+        """
+        Convert a previously-serialized value back into a response.
+
+        Return `None` if the value cannot be read (e.g. because it was stored
+        in an unknown format), in which case it is treated as a cache miss.
+        """
+        raise NotImplementedError  # pragma: no cover
+
+
+class JSONSerializer(Serializer):
+    """
+    Store responses as JSON objects, with a base64-encoded body.
+
+    This is the format used by earlier versions of `asgi-caches`.
+    """
+
+    def dumps(self, response: CachedResponse) -> dict:
+        response = response.decode()
+        return {
+            "content": bytes_to_json_string(response.body),
+            "status_code": response.status_code,
+            "headers": [
+                [key.decode("latin-1"), value.decode("latin-1")]
+                for key, value in response.headers
+            ],
+            "fresh_until": response.fresh_until,
+            "stale_while_revalidate": response.stale_while_revalidate,
+            "stale_if_error": response.stale_if_error,
+        }
+
+    def loads(self, value: typing.Any) -> typing.Optional[CachedResponse]:
+        if not isinstance(value, dict):
+            return None
+
+        try:
+            headers = value["headers"]
+            if isinstance(headers, dict):
+                # Earlier versions stored headers as a mapping.
+                headers = headers.items()
+
+            return CachedResponse(
+                status_code=value["status_code"],
+                headers=[
+                    (name.encode("latin-1"), header.encode("latin-1"))
+                    for name, header in headers
+                ],
+                body=json_string_to_bytes(value["content"]),
+                # NOTE: earlier versions didn't store freshness information.
+                fresh_until=value.get("fresh_until", math.inf),
+                stale_while_revalidate=value.get("stale_while_revalidate", 0),
+                stale_if_error=value.get("stale_if_error", 0),
+            )
+        except (KeyError, ValueError, TypeError, AttributeError):
+            # Corrupted value.
+            return None
+
+
+class BinarySerializer(Serializer):
+    """
+    Store responses in a compact binary format: a fixed-size block of metadata,
+    followed by length-prefixed raw headers, followed by the raw body.
+
+    As cached values must be JSON-serializable, the binary data is base64-encoded
+    into a string tagged with the version of the format. Values stored in the
+    JSON format can still be read.
+
+    If a `codec` is given (e.g. `GzipCodec()`), bodies of at least `min_size`
+    bytes are compressed, unless they are compressed already or the response
+    has `Cache-Control: no-transform`. Compressed values are tagged with their
+    content coding, so they can be read whatever the `codec` of the reader.
+    """
+
+    prefix = "ac1:"
+    compressed_prefix = "ac2:"
+    # Status code, freshness deadline, stale-while-revalidate, stale-if-error,
+    # number of headers.
+    metadata = struct.Struct("!HdIII")
+    # Header name length, header value length.
+    header = struct.Struct("!II")
+
+    def __init__(
+        self, codec: typing.Optional[Codec] = None, min_size: int = DEFAULT_MIN_SIZE
+    ) -> None:
+        self.json_serializer = JSONSerializer()
+        self.codec = codec
+        self.min_size = min_size
+
+    def compress(self, response: CachedResponse) -> CachedResponse:
+        """Return a response with its body compressed, if worth it."""
+        if (
+            self.codec is None
+            or response.encoding is not None
+            or len(response.body) < self.min_size
+            or not is_compressible(response.headers)
+        ):
+            return response
+        body = self.codec.compress(response.body)
+        if len(body) >= len(response.body):
+            return response
+        return response._replace(body=body, encoding=self.codec.name)
+
+    def dumps(self, response: CachedResponse) -> str:
+        response = self.compress(response)
+        parts = [
+            self.metadata.pack(
+                response.status_code,
+                response.fresh_until,
+                response.stale_while_revalidate,
+                response.stale_if_error,
+                len(response.headers),
+            )
+        ]
+        for key, value in response.headers:
+            parts += (self.header.pack(len(key), len(value)), key, value)
+        parts.append(response.body)
+        data = base64.b64encode(b"".join(parts)).decode("ascii")
+        if response.encoding is None:
+            return self.prefix + data
+        return f"{self.compressed_prefix}{response.encoding}:{data}"
+
+    def loads(self, value: typing.Any) -> typing.Optional[CachedResponse]:
+        if isinstance(value, dict):
+            return self.json_serializer.loads(value)
+
+        if not isinstance(value, str):
+            return None
+
+        encoding: typing.Optional[str] = None
+        if value.startswith(self.prefix):
+            value = value[len(self.prefix) :]
+        elif value.startswith(self.compressed_prefix):
+            encoding, _, value = value[len(self.compressed_prefix) :].partition(":")
+            if get_codec(encoding) is None:
+                return None
+        else:
+            return None
+
+        try:
+            return self.unpack(base64.b64decode(value), encoding)
+        except (binascii.Error, struct.error):
+            # Corrupted or truncated value.
+            return None
+
+    def unpack(self, data: bytes, encoding: typing.Optional[str]) -> CachedResponse:
+        (
+            status_code,
+            fresh_until,
+            stale_while_revalidate,
+            stale_if_error,
+            num_headers,
+        ) = self.metadata.unpack_from(data)
+        offset = self.metadata.size
+
+        headers = []
+        for _ in range(num_headers):
+            key_length, value_length = self.header.unpack_from(data, offset)
+            offset += self.header.size
+            key = data[offset : offset + key_length]
+            offset += key_length
+            headers.append((key, data[offset : offset + value_length]))
+            offset += value_length
+
+        return CachedResponse(
+            status_code=status_code,
+            headers=headers,
+            body=data[offset:],
+            fresh_until=fresh_until,
+            stale_while_revalidate=stale_while_revalidate,
+            stale_if_error=stale_if_error,
+            encoding=encoding,
+        )
+
+
+DEFAULT_SERIALIZER = BinarySerializer()
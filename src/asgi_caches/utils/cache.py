@@ -9,19 +9,31 @@ defined in this module:
 * `get_from_cache()` retrieves and uses this cache key for a new `request`.
 """
 
+import base64
 import hashlib
+import math
 import time
 import typing
+import weakref
+from collections import OrderedDict
 from urllib.request import parse_http_list
 
 from caches import Cache
-from starlette.datastructures import MutableHeaders
+from starlette.datastructures import URL, MutableHeaders
 from starlette.requests import Request
 from starlette.responses import Response
+from starlette.types import Scope
 
+from ..compression import Codec, is_compressible, select_codec
 from ..exceptions import RequestNotCachable, ResponseNotCachable
-from .logging import get_logger
-from .misc import bytes_to_json_string, http_date, json_string_to_bytes
+from ..invalidation import get_tags, index_cached_response
+from ..local import LocalCache
+from ..policies import KeyPolicy
+from ..responses import CachedResponse, RawHeaders, add_vary_header
+from ..serializers import DEFAULT_SERIALIZER, Serializer
+from .keys import hash_header_values, hash_url
+from .logging import TRACE_LOG_LEVEL, get_logger
+from .misc import http_date, parse_http_date
 
 logger = get_logger(__name__)
 
@@ -30,8 +42,28 @@ CACHABLE_METHODS = frozenset(("GET", "HEAD"))
 CACHABLE_STATUS_CODES = frozenset((200, 304))
 ONE_YEAR = 60 * 60 * 24 * 365
 
-
-async def store_in_cache(response: Response, *, request: Request, cache: Cache) -> None:
+# Varying headers last seen in each cache for each URL, along with their expiry.
+# These are used to fetch cached responses along with varying headers in a single
+# round trip, and to avoid storing varying headers again if they haven't changed.
+MAX_VARYING_HEADERS_HINTS = 1024
+VaryingHeadersHints = typing.MutableMapping[str, typing.Tuple[typing.List[str], float]]
+_varying_headers_hints: "weakref.WeakKeyDictionary[Cache, VaryingHeadersHints]" = (
+    weakref.WeakKeyDictionary()
+)
+# Varying headers are kept for longer than responses, so that they don't need to be
+# stored again when responses are refreshed.
+VARYING_HEADERS_TTL_FACTOR = 4
+
+
+async def store_in_cache(
+    response: Response,
+    *,
+    request: Request,
+    cache: Cache,
+    serializer: Serializer = DEFAULT_SERIALIZER,
+    cachable_status_codes: typing.Collection[int] = CACHABLE_STATUS_CODES,
+    status_ttls: typing.Optional[typing.Mapping[int, int]] = None,
+) -> None:
     """
     Given a response and a request, store the response in the cache for reuse.
 
@@ -43,225 +75,778 @@ async def store_in_cache(response: Response, *, request: Request, cache: Cache)
       they can be retrieved (and checked against) for future requests (without having
       to build and read an uncached response first).
 
+    Caching headers (`Expires`, `Cache-Control`) are added to the response.
+
     [^1]: The "Vary" header lists which headers should be taken into account in cache
     systems, because they may result in the server sending in a different response.
     For example, gzip compression requires to add "Accept-Encoding" to "Vary" because
     sending "Accept-Encoding: gzip", and "Accept-Encoding: identity" will result in
     different responses.
     """
-    if response.status_code not in CACHABLE_STATUS_CODES:
-        logger.trace("response_not_cachable reason=status_code")
-        raise ResponseNotCachable(response)
+    try:
+        cached_response = prepare_cached_response(
+            response.status_code,
+            list(response.raw_headers),
+            request=request,
+            cache=cache,
+            cachable_status_codes=cachable_status_codes,
+            status_ttls=status_ttls,
+        )
+    except ResponseNotCachable as exc:
+        exc.response = response
+        raise
+
+    headers = MutableHeaders(raw=list(cached_response.headers))
+    if response.status_code == 200 and "ETag" not in headers:
+        # We know the body already, so let clients know about the ETag too.
+        headers["ETag"] = generate_etag(response.body)
+        cached_response = cached_response._replace(headers=headers.raw)
+
+    response.raw_headers = list(cached_response.headers)
+    await store_cached_response(
+        cached_response._replace(body=response.body),
+        request=request,
+        cache=cache,
+        serializer=serializer,
+    )
 
-    if not request.cookies and "Set-Cookie" in response.headers:
-        logger.trace("response_not_cachable reason=cookies_for_cookieless_request")
-        raise ResponseNotCachable(response)
+
+def prepare_cached_response(
+    status_code: int,
+    headers: RawHeaders,
+    *,
+    request: Request,
+    cache: Cache,
+    cachable_status_codes: typing.Collection[int] = CACHABLE_STATUS_CODES,
+    status_ttls: typing.Optional[typing.Mapping[int, int]] = None,
+) -> CachedResponse:
+    """
+    Given the status code and raw headers of a response, check that the response can
+    be cached, and return a body-less cached response with caching headers applied.
+
+    Only responses with one of the `cachable_status_codes`, or with a status code
+    listed in `status_ttls`, can be cached. `status_ttls` maps status codes to the
+    maximum lifetime of responses with this status code, in seconds (e.g. so that
+    '404 Not Found' responses are only cached for a short time).
+
+    The body should then be added before passing it to `store_cached_response()`.
+
+    Raises `ResponseNotCachable` if the response cannot be cached.
+    """
+    cached_response = CachedResponse(status_code=status_code, headers=headers, body=b"")
+
+    status_ttl = None if status_ttls is None else status_ttls.get(status_code)
+    if status_code not in cachable_status_codes and status_ttl is None:
+        logger.trace_event("response_not_cachable", reason="status_code")
+        raise ResponseNotCachable(cached_response, reason="status_code")
+
+    response_headers = MutableHeaders(raw=headers)
+
+    if not request.cookies and "Set-Cookie" in response_headers:
+        logger.trace_event(
+            "response_not_cachable", reason="cookies_for_cookieless_request"
+        )
+        raise ResponseNotCachable(
+            cached_response, reason="cookies_for_cookieless_request"
+        )
+
+    # NOTE: we are a shared cache, so we must not store private responses.
+    cache_control = parse_cache_control(response_headers.get("Cache-Control", ""))
+    if "no-store" in cache_control or "private" in cache_control:
+        logger.trace_event("response_not_cachable", reason="cache_control")
+        raise ResponseNotCachable(cached_response, reason="cache_control")
 
     if cache.ttl == 0:
-        logger.trace("response_not_cachable reason=zero_ttl")
-        raise ResponseNotCachable(response)
-
-    if cache.ttl is None:
-        # From section 14.12 of RFC2616:
-        # "HTTP/1.1 servers SHOULD NOT send Expires dates more than
-        # one year in the future."
-        max_age = ONE_YEAR
-        logger.trace(f"max_out_ttl value={max_age!r}")
+        logger.trace_event("response_not_cachable", reason="zero_ttl")
+        raise ResponseNotCachable(cached_response, reason="zero_ttl")
+
+    max_age = get_freshness_lifetime(response_headers, cache_control)
+    if max_age is None:
+        if cache.ttl is None:
+            # From section 14.12 of RFC2616:
+            # "HTTP/1.1 servers SHOULD NOT send Expires dates more than
+            # one year in the future."
+            max_age = ONE_YEAR
+            logger.trace_event("max_out_ttl", value=max_age)
+        else:
+            max_age = cache.ttl
     else:
-        max_age = cache.ttl
+        max_age = min(max_age, ONE_YEAR)
+
+    if status_ttl is not None:
+        max_age = min(max_age, status_ttl)
+
+    if max_age == 0:
+        logger.trace_event("response_not_cachable", reason="zero_max_age")
+        raise ResponseNotCachable(cached_response, reason="zero_max_age")
+
+    logger.debug_event("store_in_cache", max_age=max_age)
+
+    cache_headers = get_cache_response_headers(response_headers, max_age=max_age)
+    logger.trace_event("patch_response_headers", headers=cache_headers)
+    response_headers.update(cache_headers)
+
+    # Responses may opt into being served stale (see RFC 5861), in which case
+    # they must be kept in the cache for longer than their freshness lifetime.
+    return cached_response._replace(
+        headers=response_headers.raw,
+        fresh_until=time.time() + max_age,
+        stale_while_revalidate=get_seconds_directive(
+            cache_control, "stale-while-revalidate"
+        ),
+        stale_if_error=get_seconds_directive(cache_control, "stale-if-error"),
+    )
+
 
-    logger.debug(f"store_in_cache max_age={max_age!r}")
+async def store_cached_response(
+    cached_response: CachedResponse,
+    *,
+    request: Request,
+    cache: Cache,
+    serializer: Serializer = DEFAULT_SERIALIZER,
+    local_cache: typing.Optional[LocalCache] = None,
+    tags: typing.Sequence[str] = (),
+    index_paths: bool = False,
+    key_policy: typing.Optional[KeyPolicy] = None,
+) -> None:
+    """
+    Store a response previously built by `prepare_cached_response()` in the cache,
+    and in the `local_cache` if given. Cache keys are built according to the
+    `key_policy`, if given.
 
-    cache_headers = get_cache_response_headers(response, max_age=max_age)
-    logger.trace(f"patch_response_headers headers={cache_headers!r}")
-    response.headers.update(cache_headers)
+    The response is registered for invalidation under the given `tags` and those
+    declared in its `Cache-Tag` header, as well as by path if `index_paths` is true.
+    """
+    if cached_response.status_code == 200:
+        headers = MutableHeaders(raw=list(cached_response.headers))
+        if "ETag" not in headers:
+            # Allow answering conditional requests from the cache.
+            headers["ETag"] = generate_etag(cached_response.body)
+            cached_response = cached_response._replace(headers=headers.raw)
+
+    # Keep the response in the cache for as long as it may be served.
+    ttl: typing.Optional[int] = None
+    if not math.isinf(cached_response.fresh_until):
+        # NOTE: the response may have become stale while we were receiving its body.
+        max_age = math.ceil(cached_response.fresh_until - time.time())
+        ttl = max(max_age + cached_response.get_max_staleness(), 1)
+
+    cache_key = await learn_cache_key(
+        request,
+        cached_response,
+        cache=cache,
+        ttl=ttl,
+        local_cache=local_cache,
+        key_policy=key_policy,
+    )
+    logger.trace_event("learnt_cache_key", cache_key=cache_key)
+    serialized_response = serializer.dumps(cached_response)
+    logger.trace_event(
+        "store_response_in_cache",
+        key=cache_key,
+        status_code=cached_response.status_code,
+        size=len(cached_response.body),
+    )
+    await cache.set(key=cache_key, value=serialized_response, ttl=ttl)
+    if local_cache is not None:
+        local_cache.set(
+            cache.make_key(cache_key),
+            cached_response,
+            expires_at=cached_response.get_expiry(),
+        )
 
-    cache_key = await learn_cache_key(request, response, cache=cache)
-    logger.trace(f"learnt_cache_key cache_key={cache_key!r}")
-    serialized_response = serialize_response(response)
-    logger.trace(
-        f"store_response_in_cache key={cache_key!r} value={serialized_response!r}"
+    await index_cached_response(
+        cache_key,
+        cached_response,
+        request=request,
+        cache=cache,
+        tags=[*tags, *get_tags(cached_response)],
+        index_paths=index_paths,
     )
-    await cache.set(key=cache_key, value=serialized_response)
 
 
 async def get_from_cache(
-    request: Request, *, cache: Cache
+    request: Request, *, cache: Cache, serializer: Serializer = DEFAULT_SERIALIZER
 ) -> typing.Optional[Response]:
     """
-    Given a GET or HEAD request, retrieve a cached response based on the cache key
-    associated to the request.
+    Given a GET or HEAD request, retrieve a fresh cached response based on the cache
+    key associated to the request.
 
-    If no cache key is present yet, or if there is no cached response at
+    If no cache key is present yet, or if there is no fresh cached response at
     that key, return `None`.
 
     A `None` return value indicates that the response for this
     request can (and should) be added to the cache once computed.
     """
-    logger.trace(
-        f"get_from_cache "
-        f"request.url={str(request.url)!r} "
-        f"request.method={request.method!r}"
+    cached_response = await get_cached_response(
+        request, cache=cache, serializer=serializer
     )
-    if request.method not in CACHABLE_METHODS:
-        logger.trace("request_not_cachable reason=method")
-        raise RequestNotCachable(request)
-
-    logger.trace("lookup_cached_response method='GET'")
-    # Try to retrieve the cached GET response (even if this is a HEAD request).
-    cache_key = await get_cache_key(request, method="GET", cache=cache)
-    if cache_key is None:
-        logger.trace("cache_key found=False")
-        return None
-    logger.trace(f"cache_key found=True cache_key={cache_key!r}")
-    serialized_response: typing.Optional[dict] = await cache.get(cache_key)
-
-    # If not present, fallback to look for a cached HEAD response.
-    if serialized_response is None:
-        logger.trace("lookup_cached_response method='HEAD'")
-        cache_key = await get_cache_key(request, method="HEAD", cache=cache)
-        assert cache_key is not None
-        logger.trace(f"cache_key found=True cache_key={cache_key!r}")
-        serialized_response = await cache.get(cache_key)
-
-    if serialized_response is None:
-        logger.trace("cached_response found=False")
+    if cached_response is None or cached_response.get_staleness() > 0:
         return None
+    return cached_response.to_response()
 
-    logger.trace(
-        f"cached_response found=True key={cache_key!r} value={serialized_response!r}"
-    )
-    response = deserialize_response(serialized_response)
-    return response
 
+class CacheLookup(typing.NamedTuple):
+    """
+    The outcome of looking up a response in the cache: the cached `response`
+    (if any), the key it is stored at, and the stored `encoded_bodies` of the
+    response fetched along with it, by cache key.
+    """
 
-def serialize_response(response: Response) -> dict:
-    """Convert a response to JSON format.
+    response: typing.Optional[CachedResponse] = None
+    cache_key: typing.Optional[str] = None
+    encoded_bodies: typing.Mapping[str, typing.Any] = {}
 
-    (This is required as `async-caches` dumps values to JSON before storing them
-    in the cache system.)
+
+async def get_cached_response(
+    request: Request,
+    *,
+    cache: Cache,
+    serializer: Serializer = DEFAULT_SERIALIZER,
+    local_cache: typing.Optional[LocalCache] = None,
+    key_policy: typing.Optional[KeyPolicy] = None,
+) -> typing.Optional[CachedResponse]:
     """
-    return {
-        "content": bytes_to_json_string(response.body),
-        "status_code": response.status_code,
-        "headers": dict(response.headers),
-    }
+    Given a GET or HEAD request, retrieve a cached response based on the cache key
+    associated to the request (according to the `key_policy`, if given).
 
+    Contrary to `get_from_cache()`, the returned response may be stale, provided
+    it allows being served stale via `stale-while-revalidate` or `stale-if-error`.
 
-def deserialize_response(serialized_response: dict) -> Response:
+    If a `local_cache` is given, it is looked up first, and populated with
+    responses retrieved from the cache.
+    """
+    lookup = await lookup_cached_response(
+        request.scope,
+        cache=cache,
+        serializer=serializer,
+        local_cache=local_cache,
+        key_policy=key_policy,
+    )
+    return lookup.response
+
+
+async def lookup_cached_response(
+    scope: Scope,
+    *,
+    cache: Cache,
+    serializer: Serializer = DEFAULT_SERIALIZER,
+    local_cache: typing.Optional[LocalCache] = None,
+    key_policy: typing.Optional[KeyPolicy] = None,
+    codecs: typing.Sequence[Codec] = (),
+) -> CacheLookup:
     """
-    Given the JSON representation of a response, re-build the
-    original response object.
+    Same as `get_cached_response()`, but given the ASGI scope of the request, and
+    also return the key of the cached response.
+
+    If `codecs` are given, the body of the response compressed with the encoding
+    the client prefers is fetched in the same round trip, if stored already
+    (see `get_encoded_response()`).
     """
-    return Response(
-        content=json_string_to_bytes(serialized_response["content"]),
-        status_code=serialized_response["status_code"],
-        headers=serialized_response["headers"],
+    if logger.isEnabledFor(TRACE_LOG_LEVEL):
+        url = str(URL(scope=scope))
+        logger.trace_event(
+            "get_from_cache", **{"request.url": url, "request.method": scope["method"]}
+        )
+    if scope["method"] not in CACHABLE_METHODS:
+        logger.trace_event("request_not_cachable", reason="method")
+        raise RequestNotCachable(Request(scope))
+
+    # Fetch varying headers along with the cached GET and HEAD responses in a single
+    # round trip. This requires guessing varying headers, which we do based on what
+    # we've seen previously for this URL (most responses don't vary at all).
+    # (Try to retrieve the cached GET response first, even if this is a HEAD request.)
+    # NOTE: the URL is hashed only once, as all keys are derived from it.
+    url_hash = hash_url(scope, key_policy)
+    varying_headers_cache_key = _make_varying_headers_cache_key(url_hash, cache)
+
+    if local_cache is not None:
+        lookup = _get_local_cached_response(
+            scope,
+            url_hash,
+            varying_headers_cache_key,
+            cache=cache,
+            local_cache=local_cache,
+            key_policy=key_policy,
+        )
+        if lookup.response is not None:
+            return lookup
+
+    # Most cached responses are stored uncompressed, so guess the encoding the
+    # client prefers, in order to fetch the compressed body along with them.
+    codec = select_codec(codecs, scope["headers"]) if codecs else None
+
+    hints = _get_varying_headers_hints(cache)
+    no_hint: typing.Tuple[typing.List[str], float] = ([], 0.0)
+    guessed_varying_headers, _ = hints.get(varying_headers_cache_key, no_hint)
+    cache_keys = _make_cache_keys(
+        scope, url_hash, guessed_varying_headers, cache, key_policy
+    )
+    logger.trace_event(
+        "lookup_cached_response",
+        varying_headers_cache_key=varying_headers_cache_key,
+        cache_keys=cache_keys,
+    )
+    values = await cache.get_many(
+        [varying_headers_cache_key, *cache_keys, *_make_encoded_keys(cache_keys, codec)]
+    )
+
+    metadata = values[varying_headers_cache_key]
+    if metadata is None:
+        logger.trace_event("varying_headers", found=False)
+        hints.pop(varying_headers_cache_key, None)
+        return CacheLookup()
+    varying_headers, expires_at = load_varying_headers(metadata)
+    logger.trace_event("varying_headers", found=True, headers=varying_headers)
+    _remember_varying_headers(
+        hints, varying_headers_cache_key, varying_headers, expires_at
+    )
+
+    if varying_headers != guessed_varying_headers:
+        # Wrong guess: we need another round trip.
+        cache_keys = _make_cache_keys(
+            scope, url_hash, varying_headers, cache, key_policy
+        )
+        logger.trace_event("lookup_cached_response", cache_keys=cache_keys)
+        values = await cache.get_many(
+            [*cache_keys, *_make_encoded_keys(cache_keys, codec)]
+        )
+
+    # If not present, fallback to the cached HEAD response.
+    cache_key = next((key for key in cache_keys if values[key] is not None), None)
+    if cache_key is None:
+        logger.trace_event("cached_response", found=False)
+        return CacheLookup()
+
+    cached_response = serializer.loads(values[cache_key])
+    if cached_response is None:
+        logger.trace_event("cached_response", found=True, key=cache_key, readable=False)
+        return CacheLookup()
+
+    logger.trace_event(
+        "cached_response",
+        found=True,
+        key=cache_key,
+        status_code=cached_response.status_code,
+        size=len(cached_response.body),
     )
 
+    staleness = cached_response.get_staleness()
+    if staleness > cached_response.get_max_staleness():
+        logger.trace_event("cached_response", expired=True, staleness=staleness)
+        return CacheLookup()
+
+    if local_cache is not None:
+        expires_at = cached_response.get_expiry()
+        local_cache.set(
+            cache.make_key(varying_headers_cache_key),
+            varying_headers,
+            expires_at=expires_at,
+        )
+        local_cache.set(
+            cache.make_key(cache_key), cached_response, expires_at=expires_at
+        )
+
+    encoded_bodies = {
+        key: values[key]
+        for key in _make_encoded_keys([cache_key], codec)
+        if values.get(key) is not None
+    }
+    return CacheLookup(cached_response, cache_key, encoded_bodies)
+
+
+async def get_encoded_response(
+    scope: Scope,
+    cached_response: CachedResponse,
+    codecs: typing.Sequence[Codec],
+    *,
+    cache: Cache,
+    cache_key: str,
+    min_size: int = 0,
+    local_cache: typing.Optional[LocalCache] = None,
+    encoded_bodies: typing.Optional[typing.Mapping[str, typing.Any]] = None,
+) -> CachedResponse:
+    """
+    Return a cached response stored at `cache_key` with its body compressed using
+    the encoding the client prefers among the given `codecs`, as per the request
+    headers of the ASGI `scope`.
+
+    Compressed bodies are stored in the cache (and in the `local_cache`, if given)
+    the first time they are requested, so that each response is compressed at
+    most once per encoding. They are stored at a key derived from `cache_key`, along
+    with the `ETag` of the response so that they aren't served once the response
+    is replaced. Stored bodies fetched already (see `lookup_cached_response()`) may
+    be given as `encoded_bodies`, to save a round trip.
+
+    The response is returned as-is if its body is smaller than `min_size` bytes
+    or may not be compressed, or (with `Accept-Encoding` added to its `Vary` header)
+    if the client doesn't accept any of these encodings.
+    """
+    etag = next(
+        (value for key, value in cached_response.headers if key.lower() == b"etag"),
+        None,
+    )
+    if (
+        cached_response.status_code != 200
+        or etag is None
+        or (cached_response.encoding is None and len(cached_response.body) < min_size)
+        or not is_compressible(cached_response.headers)
+    ):
+        return cached_response
+
+    codec = select_codec(codecs, scope["headers"], cached_response.encoding)
+    if codec is None:
+        # Other clients may get a compressed body.
+        headers = add_vary_header(cached_response.headers, b"Accept-Encoding")
+        return cached_response._replace(headers=headers)
+    if codec.name == cached_response.encoding:
+        return cached_response
+
+    encoded_key = _make_encoded_body_cache_key(codec.name, cache_key)
+
+    if local_cache is not None:
+        value = local_cache.get(cache.make_key(encoded_key))
+        if value is not None and value[0] == etag:
+            logger.trace_event("local_encoded_body", found=True, key=encoded_key)
+            return cached_response._replace(body=value[1], encoding=codec.name)
+
+    if encoded_bodies is not None and encoded_key in encoded_bodies:
+        value = encoded_bodies[encoded_key]
+    else:
+        value = await cache.get(encoded_key)
 
-async def learn_cache_key(request: Request, response: Response, *, cache: Cache) -> str:
+    etag_value = etag.decode("latin-1")
+    if value is not None and value["etag"] == etag_value:
+        logger.trace_event("encoded_body", found=True, key=encoded_key)
+        body = base64.b64decode(value["body"])
+    else:
+        body = codec.compress(cached_response.decode().body)
+        logger.trace_event("store_encoded_body", key=encoded_key, size=len(body))
+        ttl: typing.Optional[int] = None
+        expires_at = cached_response.get_expiry()
+        if not math.isinf(expires_at):
+            ttl = max(math.ceil(expires_at - time.time()), 1)
+        value = {"etag": etag_value, "body": base64.b64encode(body).decode("ascii")}
+        await cache.set(encoded_key, value, ttl=ttl)
+
+    if local_cache is not None:
+        # NOTE: only keep the body, as headers may change when the response is
+        # refreshed without its body changing.
+        local_cache.set(
+            cache.make_key(encoded_key),
+            [etag, body],
+            expires_at=cached_response.get_expiry(),
+        )
+    return cached_response._replace(body=body, encoding=codec.name)
+
+
+def _get_local_cached_response(
+    scope: Scope,
+    url_hash: str,
+    varying_headers_cache_key: str,
+    *,
+    cache: Cache,
+    local_cache: LocalCache,
+    key_policy: typing.Optional[KeyPolicy] = None,
+) -> CacheLookup:
+    varying_headers = local_cache.get(cache.make_key(varying_headers_cache_key))
+    if varying_headers is None:
+        logger.trace_event("local_varying_headers", found=False)
+        return CacheLookup()
+
+    for cache_key in _make_cache_keys(
+        scope, url_hash, varying_headers, cache, key_policy
+    ):
+        cached_response = local_cache.get(cache.make_key(cache_key))
+        if cached_response is not None:
+            logger.trace_event("local_cached_response", found=True, key=cache_key)
+            return CacheLookup(cached_response, cache_key)
+
+    logger.trace_event("local_cached_response", found=False)
+    return CacheLookup()
+
+
+async def learn_cache_key(
+    request: Request,
+    response: CachedResponse,
+    *,
+    cache: Cache,
+    ttl: typing.Optional[int] = None,
+    local_cache: typing.Optional[LocalCache] = None,
+    key_policy: typing.Optional[KeyPolicy] = None,
+) -> str:
     """
-    Generate a cache key from the requested absolute URL.
+    Generate a cache key from the requested absolute URL, normalized according
+    to the `key_policy` if given.
 
     Varying response headers are stored at another key based from the
-    requested absolute URL.
+    requested absolute URL, for `VARYING_HEADERS_TTL_FACTOR` times the `ttl` of the
+    response (defaults to the cache TTL). They are only stored if they changed, or
+    if they would expire before the response.
     """
-    logger.trace(
-        "learn_cache_key "
-        f"request.method={request.method!r} "
-        f"response.headers.Vary={response.headers.get('Vary')!r}"
+    vary = MutableHeaders(raw=response.headers).get("Vary")
+    logger.trace_event(
+        "learn_cache_key",
+        **{"request.method": request.method, "response.headers.Vary": vary},
+    )
+    varying_headers_cache_key = generate_varying_headers_cache_key(
+        request, cache=cache, key_policy=key_policy
     )
-    varying_headers_cache_key = generate_varying_headers_cache_key(request, cache=cache)
 
     varying_headers: typing.List[str] = []
-    if "Vary" in response.headers:
-        for header in parse_http_list(response.headers["Vary"]):
+    if vary is not None:
+        for header in parse_http_list(vary):
             varying_headers.append(header.lower())
         varying_headers.sort()
 
-    logger.trace(
-        "store_varying_headers "
-        f"cache_key={varying_headers_cache_key!r} headers={varying_headers!r}"
+    hints = _get_varying_headers_hints(cache)
+    known_varying_headers, known_expires_at = hints.get(
+        varying_headers_cache_key, (None, 0.0)
     )
-    await cache.set(key=varying_headers_cache_key, value=varying_headers)
+    if (
+        varying_headers == known_varying_headers
+        and known_expires_at >= response.get_expiry()
+    ):
+        logger.trace_event(
+            "varying_headers_unchanged", cache_key=varying_headers_cache_key
+        )
+    else:
+        metadata_ttl: typing.Optional[int] = None
+        expires_at = math.inf
+        if ttl is not None:
+            metadata_ttl = ttl * VARYING_HEADERS_TTL_FACTOR
+            expires_at = time.time() + metadata_ttl
+        logger.trace_event(
+            "store_varying_headers",
+            cache_key=varying_headers_cache_key,
+            headers=varying_headers,
+        )
+        await cache.set(
+            key=varying_headers_cache_key,
+            value=dump_varying_headers(varying_headers, expires_at),
+            ttl=metadata_ttl,
+        )
+        _remember_varying_headers(
+            hints, varying_headers_cache_key, varying_headers, expires_at
+        )
+
+    if local_cache is not None:
+        local_cache.set(
+            cache.make_key(varying_headers_cache_key),
+            varying_headers,
+            expires_at=response.get_expiry(),
+        )
 
     return generate_cache_key(
-        request, method=request.method, varying_headers=varying_headers, cache=cache
+        request,
+        method=request.method,
+        varying_headers=varying_headers,
+        cache=cache,
+        key_policy=key_policy,
     )
 
 
+def dump_varying_headers(varying_headers: typing.List[str], expires_at: float) -> dict:
+    """
+    Convert varying headers of a URL, which are stored until `expires_at`,
+    to a JSON-serializable value.
+    """
+    return {
+        "headers": varying_headers,
+        "expires_at": None if math.isinf(expires_at) else expires_at,
+    }
+
+
+def load_varying_headers(value: dict) -> typing.Tuple[typing.List[str], float]:
+    """Convert a value stored by `dump_varying_headers()` back."""
+    expires_at = value["expires_at"]
+    return value["headers"], math.inf if expires_at is None else expires_at
+
+
+def _get_varying_headers_hints(cache: Cache) -> VaryingHeadersHints:
+    hints = _varying_headers_hints.get(cache)
+    if hints is None:
+        hints = _varying_headers_hints[cache] = OrderedDict()
+    return hints
+
+
+def _remember_varying_headers(
+    hints: VaryingHeadersHints,
+    varying_headers_cache_key: str,
+    varying_headers: typing.List[str],
+    expires_at: float,
+) -> None:
+    # Keep hints in least recently seen order.
+    hints.pop(varying_headers_cache_key, None)
+    hints[varying_headers_cache_key] = (varying_headers, expires_at)
+    if len(hints) > MAX_VARYING_HEADERS_HINTS:
+        del hints[next(iter(hints))]
+
+
 async def get_cache_key(
-    request: Request, method: str, cache: Cache
+    request: Request,
+    method: str,
+    cache: Cache,
+    key_policy: typing.Optional[KeyPolicy] = None,
 ) -> typing.Optional[str]:
     """
     Given a request, return the cache key where a cached response should be looked up.
     If this request hasn't been served before, return `None` as there definitely
     won't be any matching cached response.
     """
-    logger.trace(f"get_cache_key request.url={str(request.url)!r} method={method!r}")
-    varying_headers_cache_key = generate_varying_headers_cache_key(request, cache=cache)
-    varying_headers = await cache.get(varying_headers_cache_key)
+    if logger.isEnabledFor(TRACE_LOG_LEVEL):
+        logger.trace_event(
+            "get_cache_key", **{"request.url": str(request.url)}, method=method
+        )
+    varying_headers_cache_key = generate_varying_headers_cache_key(
+        request, cache=cache, key_policy=key_policy
+    )
+    metadata = await cache.get(varying_headers_cache_key)
 
-    if varying_headers is None:
-        logger.trace("varying_headers found=False")
+    if metadata is None:
+        logger.trace_event("varying_headers", found=False)
         return None
-    logger.trace(f"varying_headers found=True headers={varying_headers!r}")
+    varying_headers, _ = load_varying_headers(metadata)
+    logger.trace_event("varying_headers", found=True, headers=varying_headers)
 
     return generate_cache_key(
-        request, method=method, varying_headers=varying_headers, cache=cache,
+        request,
+        method=method,
+        varying_headers=varying_headers,
+        cache=cache,
+        key_policy=key_policy,
     )
 
 
 def generate_cache_key(
-    request: Request, method: str, varying_headers: typing.List[str], cache: Cache,
+    request: Request,
+    method: str,
+    varying_headers: typing.List[str],
+    cache: Cache,
+    key_policy: typing.Optional[KeyPolicy] = None,
 ) -> str:
     """
     Return a cache key generated from the request full URL and varying
     response headers.
 
+    If a `key_policy` is given, the URL and varying headers are normalized according
+    to it, so that equivalent requests share the same key.
+
     Note that the given `method` may be different from that of the request, e.g.
     because we're trying to find a response cached from a previous GET request
     while this one is a HEAD request. (This is OK because web servers will strip content
     from responses to a HEAD request before sending them on the wire.)
     """
     assert method in CACHABLE_METHODS
+    url_hash = hash_url(request.scope, key_policy)
+    headers_hash = hash_header_values(request.scope, varying_headers, key_policy)
+    return _make_cache_key(method, url_hash, headers_hash, cache)
 
-    ctx = hashlib.md5()
-    for header in varying_headers:
-        value = request.headers.get(header)
-        if value is not None:
-            ctx.update(value.encode())
 
-    absolute_url = str(request.url)
-    url = hashlib.md5(absolute_url.encode("ascii"))
+def _make_cache_key(method: str, url_hash: str, headers_hash: str, cache: Cache) -> str:
+    return cache.make_key(f"cache_page.{method}.{url_hash}.{headers_hash}")
 
-    return cache.make_key(f"cache_page.{method}.{url.hexdigest()}.{ctx.hexdigest()}")
 
+def _make_cache_keys(
+    scope: Scope,
+    url_hash: str,
+    varying_headers: typing.List[str],
+    cache: Cache,
+    key_policy: typing.Optional[KeyPolicy],
+) -> typing.List[str]:
+    # Keys of the GET and HEAD responses, in this order.
+    headers_hash = hash_header_values(scope, varying_headers, key_policy)
+    return [
+        _make_cache_key(method, url_hash, headers_hash, cache)
+        for method in ("GET", "HEAD")
+    ]
 
-def generate_varying_headers_cache_key(request: Request, cache: Cache) -> str:
+
+def generate_varying_headers_cache_key(
+    request: Request, cache: Cache, key_policy: typing.Optional[KeyPolicy] = None
+) -> str:
     """
-    Return a cache key generated from the requested absolute URL, suitable for
-    associating varying headers to a requested URL.
+    Return a cache key generated from the requested absolute URL (normalized
+    according to the `key_policy`, if given), suitable for associating varying
+    headers to a requested URL.
     """
-    url = request.url.path
-    url_hash = hashlib.md5(url.encode("ascii"))
-    return cache.make_key(f"varying_headers.{url_hash.hexdigest()}")
+    return _make_varying_headers_cache_key(hash_url(request.scope, key_policy), cache)
+
+
+def _make_varying_headers_cache_key(url_hash: str, cache: Cache) -> str:
+    return cache.make_key(f"varying_headers.{url_hash}")
+
+
+def _make_encoded_body_cache_key(encoding: str, cache_key: str) -> str:
+    return f"encoded_body.{encoding}.{cache_key}"
+
+
+def _make_encoded_keys(
+    cache_keys: typing.List[str], codec: typing.Optional[Codec]
+) -> typing.List[str]:
+    # Keys of bodies compressed with the codec of responses at the given keys.
+    if codec is None:
+        return []
+    return [_make_encoded_body_cache_key(codec.name, key) for key in cache_keys]
+
+
+def generate_etag(body: bytes) -> str:
+    """Return a strong entity tag for a response body."""
+    return f'"{hashlib.md5(body).hexdigest()}"'
+
+
+def is_not_modified(scope: Scope, response: CachedResponse) -> bool:
+    """
+    Return whether a conditional request, given its ASGI scope, can be answered
+    with a '304 Not Modified' response, as per RFC 7232.
+    """
+    # Most requests aren't conditional, so look for conditional headers first.
+    if_none_match: typing.Optional[str] = None
+    if_modified_since: typing.Optional[str] = None
+    for key, value in scope["headers"]:
+        if key == b"if-none-match" and if_none_match is None:
+            if_none_match = value.decode("latin-1")
+        elif key == b"if-modified-since" and if_modified_since is None:
+            if_modified_since = value.decode("latin-1")
+    if if_none_match is None and if_modified_since is None:
+        return False
+
+    headers = MutableHeaders(raw=response.headers)
+
+    if if_none_match is not None:
+        # NOTE: 'If-None-Match' uses the weak comparison function.
+        etag = headers.get("ETag")
+        if etag is None:
+            return False
+        etags = {tag.strip() for tag in if_none_match.split(",")}
+        return "*" in etags or _strip_weak(etag) in {_strip_weak(tag) for tag in etags}
+
+    assert if_modified_since is not None
+    last_modified = headers.get("Last-Modified")
+    if last_modified is None:
+        return False
+    since = parse_http_date(if_modified_since)
+    modified = parse_http_date(last_modified)
+    return since is not None and modified is not None and modified <= since
+
+
+def _strip_weak(etag: str) -> str:
+    return etag[2:] if etag.startswith("W/") else etag
 
 
 def get_cache_response_headers(
-    response: Response, *, max_age: int
+    headers: MutableHeaders, *, max_age: int
 ) -> typing.Dict[str, str]:
     """Return caching-related headers to add to a response."""
     assert max_age >= 0, "Can't have a negative cache max-age"
-    headers = {}
+    cache_headers = {}
 
-    if "Expires" not in response.headers:
-        headers["Expires"] = http_date(time.time() + max_age)
+    if "Expires" not in headers:
+        cache_headers["Expires"] = http_date(time.time() + max_age)
 
-    patch_cache_control(response.headers, max_age=max_age)
+    patch_cache_control(headers, max_age=max_age)
 
-    return headers
+    return cache_headers
 
 
 def patch_cache_control(headers: MutableHeaders, **kwargs: typing.Any) -> None:
@@ -269,14 +854,7 @@ def patch_cache_control(headers: MutableHeaders, **kwargs: typing.Any) -> None:
     Patch headers with an extended version of the initial Cache-Control header by adding
     all keyword arguments to it.
     """
-    cache_control: typing.Dict[str, typing.Any] = {}
-    for field in parse_http_list(headers.get("Cache-Control", "")):
-        try:
-            key, value = field.split("=")
-        except ValueError:
-            cache_control[field] = True
-        else:
-            cache_control[key] = value
+    cache_control = parse_cache_control(headers.get("Cache-Control", ""))
 
     if "max-age" in cache_control and "max_age" in kwargs:
         kwargs["max_age"] = min(int(cache_control["max-age"]), kwargs["max_age"])
@@ -310,3 +888,57 @@ def patch_cache_control(headers: MutableHeaders, **kwargs: typing.Any) -> None:
         headers["Cache-Control"] = patched_cache_control
     else:
         del headers["Cache-Control"]
+
+
+def parse_cache_control(header: str) -> typing.Dict[str, typing.Any]:
+    """
+    Parse the value of a Cache-Control header into a dictionary of directives.
+
+    Directives without a value (e.g. `must-revalidate`) are mapped to `True`.
+    """
+    cache_control: typing.Dict[str, typing.Any] = {}
+    for field in parse_http_list(header):
+        try:
+            key, value = field.split("=")
+        except ValueError:
+            cache_control[field] = True
+        else:
+            cache_control[key] = value
+    return cache_control
+
+
+def get_freshness_lifetime(
+    headers: MutableHeaders, cache_control: typing.Dict[str, typing.Any]
+) -> typing.Optional[int]:
+    """
+    Return the freshness lifetime of a response in a shared cache, as specified
+    by its headers (see RFC 7234, section 4.2.1), or `None` if unspecified.
+    """
+    for directive in ("s-maxage", "max-age"):
+        if directive in cache_control:
+            return get_seconds_directive(cache_control, directive)
+
+    expires = headers.get("Expires")
+    if expires is None:
+        return None
+
+    expires_at = parse_http_date(expires)
+    if expires_at is None:
+        # Invalid dates represent a time in the past (RFC 7234, section 5.3).
+        return 0
+    date = parse_http_date(headers.get("Date", ""))
+    return max(math.floor(expires_at - (time.time() if date is None else date)), 0)
+
+
+def get_seconds_directive(cache_control: typing.Dict[str, typing.Any], key: str) -> int:
+    """
+    Return the number of seconds of a Cache-Control directive such as
+    `stale-if-error=60`, or zero if it is missing or invalid.
+    """
+    value = cache_control.get(key)
+    if value is None or value is True:
+        return 0
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        return 0
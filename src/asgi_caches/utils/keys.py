@@ -0,0 +1,102 @@
+"""
+Hashing of requests into cache keys.
+
+Hashes are computed directly from ASGI scope fields, without building Starlette
+request or URL objects. Hashes of URLs without their query string are memoized,
+as most requests are made to a small number of paths.
+"""
+
+import functools
+import hashlib
+import typing
+
+from starlette.types import Scope
+
+if typing.TYPE_CHECKING:  # pragma: no cover
+    from ..policies import KeyPolicy
+
+# NOTE: cache keys don't need a cryptographic hash, but must be stable across
+# processes. BLAKE2 with a small digest is one of the fastest hashes of the
+# standard library.
+DIGEST_SIZE = 16
+DEFAULT_PORTS = {"http": 80, "https": 443, "ws": 80, "wss": 443}
+MAX_MEMOIZED_PATHS = 1024
+
+
+def get_path(scope: Scope) -> str:
+    """Return the full path of a request, including the root path."""
+    return scope.get("root_path", "") + scope["path"]
+
+
+def get_host(scope: Scope) -> bytes:
+    """
+    Return the host of a request, from the `Host` header if set, or
+    from the server address otherwise.
+    """
+    for key, value in scope["headers"]:
+        if key == b"host":
+            return value
+
+    server = scope.get("server")
+    if server is None:
+        return b""
+
+    host, port = server
+    if port == DEFAULT_PORTS.get(scope.get("scheme", "http")):
+        return host.encode("latin-1")
+    return f"{host}:{port}".encode("latin-1")
+
+
+@functools.lru_cache(maxsize=MAX_MEMOIZED_PATHS)
+def _hash_url_without_query(scheme: str, host: bytes, path: str) -> typing.Any:
+    url_hash = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    url_hash.update(scheme.encode("latin-1"))
+    url_hash.update(b"://")
+    url_hash.update(host)
+    url_hash.update(path.encode("utf-8"))
+    return url_hash
+
+
+def hash_url(scope: Scope, key_policy: "typing.Optional[KeyPolicy]" = None) -> str:
+    """
+    Return a hash of the absolute URL of a request, including its query string.
+
+    If a `key_policy` is given, the URL is normalized according to it first.
+    """
+    scheme = scope.get("scheme", "http")
+    host = get_host(scope)
+    query_string = scope.get("query_string", b"")
+    if key_policy is not None:
+        scheme, host, query_string = key_policy.normalize_url(
+            scheme, host, query_string
+        )
+
+    url_hash = _hash_url_without_query(scheme, host, get_path(scope)).copy()
+    url_hash.update(b"?")
+    url_hash.update(query_string)
+    return url_hash.hexdigest()
+
+
+def hash_header_values(
+    scope: Scope,
+    names: typing.Sequence[str],
+    key_policy: "typing.Optional[KeyPolicy]" = None,
+) -> str:
+    """
+    Return a hash of the values of the given (lowercase) request headers.
+
+    Missing headers are considered empty. If a `key_policy` is given, values are
+    normalized according to it first.
+    """
+    values_hash = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    if names:
+        values: typing.Dict[bytes, bytes] = {}
+        for key, value in scope["headers"]:
+            values.setdefault(key, value)
+        for name in names:
+            value = values.get(name.encode("latin-1"), b"")
+            if key_policy is not None:
+                value = key_policy.normalize_header(name, value)
+            values_hash.update(value)
+            values_hash.update(b"\n")
+    return values_hash.hexdigest()
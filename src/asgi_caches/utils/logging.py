@@ -9,9 +9,11 @@ try:  # pragma: no cover
     # Extra log info for optional coloured terminal outputs.
     HIT_EXTRA = {"color_message": "cache_lookup " + click.style("%s", fg="green")}
     MISS_EXTRA = {"color_message": "cache_lookup " + click.style("%s", fg="yellow")}
+    STALE_EXTRA = {"color_message": "cache_lookup " + click.style("%s", fg="cyan")}
 except ImportError:  # pragma: no cover
     HIT_EXTRA = {}
     MISS_EXTRA = {}
+    STALE_EXTRA = {}
 
 
 TRACE_LOG_LEVEL = 5
@@ -22,6 +24,31 @@ class Logger(logging.Logger):
     def trace(self, message: str, *args: typing.Any, **kwargs: typing.Any) -> None:
         ...  # pragma: no cover
 
+    def trace_event(self, event: str, **fields: typing.Any) -> None:
+        ...  # pragma: no cover
+
+    def debug_event(self, event: str, **fields: typing.Any) -> None:
+        ...  # pragma: no cover
+
+
+class EventMessage:
+    """
+    The message of a structured log event, e.g. `store_in_cache max_age=120`.
+
+    Fields are only formatted if the message actually gets emitted.
+    """
+
+    __slots__ = ("event", "fields")
+
+    def __init__(self, event: str, fields: typing.Dict[str, typing.Any]) -> None:
+        self.event = event
+        self.fields = fields
+
+    def __str__(self) -> str:
+        return " ".join(
+            [self.event, *(f"{key}={value!r}" for key, value in self.fields.items())]
+        )
+
 
 class LoggerFactory:
     log_level_env_var = "ASGI_CACHES_LOG_LEVEL"
@@ -41,6 +68,15 @@ class LoggerFactory:
     def get(self, name: str) -> Logger:
         """
         Get a logger instance, and optionally set up logging.
+
+        On top of the standard logging API, the logger provides:
+
+        * `.trace()`, for logging at the TRACE level.
+        * `.trace_event()` and `.debug_event()`, for logging structured events.
+        Event fields are available as `record.fields` to log handlers.
+
+        Messages are only formatted if the corresponding level is enabled. Callers
+        should check `logger.isEnabledFor()` before computing expensive fields.
         """
         if not getattr(self, "_initialized", False):
             logging.addLevelName(TRACE_LOG_LEVEL, "TRACE")
@@ -52,9 +88,25 @@ class LoggerFactory:
         logger = logging.getLogger(name)
 
         def trace(message: str, *args: typing.Any, **kwargs: typing.Any) -> None:
-            logger.log(TRACE_LOG_LEVEL, message, *args, **kwargs)
+            if logger.isEnabledFor(TRACE_LOG_LEVEL):
+                logger.log(TRACE_LOG_LEVEL, message, *args, **kwargs)
+
+        def log_event(
+            level: int, event: str, fields: typing.Dict[str, typing.Any]
+        ) -> None:
+            if logger.isEnabledFor(level):
+                extra = {"event": event, "fields": fields}
+                logger.log(level, EventMessage(event, fields), extra=extra)
+
+        def trace_event(event: str, **fields: typing.Any) -> None:
+            log_event(TRACE_LOG_LEVEL, event, fields)
+
+        def debug_event(event: str, **fields: typing.Any) -> None:
+            log_event(logging.DEBUG, event, fields)
 
         logger.trace = trace  # type: ignore
+        logger.trace_event = trace_event  # type: ignore
+        logger.debug_event = debug_event  # type: ignore
 
         return typing.cast(Logger, logger)
 
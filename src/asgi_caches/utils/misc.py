@@ -14,6 +14,14 @@ def http_date(epoch_time: float) -> str:
     return email.utils.formatdate(epoch_time, usegmt=True)
 
 
+def parse_http_date(value: str) -> typing.Optional[float]:
+    """Return the epoch time of a date from an HTTP header, or `None` if invalid."""
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return email.utils.mktime_tz(parsed)
+
+
 def bytes_to_json_string(data: bytes) -> str:
     """
     Given binary data, return a string representation
@@ -54,7 +62,3 @@ def is_asgi3(app: typing.Any) -> bool:
         return False
     else:
         return inspect.iscoroutinefunction(call) and has_asgi3_signature(call)
-
-
-def kvformat(**kwargs: typing.Any) -> str:
-    return " ".join(f"{key}={value}" for key, value in kwargs.items())
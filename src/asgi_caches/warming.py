@@ -0,0 +1,278 @@
+"""
+Cache warming: populate the cache by passing requests through an application
+wrapped with `CacheMiddleware`, e.g. after a deployment or a cache flush.
+
+Usage from the command line:
+
+    python -m asgi_caches.warming myproject.app:app urls.txt [-H 'Accept-Language: fr']
+
+URLs are read from the given file (or from standard input if `-`), one per line.
+"""
+
+import argparse
+import asyncio
+import importlib
+import sys
+import typing
+from urllib.parse import unquote, urlsplit
+
+from starlette.types import ASGIApp, Message, Scope
+
+from .middleware import CACHE_STATUS_KEY, make_revalidation_receive
+from .utils.keys import DEFAULT_PORTS
+from .utils.logging import get_logger
+
+logger = get_logger(__name__)
+
+# Outcomes of requests whose response is in the cache afterwards.
+POPULATED_STATUSES = frozenset(("hit", "stored", "queued"))
+
+
+class WarmingResult(typing.NamedTuple):
+    """
+    The outcome of warming a URL with a set of request headers: `hit`, `stored`,
+    `queued` (if a background writer is used), or why the response isn't cached.
+    """
+
+    url: str
+    headers: typing.Dict[str, str]
+    status: str
+
+
+class WarmingReport(typing.NamedTuple):
+    populated: typing.List[WarmingResult]
+    failed: typing.List[WarmingResult]
+
+
+class RateLimiter:
+    """Space out calls to `.wait()` so that at most `rate` of them return per second."""
+
+    def __init__(self, rate: float) -> None:
+        self.interval = 1 / rate
+        self.next_time = 0.0
+
+    async def wait(self) -> None:
+        now = asyncio.get_event_loop().time()
+        start = max(now, self.next_time)
+        self.next_time = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+def make_scope(
+    url: str, headers: typing.Mapping[str, str], base_url: str = "http://localhost"
+) -> Scope:
+    """Build the scope of a GET request to a URL, relative to `base_url`."""
+    base = urlsplit(base_url)
+    parts = urlsplit(url)
+    scheme = parts.scheme or base.scheme
+    netloc = parts.netloc or base.netloc
+    host, _, port = netloc.partition(":")
+    raw_headers = [(b"host", netloc.encode("latin-1"))] + [
+        (key.lower().encode("latin-1"), value.encode("latin-1"))
+        for key, value in headers.items()
+        if key.lower() != "host"
+    ]
+    return {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": scheme,
+        "server": (host, int(port) if port else DEFAULT_PORTS.get(scheme, 80)),
+        "client": None,
+        "root_path": "",
+        "path": unquote(parts.path or "/"),
+        "raw_path": (parts.path or "/").encode("latin-1"),
+        "query_string": parts.query.encode("latin-1"),
+        "headers": raw_headers,
+    }
+
+
+async def warm_url(
+    app: ASGIApp,
+    url: str,
+    headers: typing.Mapping[str, str],
+    base_url: str = "http://localhost",
+) -> WarmingResult:
+    """Pass a GET request through an application, and return the outcome."""
+    scope = make_scope(url, headers, base_url)
+
+    async def send(message: Message) -> None:
+        pass
+
+    try:
+        await app(scope, make_revalidation_receive(), send)
+    except Exception as exc:
+        logger.exception("warm_url_failed url=%r", url)
+        status = f"error: {exc!r}"
+    else:
+        # NOTE: the response wasn't cached if it didn't go through `CacheMiddleware`.
+        status = scope.get(CACHE_STATUS_KEY, "not_cached")
+    return WarmingResult(url=url, headers=dict(headers), status=status)
+
+
+async def warm(
+    app: ASGIApp,
+    urls: typing.Iterable[str],
+    *,
+    headers: typing.Optional[typing.Sequence[typing.Mapping[str, str]]] = None,
+    concurrency: int = 10,
+    rate: typing.Optional[float] = None,
+    base_url: str = "http://localhost",
+) -> WarmingReport:
+    """
+    Populate the cache by passing GET requests to the given `urls` through `app`,
+    which must use `CacheMiddleware`.
+
+    Each URL is requested once for each set of request `headers`, e.g. one for each
+    `Accept-Language` of responses that vary on it, or once without extra headers
+    by default. URLs may be relative to the `base_url`, and are consumed lazily,
+    so `urls` may be a generator.
+
+    At most `concurrency` requests are processed at a time, and at most `rate`
+    requests are started per second if given.
+    """
+    assert concurrency > 0, "concurrency must be positive"
+    if headers is None:
+        headers = [{}]
+    requests = ((url, headers_) for url in urls for headers_ in headers)
+    limiter = RateLimiter(rate) if rate is not None else None
+    report = WarmingReport(populated=[], failed=[])
+
+    async def worker() -> None:
+        # NOTE: workers share the iterator, so each request is made once.
+        for url, request_headers in requests:
+            if limiter is not None:
+                await limiter.wait()
+            result = await warm_url(app, url, request_headers, base_url)
+            logger.debug_event("warm_url", url=url, status=result.status)
+            if result.status in POPULATED_STATUSES:
+                report.populated.append(result)
+            else:
+                report.failed.append(result)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    logger.debug_event(
+        "warm", populated=len(report.populated), failed=len(report.failed)
+    )
+    return report
+
+
+class Lifespan:
+    """
+    Run the startup and shutdown handlers of an application, e.g. to connect to
+    its cache when warming it from a separate process.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+        self.receive_queue: "asyncio.Queue[Message]" = asyncio.Queue()
+        self.send_queue: "asyncio.Queue[Message]" = asyncio.Queue()
+        self.task: typing.Optional[asyncio.Future] = None
+
+    async def __aenter__(self) -> None:
+        scope = {"type": "lifespan"}
+        self.task = asyncio.ensure_future(
+            self.app(scope, self.receive_queue.get, self.send_queue.put)
+        )
+        await self.receive_queue.put({"type": "lifespan.startup"})
+        await self.expect("lifespan.startup.complete")
+
+    async def __aexit__(self, *args: typing.Any) -> None:
+        await self.receive_queue.put({"type": "lifespan.shutdown"})
+        await self.expect("lifespan.shutdown.complete")
+        assert self.task is not None
+        await self.task
+
+    async def expect(self, message_type: str) -> None:
+        assert self.task is not None
+        get_message = asyncio.ensure_future(self.send_queue.get())
+        await asyncio.wait(
+            [get_message, self.task], return_when=asyncio.FIRST_COMPLETED
+        )
+        if not get_message.done():
+            get_message.cancel()
+            # Raise any exception of the application.
+            self.task.result()
+            raise RuntimeError("Application does not support lifespan events")
+        message = get_message.result()
+        if message["type"] != message_type:
+            raise RuntimeError(message.get("message") or message["type"])
+
+
+def import_app(path: str) -> ASGIApp:
+    """Import an application from a path such as `myproject.app:app`."""
+    module_name, _, attribute = path.partition(":")
+    if not attribute:
+        raise ValueError(f"Expected a path such as 'module:app', got {path!r}")
+    module = importlib.import_module(module_name)
+    return getattr(module, attribute)
+
+
+def parse_header(value: str) -> typing.Tuple[str, str]:
+    name, sep, header = value.partition(":")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"Expected 'Name: value', got {value!r}")
+    return name.strip(), header.strip()
+
+
+def main(argv: typing.Optional[typing.Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("app", help="Import path of the application, e.g. 'app:app'.")
+    parser.add_argument("urls", help="File listing URLs, one per line, or '-'.")
+    parser.add_argument(
+        "-H",
+        "--header",
+        action="append",
+        type=parse_header,
+        default=[],
+        help="Header of a variant, as 'Name: value'. "
+        "Each URL is requested once for each header.",
+    )
+    parser.add_argument("--base-url", default="http://localhost")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--rate", type=float, help="Maximum requests per second.")
+    parser.add_argument(
+        "--no-lifespan",
+        dest="lifespan",
+        action="store_false",
+        help="Don't run the startup and shutdown handlers of the application.",
+    )
+    args = parser.parse_args(argv)
+
+    app = import_app(args.app)
+    headers = [{name: value} for name, value in args.header] or None
+    if args.urls == "-":
+        lines: typing.Iterable[str] = sys.stdin
+    else:
+        lines = open(args.urls)
+    urls = (line.strip() for line in lines if line.strip())
+
+    async def run() -> WarmingReport:
+        kwargs: typing.Dict[str, typing.Any] = {
+            "headers": headers,
+            "concurrency": args.concurrency,
+            "rate": args.rate,
+            "base_url": args.base_url,
+        }
+        if not args.lifespan:
+            return await warm(app, urls, **kwargs)
+        async with Lifespan(app):
+            return await warm(app, urls, **kwargs)
+
+    loop = asyncio.new_event_loop()
+    try:
+        report = loop.run_until_complete(run())
+    finally:
+        loop.close()
+        if lines is not sys.stdin:
+            typing.cast(typing.TextIO, lines).close()
+
+    for result in report.failed:
+        print(f"FAILED {result.url} {result.headers} {result.status}", file=sys.stderr)
+    print(f"Populated: {len(report.populated)}, failed: {len(report.failed)}")
+    return 1 if report.failed else 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
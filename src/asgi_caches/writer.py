@@ -0,0 +1,94 @@
+import asyncio
+import typing
+
+from .utils.logging import get_logger
+
+logger = get_logger(__name__)
+
+Write = typing.Callable[[], typing.Awaitable[None]]
+
+
+class CacheWriter:
+    """
+    Perform cache writes in the background, so that storing responses in the
+    cache doesn't add latency to cache misses.
+
+    At most `max_pending` writes can be waiting to be performed, and at most
+    `concurrency` writes are performed at the same time. Writes submitted while
+    the queue is full are dropped.
+
+    The writer keeps count of `written`, `dropped` and `failed` writes.
+    """
+
+    def __init__(self, *, max_pending: int = 1024, concurrency: int = 4) -> None:
+        assert max_pending > 0
+        assert concurrency > 0
+        self.max_pending = max_pending
+        self.concurrency = concurrency
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        # NOTE: created lazily, as they must be bound to a running event loop.
+        self._queue: typing.Optional[asyncio.Queue] = None
+        self._workers: typing.List[asyncio.Future] = []
+
+    @property
+    def pending(self) -> int:
+        """Return the number of writes submitted but not performed yet."""
+        return 0 if self._queue is None else self._queue.qsize()
+
+    def submit(self, write: Write) -> typing.Optional[asyncio.Future]:
+        """
+        Schedule a cache write.
+
+        Return a future that completes once the write has been performed (whether
+        it succeeded or not), or `None` if the write was dropped.
+        """
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_pending)
+            self._workers = [
+                asyncio.ensure_future(self._work(self._queue))
+                for _ in range(self.concurrency)
+            ]
+
+        done: asyncio.Future = asyncio.get_event_loop().create_future()
+        try:
+            self._queue.put_nowait((write, done))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.trace_event("cache_write_dropped", pending=self.pending)
+            return None
+
+        return done
+
+    async def _work(self, queue: asyncio.Queue) -> None:
+        while True:
+            write, done = await queue.get()
+            try:
+                await write()
+            except Exception:
+                self.failed += 1
+                logger.exception("cache_write_failed")
+            else:
+                self.written += 1
+            finally:
+                done.set_result(None)
+                queue.task_done()
+
+    async def drain(self) -> None:
+        """
+        Wait for pending writes to be performed, and stop background workers.
+
+        This should be called when the application shuts down. The writer can
+        still be used afterwards.
+        """
+        if self._queue is None:
+            return
+
+        queue, workers = self._queue, self._workers
+        self._queue, self._workers = None, []
+
+        await queue.join()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
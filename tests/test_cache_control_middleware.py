@@ -5,6 +5,7 @@ import pytest
 from starlette.responses import PlainTextResponse
 from starlette.types import ASGIApp, Receive, Scope, Send
 
+import asgi_caches.middleware
 from asgi_caches.middleware import CacheControlMiddleware
 from tests.utils import mock_receive, mock_send
 
@@ -76,3 +77,35 @@ async def test_not_http() -> None:
 
     app = CacheControlMiddleware(app)
     await app({"type": "lifespan"}, mock_receive, mock_send)
+
+
+def test_patch_headers() -> None:
+    middleware = CacheControlMiddleware(PlainTextResponse("Hello"), max_age=30)
+    headers = [
+        (b"cache-control", b"no-transform"),
+        (b"content-type", b"text/plain"),
+        (b"cache-control", b"must-revalidate"),
+    ]
+    assert middleware.patch_headers(headers) == [
+        (b"cache-control", b"no-transform, max-age=30"),
+        (b"content-type", b"text/plain"),
+    ]
+    assert middleware.patched_values == {b"no-transform": b"no-transform, max-age=30"}
+
+    # Headers are left as-is if there's nothing to patch.
+    headers = [(b"cache-control", b"max-age=30")]
+    assert middleware.patch_headers(headers) is headers
+
+
+def test_patch_headers_remove() -> None:
+    middleware = CacheControlMiddleware(PlainTextResponse("Hello"), max_stale=False)
+    headers = [(b"cache-control", b"max-stale=60"), (b"content-type", b"text/plain")]
+    assert middleware.patch_headers(headers) == [(b"content-type", b"text/plain")]
+
+
+def test_patched_values_bounded(monkeypatch: typing.Any) -> None:
+    monkeypatch.setattr(asgi_caches.middleware, "MAX_PATCHED_VALUES", 1)
+    middleware = CacheControlMiddleware(PlainTextResponse("Hello"), max_age=30)
+    for value in (b"max-age=10", b"max-age=20"):
+        assert middleware.get_patched_value(value) == value
+    assert list(middleware.patched_values) == [b"max-age=10"]
@@ -1,3 +1,4 @@
+import asyncio
 import datetime as dt
 import gzip
 import typing
@@ -6,16 +7,33 @@ import httpx
 import pytest
 from caches import Cache
 from starlette.applications import Starlette
-from starlette.datastructures import Headers
+from starlette.datastructures import Headers, MutableHeaders
 from starlette.endpoints import HTTPEndpoint
 from starlette.middleware import Middleware
-from starlette.responses import PlainTextResponse, StreamingResponse
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
 from starlette.routing import Route
-from starlette.types import Receive, Scope, Send
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
+from asgi_caches.compression import BrotliCodec, GzipCodec
 from asgi_caches.exceptions import CacheNotConnected, DuplicateCaching
-from asgi_caches.middleware import CacheMiddleware
-from tests.utils import CacheSpy, ComparableHTTPXResponse, mock_receive, mock_send
+from asgi_caches.local import LocalCache
+from asgi_caches.metrics import InMemoryMetrics
+from asgi_caches.middleware import CacheMiddleware, make_revalidation_receive
+from asgi_caches.policies import (
+    AcceptEncodingNormalizer,
+    FrequencyAdmissionPolicy,
+    KeyPolicy,
+)
+from asgi_caches.serializers import BinarySerializer, JSONSerializer
+from asgi_caches.writer import CacheWriter
+from tests.utils import (
+    CacheSpy,
+    ComparableHTTPXResponse,
+    mock_receive,
+    mock_send,
+    travel,
+)
 
 
 @pytest.mark.asyncio
@@ -43,13 +61,143 @@ async def test_cache_response() -> None:
 
         r1 = await client.get("/")
         assert spy.misses == 1
+        # ETags are added when storing responses, so only cache hits have one.
+        assert "ETag" not in r.headers
+        assert "ETag" in r1.headers
+        r1_etag = r1.headers["ETag"]
+        del r1.headers["ETag"]
         assert ComparableHTTPXResponse(r1) == r
 
         r2 = await client.get("/")
         assert spy.misses == 1
+        assert r2.headers["ETag"] == r1_etag
+        del r2.headers["ETag"]
         assert ComparableHTTPXResponse(r2) == r
 
 
+@pytest.mark.asyncio
+async def test_cache_hit_raw_messages(monkeypatch: typing.Any) -> None:
+    """
+    Cache hits should replay raw ASGI messages, without building response objects.
+    """
+    cache = Cache("locmem://null", ttl=2 * 60)
+    spy = CacheSpy(PlainTextResponse("Hello, world!"))
+    app = CacheMiddleware(spy, cache=cache)
+    client = httpx.AsyncClient(app=app, base_url="http://testserver")
+
+    async with cache, client:
+        r = await client.get("/")
+        assert spy.misses == 1
+
+        def fail(*args: typing.Any, **kwargs: typing.Any) -> None:
+            raise AssertionError("Response was built")  # pragma: no cover
+
+        monkeypatch.setattr(Response, "__init__", fail)
+
+        r1 = await client.get("/")
+        assert spy.misses == 1
+        # ETags are added when storing responses, so only cache hits have one.
+        assert "ETag" not in r.headers
+        assert "ETag" in r1.headers
+        del r1.headers["ETag"]
+        assert ComparableHTTPXResponse(r1) == r
+
+
+@pytest.mark.asyncio
+async def test_cache_response_json_serializer() -> None:
+    cache = Cache("locmem://null", ttl=2 * 60)
+    spy = CacheSpy(PlainTextResponse("Hello, world!"))
+    app = CacheMiddleware(spy, cache=cache, serializer=JSONSerializer())
+    client = httpx.AsyncClient(app=app, base_url="http://testserver")
+
+    async with cache, client:
+        r = await client.get("/")
+        assert r.text == "Hello, world!"
+        assert spy.misses == 1
+
+        r1 = await client.get("/")
+        assert spy.misses == 1
+        # ETags are added when storing responses, so only cache hits have one.
+        assert "ETag" not in r.headers
+        assert "ETag" in r1.headers
+        del r1.headers["ETag"]
+        assert ComparableHTTPXResponse(r1) == r
+
+
+@pytest.mark.asyncio
+async def test_cache_response_compressed() -> None:
+    cache = Cache("locmem://null", ttl=2 * 60)
+    content = "Hello, world!" * 100
+    spy = CacheSpy(PlainTextResponse(content, headers={"Vary": "Cookie"}))
+    serializer = BinarySerializer(codec=GzipCodec())
+    app = CacheMiddleware(spy, cache=cache, serializer=serializer)
+    client = httpx.AsyncClient(app=app, base_url="http://testserver")
+
+    async with cache, client:
+        r = await client.get("/", headers={"Accept-Encoding": "gzip"})
+        assert r.text == content
+        assert "Content-Encoding" not in r.headers
+        assert spy.misses == 1
+
+        # The compressed body is sent as-is.
+        r = await client.get("/", headers={"Accept-Encoding": "gzip, br"})
+        assert spy.misses == 1
+        assert r.text == content
+        assert r.headers["Content-Encoding"] == "gzip"
+        assert int(r.headers["Content-Length"]) < len(content)
+        assert r.headers["Vary"] == "Cookie, Accept-Encoding"
+        etag = r.headers["ETag"]
+        assert etag.startswith("W/")
+
+        r = await client.get("/", headers={"Accept-Encoding": "identity"})
+        assert spy.misses == 1
+        assert r.text == content
+        assert "Content-Encoding" not in r.headers
+        assert r.headers["Content-Length"] == str(len(content))
+        assert r.headers["Vary"] == "Cookie, Accept-Encoding"
+        assert r.headers["ETag"] == etag[2:]
+
+        for accept_encoding in ("gzip", "identity"):
+            r = await client.get(
+                "/",
+                headers={"Accept-Encoding": accept_encoding, "If-None-Match": etag},
+            )
+            assert r.status_code == 304
+            assert r.content == b""
+            assert "Content-Encoding" not in r.headers
+
+
+@pytest.mark.asyncio
+async def test_encodings() -> None:
+    cache = Cache("locmem://null", ttl=2 * 60)
+    content = "Hello, world!" * 100
+    spy = CacheSpy(PlainTextResponse(content))
+    app = CacheMiddleware(
+        spy, cache=cache, encodings=[BrotliCodec(), GzipCodec()], min_encoding_size=500
+    )
+    client = httpx.AsyncClient(app=app, base_url="http://testserver")
+
+    async with cache, client:
+        r = await client.get("/", headers={"Accept-Encoding": "gzip, br"})
+        assert r.text == content
+        assert "Content-Encoding" not in r.headers
+        assert r.headers["Vary"] == "Accept-Encoding"
+        assert spy.misses == 1
+
+        # A single identity response is stored, and variants are picked per request.
+        for accept_encoding, content_encoding in (
+            ("gzip, br", "br"),
+            ("gzip", "gzip"),
+            ("gzip;q=0.5, br", "br"),
+            ("identity", None),
+        ):
+            r = await client.get("/", headers={"Accept-Encoding": accept_encoding})
+            assert r.text == content
+            assert r.headers.get("Content-Encoding") == content_encoding
+            assert r.headers["Vary"] == "Accept-Encoding"
+        assert spy.misses == 1
+
+
 @pytest.mark.asyncio
 async def test_not_http() -> None:
     async def app(scope: Scope, receive: Receive, send: Send) -> None:
@@ -82,6 +230,19 @@ async def test_non_cachable_request() -> None:
         assert spy.misses == 2
 
 
+@pytest.mark.asyncio
+async def test_non_cachable_request_skips_cache() -> None:
+    # NOTE: the cache isn't connected, so any cache operation would fail.
+    cache = Cache("locmem://null")
+    app = CacheMiddleware(PlainTextResponse("Hello, world!"), cache=cache)
+    client = httpx.AsyncClient(app=app, base_url="http://testserver")
+
+    async with client:
+        r = await client.post("/")
+        assert r.status_code == 200
+        assert r.text == "Hello, world!"
+
+
 @pytest.mark.asyncio
 async def test_use_cached_head_response_on_get() -> None:
     """
@@ -134,9 +295,49 @@ async def test_not_200_ok(status_code: int) -> None:
         assert spy.misses == 2
 
 
+@pytest.mark.parametrize("status_code", (301, 308, 404, 410))
+@pytest.mark.asyncio
+async def test_status_ttls(status_code: int, monkeypatch: typing.Any) -> None:
+    cache = Cache("locmem://null", ttl=2 * 60)
+    spy = CacheSpy(PlainTextResponse("Hello, world!", status_code=status_code))
+    app = CacheMiddleware(
+        spy, cache=cache, status_ttls={301: 30, 308: 30, 404: 30, 410: 30}
+    )
+    client = httpx.AsyncClient(app=app, base_url="http://testserver")
+
+    async with cache, client:
+        r = await client.get("/")
+        assert r.status_code == status_code
+        assert r.headers["Cache-Control"] == "max-age=30"
+        assert spy.misses == 1
+
+        r1 = await client.get("/")
+        assert r1.status_code == status_code
+        assert r1.text == "Hello, world!"
+        assert spy.misses == 1
+
+        travel(monkeypatch, 31)
+        await client.get("/")
+        assert spy.misses == 2
+
+
+@pytest.mark.asyncio
+async def test_cachable_status_codes() -> None:
+    cache = Cache("locmem://null", ttl=2 * 60)
+    spy = CacheSpy(PlainTextResponse("Hello, world!", status_code=203))
+    app = CacheMiddleware(spy, cache=cache, cachable_status_codes={200, 203})
+    client = httpx.AsyncClient(app=app, base_url="http://testserver")
+
+    async with cache, client:
+        await client.get("/")
+        r = await client.get("/")
+        assert r.status_code == 203
+        assert spy.misses == 1
+
+
 @pytest.mark.asyncio
 async def test_streaming_response() -> None:
-    """Streaming responses should not be cached."""
+    """Streaming responses should be cached once fully sent."""
     cache = Cache("locmem://null")
 
     async def body() -> typing.AsyncIterator[str]:
@@ -162,128 +363,1048 @@ async def test_streaming_response() -> None:
         r = await client.get("/")
         assert r.status_code == 200
         assert r.text == "Hello, world!"
-        assert spy.misses == 2
+        assert spy.misses == 1
 
 
 @pytest.mark.asyncio
-async def test_vary() -> None:
+async def test_streaming_response_chunks() -> None:
     """
-    Sending different values for request headers registered as varying should
-    result in different cache entries.
+    Streamed chunks should be sent as they are produced, and cached streaming
+    responses should be replayed in chunks.
     """
     cache = Cache("locmem://null")
+    body = b"Hello, world!" * 10000
 
-    async def gzippable_app(scope: Scope, receive: Receive, send: Send) -> None:
-        headers = Headers(scope=scope)
+    async def app(scope: Scope, receive: Receive, send: Send) -> None:
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        for start in range(0, len(body), 1000):
+            chunk = body[start : start + 1000]
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            # The chunk must have been passed through already.
+            assert messages[-1]["body"] == chunk
+        await send({"type": "http.response.body", "body": b""})
 
-        if "gzip" in headers.getlist("accept-encoding"):
-            body = gzip.compress(b"Hello, world!")
-            response = PlainTextResponse(
-                content=body,
-                headers={"Content-Encoding": "gzip", "Content-Length": str(len(body))},
-            )
-        else:
-            response = PlainTextResponse("Hello, world!")
+    cached_app = CacheMiddleware(app, cache=cache)
+    scope: Scope = {
+        "type": "http",
+        "method": "GET",
+        "scheme": "http",
+        "server": ("testserver", 80),
+        "path": "/",
+        "query_string": b"",
+        "headers": [(b"host", b"testserver")],
+    }
+    messages: typing.List[Message] = []
 
-        response.headers["Vary"] = "Accept-Encoding"
-        await response(scope, receive, send)
+    async def send(message: Message) -> None:
+        messages.append(message)
 
-    spy = CacheSpy(gzippable_app)
+    async with cache:
+        await cached_app({**scope}, mock_receive, send)
+        assert len(messages) == 1 + 130 + 1
+        assert "Cache-Control" in Headers(raw=messages[0]["headers"])
+
+        messages.clear()
+        await cached_app({**scope}, mock_receive, send)
+        start, *body_messages = messages
+        assert "Cache-Control" in Headers(raw=start["headers"])
+        assert [message["more_body"] for message in body_messages] == [True, False]
+        assert b"".join(message["body"] for message in body_messages) == body
+
+
+@pytest.mark.asyncio
+async def test_conditional_request() -> None:
+    """Conditional requests should be answered with a 304 from the cache."""
+    cache = Cache("locmem://null", ttl=2 * 60)
+    spy = CacheSpy(
+        PlainTextResponse(
+            "Hello, world!", headers={"Last-Modified": "Wed, 20 Nov 2019 00:00:00 GMT"},
+        )
+    )
     app = CacheMiddleware(spy, cache=cache)
     client = httpx.AsyncClient(app=app, base_url="http://testserver")
 
     async with cache, client:
-        r = await client.get("/", headers={"accept-encoding": "gzip"})
-        assert spy.misses == 1
+        r = await client.get("/")
+        assert r.status_code == 200
+        assert "ETag" not in r.headers
+
+        r = await client.get("/")
         assert r.status_code == 200
         assert r.text == "Hello, world!"
-        assert r.headers["content-encoding"] == "gzip"
-        assert "Expires" in r.headers
-        assert "Cache-Control" in r.headers
+        etag = r.headers["ETag"]
 
-        # Different "Accept-Encoding" header => the cached result
-        # for "Accept-Encoding: gzip" should not be used.
-        r1 = await client.get("/", headers={"accept-encoding": "identity"})
-        assert spy.misses == 2
-        assert r1.status_code == 200
-        assert r1.text == "Hello, world!"
-        assert "Expires" in r.headers
+        r = await client.get("/", headers={"If-None-Match": etag})
+        assert r.status_code == 304
+        assert r.content == b""
+        assert r.headers["ETag"] == etag
         assert "Cache-Control" in r.headers
+        assert "Content-Type" not in r.headers
+        assert "Content-Length" not in r.headers
 
-        # This "Accept-Encoding" header has already been seen => we should
-        # get a cached response.
-        r2 = await client.get("/", headers={"accept-encoding": "gzip"})
-        assert spy.misses == 2
+        r = await client.get("/", headers={"If-None-Match": '"other"'})
         assert r.status_code == 200
         assert r.text == "Hello, world!"
-        assert r2.headers["Content-Encoding"] == "gzip"
-        assert "Expires" in r.headers
-        assert "Cache-Control" in r.headers
+
+        r = await client.get(
+            "/", headers={"If-Modified-Since": "Thu, 21 Nov 2019 00:00:00 GMT"}
+        )
+        assert r.status_code == 304
+
+        r = await client.get(
+            "/", headers={"If-Modified-Since": "Tue, 19 Nov 2019 00:00:00 GMT"}
+        )
+        assert r.status_code == 200
+
+        assert spy.misses == 1
 
 
 @pytest.mark.asyncio
-async def test_cookies_in_response_and_cookieless_request() -> None:
-    """
-    Responses that set cookies shouldn't be cached
-    if the request doesn't have cookies.
-    """
-    cache = Cache("locmem://null")
+async def test_invalidate() -> None:
+    cache = Cache("locmem://null", ttl=2 * 60)
 
     async def app(scope: Scope, receive: Receive, send: Send) -> None:
-        response = PlainTextResponse("Hello, world!")
-        response.set_cookie("session_id", "1234")
+        response = PlainTextResponse(
+            "Hello, world!", headers={"Cache-Tag": scope["path"].strip("/")}
+        )
         await response(scope, receive, send)
 
     spy = CacheSpy(app)
-    app = CacheMiddleware(spy, cache=cache)
+    cached_app = CacheMiddleware(
+        spy, cache=cache, local_cache=LocalCache(), tags=["all"], index_paths=True
+    )
+    client = httpx.AsyncClient(app=cached_app, base_url="http://testserver")
+
+    async with cache, client:
+        await client.get("/a")
+        await client.get("/b")
+        await client.get("/b")
+        assert spy.misses == 2
+
+        assert await cached_app.invalidate(tags=["b"]) == 1
+        await client.get("/a")
+        await client.get("/b")
+        assert spy.misses == 3
+
+        assert await cached_app.invalidate(path_prefix="/a") == 1
+        await client.get("/a")
+        assert spy.misses == 4
+
+        assert await cached_app.invalidate(tags=["all"]) == 2
+        await client.get("/a")
+        await client.get("/b")
+        assert spy.misses == 6
+
+
+@pytest.mark.asyncio
+async def test_key_policy() -> None:
+    """Equivalent requests should share the same cached response."""
+    cache = Cache("locmem://null", ttl=2 * 60)
+    spy = CacheSpy(PlainTextResponse("Hello, world!"))
+    app = CacheMiddleware(
+        spy,
+        cache=cache,
+        key_policy=KeyPolicy(exclude_query=["utm_*"], normalize_host=True),
+    )
     client = httpx.AsyncClient(app=app, base_url="http://testserver")
 
     async with cache, client:
-        r = await client.get("/")
-        assert r.status_code == 200
-        assert r.text == "Hello, world!"
+        await client.get("/?a=1&b=2")
         assert spy.misses == 1
 
-        r = await client.get("/")
-        assert r.status_code == 200
-        assert r.text == "Hello, world!"
+        await client.get("/?b=2&a=1")
+        await client.get("/?a=1&utm_source=newsletter&b=2")
+        await client.get("http://TestServer/?a=1&b=2")
+        assert spy.misses == 1
+
+        await client.get("/?a=1&b=3")
         assert spy.misses == 2
 
 
 @pytest.mark.asyncio
-async def test_cache_not_connected() -> None:
+async def test_key_policy_vary_normalizers() -> None:
+    """Requests with equivalent varying headers should share the same response."""
     cache = Cache("locmem://null", ttl=2 * 60)
-    app = CacheMiddleware(PlainTextResponse("Hello, world!"), cache=cache)
+    spy = CacheSpy(
+        PlainTextResponse("Hello, world!", headers={"Vary": "Accept-Encoding"})
+    )
+    key_policy = KeyPolicy(
+        vary_normalizers={"Accept-Encoding": AcceptEncodingNormalizer(["gzip"])}
+    )
+    app = CacheMiddleware(spy, cache=cache, key_policy=key_policy)
     client = httpx.AsyncClient(app=app, base_url="http://testserver")
 
-    async with client:
-        with pytest.raises(CacheNotConnected) as ctx:
-            await client.get("/")
+    async with cache, client:
+        await client.get("/", headers={"Accept-Encoding": "gzip, deflate"})
+        assert spy.misses == 1
 
-    exc = ctx.value
-    assert exc.cache is cache
-    assert str(cache.url) in str(exc)
+        await client.get("/", headers={"Accept-Encoding": "br, gzip"})
+        await client.get("/", headers={"Accept-Encoding": "gzip"})
+        assert spy.misses == 1
+
+        await client.get("/", headers={"Accept-Encoding": "identity"})
+        assert spy.misses == 2
 
 
 @pytest.mark.asyncio
-async def test_duplicate_caching() -> None:
-    cache = Cache("locmem://default")
-    special_cache = Cache("locmem://special")
+async def test_metrics() -> None:
+    cache = Cache("locmem://null", ttl=2 * 60)
+    metrics = InMemoryMetrics()
 
-    class DuplicateCache(HTTPEndpoint):
-        pass
+    async def home(request: typing.Any) -> Response:
+        return PlainTextResponse("Hello, world!")
+
+    async def user(request: typing.Any) -> Response:
+        return PlainTextResponse("Hello, user!" + "!" * 1024)
+
+    async def error(request: typing.Any) -> Response:
+        return PlainTextResponse("Oops", status_code=500)
 
     app = Starlette(
         routes=[
-            Route(
-                "/duplicate_cache", CacheMiddleware(DuplicateCache, cache=special_cache)
-            )
+            Route("/", home, methods=["GET", "POST"]),
+            Route("/users/{id}", user),
+            Route("/error", error),
+        ],
+        middleware=[
+            Middleware(CacheMiddleware, cache=cache, metrics=metrics, max_body_size=16)
         ],
-        middleware=[Middleware(CacheMiddleware, cache=cache)],
     )
+    client = httpx.AsyncClient(app=app, base_url="http://testserver")
+
+    async with cache, client:
+        await client.get("/")
+        await client.get("/")
+        await client.get("/")
+        await client.post("/")
+        await client.get("/users/1")
+        await client.get("/users/2")
+        await client.get("/error")
+
+    assert metrics.get_count("misses", route="/") == 1
+    assert metrics.get_count("hits", route="/") == 2
+    assert metrics.get_count("stores", route="/") == 1
+    assert metrics.get_count("bypasses", route="/", reason="method") == 1
+    assert metrics.get_count("misses", route="/users/{id}") == 2
+    assert metrics.get_count("bypasses", reason="body_too_large") == 2
+    assert metrics.get_count("bypasses", reason="status_code") == 1
+    assert metrics.get_count("stores") == 1
+
+    lookups = metrics.get_histogram("lookup_seconds", route="/")
+    assert lookups is not None
+    assert lookups.count == 3
+    sizes = metrics.get_histogram("entry_size_bytes", route="/")
+    assert sizes is not None
+    assert sizes.sum == len("Hello, world!")
+    assert metrics.get_histogram("store_seconds", route="/") is not None
 
+
+@pytest.mark.asyncio
+async def test_metrics_wrapped_app() -> None:
+    cache = Cache("locmem://null", ttl=2 * 60)
+    metrics = InMemoryMetrics()
+
+    async def user(request: typing.Any) -> Response:
+        return PlainTextResponse("Hello, user!")
+
+    # Routes are resolved before the application sets `scope["app"]`.
+    app = CacheMiddleware(
+        Starlette(routes=[Route("/users/{id}", user)]), cache=cache, metrics=metrics
+    )
     client = httpx.AsyncClient(app=app, base_url="http://testserver")
 
-    async with cache, special_cache, client:
-        with pytest.raises(DuplicateCaching):
-            await client.get("/duplicate_cache")
+    async with cache, client:
+        await client.get("/users/1")
+        await client.get("/users/1")
+        await client.post("/users/1")
+
+    assert metrics.get_count("misses", route="/users/{id}") == 1
+    assert metrics.get_count("hits", route="/users/{id}") == 1
+    assert metrics.get_count("bypasses", route="/users/{id}", reason="method") == 1
+
+
+@pytest.mark.asyncio
+async def test_metrics_store_errors(monkeypatch: typing.Any) -> None:
+    cache = Cache("locmem://null", ttl=2 * 60)
+    metrics = InMemoryMetrics()
+    writer = CacheWriter()
+    app = CacheMiddleware(
+        PlainTextResponse("Hello, world!"), cache=cache, writer=writer, metrics=metrics
+    )
+    client = httpx.AsyncClient(app=app, base_url="http://testserver")
+
+    async def failing_set(*args: typing.Any, **kwargs: typing.Any) -> None:
+        raise RuntimeError("Backend unavailable")
+
+    async with cache, client:
+        monkeypatch.setattr(cache, "set", failing_set)
+        r = await client.get("/")
+        assert r.status_code == 200
+        await writer.drain()
+
+    assert metrics.get_count("store_errors", route="<unknown>") == 1
+    assert metrics.get_count("stores") == 0
+    assert writer.failed == 1
+
+
+@pytest.mark.asyncio
+async def test_admission_policy() -> None:
+    cache = Cache("locmem://null", ttl=2 * 60)
+    metrics = InMemoryMetrics()
+    spy = CacheSpy(PlainTextResponse("Hello, world!"))
+    app = CacheMiddleware(
+        spy, cache=cache, metrics=metrics, admission_policy=FrequencyAdmissionPolicy(2),
+    )
+    client = httpx.AsyncClient(app=app, base_url="http://testserver")
+
+    async with cache, client:
+        r = await client.get("/")
+        assert r.status_code == 200
+        assert r.text == "Hello, world!"
+        assert spy.misses == 1
+        assert metrics.get_count("bypasses", reason="infrequent") == 1
+
+        # The response is stored once requested often enough.
+        await client.get("/")
+        assert spy.misses == 2
+        r = await client.get("/")
+        assert r.text == "Hello, world!"
+        assert spy.misses == 2
+        assert metrics.get_count("stores") == 1
+        assert metrics.get_count("bypasses") == 1
+
+
+@pytest.mark.asyncio
+async def test_local_cache(monkeypatch: typing.Any) -> None:
+    """Cache hits should be served from the local cache when possible."""
+    cache = Cache("locmem://null", ttl=2 * 60)
+    spy = CacheSpy(PlainTextResponse("Hello, world!"))
+    local_cache = LocalCache()
+    app = CacheMiddleware(spy, cache=cache, local_cache=local_cache)
+    client = httpx.AsyncClient(app=app, base_url="http://testserver")
+
+    async with cache, client:
+        r = await client.get("/")
+        assert spy.misses == 1
+        assert len(local_cache) == 2
+
+        monkeypatch.setattr(cache, "get_many", None)
+        r1 = await client.get("/")
+        assert spy.misses == 1
+        # ETags are added when storing responses, so only cache hits have one.
+        assert "ETag" not in r.headers
+        assert "ETag" in r1.headers
+        del r1.headers["ETag"]
+        assert ComparableHTTPXResponse(r1) == r
+
+
+@pytest.mark.asyncio
+async def test_writer() -> None:
+    """Responses should be stored in the background when using a writer."""
+    cache = Cache("locmem://null", ttl=2 * 60)
+    spy = CacheSpy(PlainTextResponse("Hello, world!"))
+    writer = CacheWriter()
+    app = CacheMiddleware(spy, cache=cache, writer=writer)
+    client = httpx.AsyncClient(app=app, base_url="http://testserver")
+
+    async with cache, client:
+        r = await client.get("/")
+        assert r.status_code == 200
+        assert r.text == "Hello, world!"
+        assert spy.misses == 1
+
+        await writer.drain()
+        assert writer.written == 1
+
+        r1 = await client.get("/")
+        assert spy.misses == 1
+        # ETags are added when storing responses, so only cache hits have one.
+        assert "ETag" not in r.headers
+        assert "ETag" in r1.headers
+        del r1.headers["ETag"]
+        assert ComparableHTTPXResponse(r1) == r
+
+
+@pytest.mark.asyncio
+async def test_writer_outer_middleware_edits_headers() -> None:
+    """
+    Headers edited by outer middleware should not be stored, even though
+    background writes happen well after the response start was sent.
+    """
+    cache = Cache("locmem://null", ttl=2 * 60)
+    spy = CacheSpy(PlainTextResponse("Hello, world!" * 100))
+    writer = CacheWriter()
+    app = GZipMiddleware(CacheMiddleware(spy, cache=cache, writer=writer))
+    client = httpx.AsyncClient(app=app, base_url="http://testserver")
+
+    async with cache, client:
+        r = await client.get("/", headers={"Accept-Encoding": "gzip"})
+        assert r.headers["Content-Encoding"] == "gzip"
+        assert spy.misses == 1
+
+        await writer.drain()
+        assert writer.written == 1
+
+        r = await client.get("/", headers={"Accept-Encoding": "identity"})
+        assert spy.misses == 1
+        assert "Content-Encoding" not in r.headers
+        assert r.headers["Content-Length"] == "1300"
+        assert r.text == "Hello, world!" * 100
+
+
+@pytest.mark.asyncio
+async def test_writer_lifespan_shutdown() -> None:
+    """Pending writes should be performed before the application shuts down."""
+    cache = Cache("locmem://null", ttl=2 * 60)
+    writer = CacheWriter()
+    received: typing.List[str] = []
+
+    async def app(scope: Scope, receive: Receive, send: Send) -> None:
+        assert scope["type"] == "lifespan"
+        while True:
+            message = await receive()
+            received.append(message["type"])
+            if message["type"] == "lifespan.shutdown":
+                # Writes must have been performed already.
+                assert writer.pending == 0
+                assert writer.written == 1
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+            await send({"type": "lifespan.startup.complete"})
+
+    cached_app = CacheMiddleware(app, cache=cache, writer=writer)
+    messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+
+    async def receive() -> Message:
+        return messages.pop(0)
+
+    async def send(message: Message) -> None:
+        pass
+
+    async def write() -> None:
+        await asyncio.sleep(0.01)
+
+    writer.submit(write)
+    await cached_app({"type": "lifespan"}, receive, send)
+    assert received == ["lifespan.startup", "lifespan.shutdown"]
+
+
+@pytest.mark.asyncio
+async def test_response_start_not_held_back(monkeypatch: typing.Any) -> None:
+    """
+    The response start should be sent as soon as the application sends it,
+    and the response should be stored after it has been sent.
+    """
+    cache = Cache("locmem://null")
+    events: typing.List[str] = []
+
+    async def app(scope: Scope, receive: Receive, send: Send) -> None:
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        assert events == ["http.response.start"]
+        await send({"type": "http.response.body", "body": b"Hello, world!"})
+
+    cached_app = CacheMiddleware(app, cache=cache)
+    scope: Scope = {
+        "type": "http",
+        "method": "GET",
+        "scheme": "http",
+        "server": ("testserver", 80),
+        "path": "/",
+        "query_string": b"",
+        "headers": [(b"host", b"testserver")],
+    }
+
+    async def send(message: Message) -> None:
+        if message["type"] == "http.response.start":
+            assert "Cache-Control" in Headers(raw=message["headers"])
+        events.append(message["type"])
+
+    cache_set = cache.set
+
+    async def set(key: str, value: typing.Any, **kwargs: typing.Any) -> None:
+        events.append(f"set {key}")
+        await cache_set(key, value, **kwargs)
+
+    monkeypatch.setattr(cache, "set", set)
+
+    async with cache:
+        await cached_app(scope, mock_receive, send)
+
+    assert events[:2] == ["http.response.start", "http.response.body"]
+    assert len(events) == 4
+    assert all(event.startswith("set ") for event in events[2:])
+
+
+@pytest.mark.asyncio
+async def test_streaming_response_too_large() -> None:
+    """Responses larger than `max_body_size` should not be cached."""
+    cache = Cache("locmem://null")
+
+    async def body() -> typing.AsyncIterator[str]:
+        yield "Hello, "
+        yield "world!"
+
+    async def app(scope: Scope, receive: Receive, send: Send) -> None:
+        response = StreamingResponse(body())
+        await response(scope, receive, send)
+
+    spy = CacheSpy(app)
+    app = CacheMiddleware(spy, cache=cache, max_body_size=10)
+    client = httpx.AsyncClient(app=app, base_url="http://testserver")
+
+    async with cache, client:
+        r = await client.get("/")
+        assert r.status_code == 200
+        assert r.text == "Hello, world!"
+        assert spy.misses == 1
+
+        r = await client.get("/")
+        assert r.status_code == 200
+        assert r.text == "Hello, world!"
+        assert spy.misses == 2
+
+
+@pytest.mark.asyncio
+async def test_vary() -> None:
+    """
+    Sending different values for request headers registered as varying should
+    result in different cache entries.
+    """
+    cache = Cache("locmem://null")
+
+    async def gzippable_app(scope: Scope, receive: Receive, send: Send) -> None:
+        headers = Headers(scope=scope)
+
+        if "gzip" in headers.getlist("accept-encoding"):
+            body = gzip.compress(b"Hello, world!")
+            response = PlainTextResponse(
+                content=body,
+                headers={"Content-Encoding": "gzip", "Content-Length": str(len(body))},
+            )
+        else:
+            response = PlainTextResponse("Hello, world!")
+
+        response.headers["Vary"] = "Accept-Encoding"
+        await response(scope, receive, send)
+
+    spy = CacheSpy(gzippable_app)
+    app = CacheMiddleware(spy, cache=cache)
+    client = httpx.AsyncClient(app=app, base_url="http://testserver")
+
+    async with cache, client:
+        r = await client.get("/", headers={"accept-encoding": "gzip"})
+        assert spy.misses == 1
+        assert r.status_code == 200
+        assert r.text == "Hello, world!"
+        assert r.headers["content-encoding"] == "gzip"
+        assert "Expires" in r.headers
+        assert "Cache-Control" in r.headers
+
+        # Different "Accept-Encoding" header => the cached result
+        # for "Accept-Encoding: gzip" should not be used.
+        r1 = await client.get("/", headers={"accept-encoding": "identity"})
+        assert spy.misses == 2
+        assert r1.status_code == 200
+        assert r1.text == "Hello, world!"
+        assert "Expires" in r.headers
+        assert "Cache-Control" in r.headers
+
+        # This "Accept-Encoding" header has already been seen => we should
+        # get a cached response.
+        r2 = await client.get("/", headers={"accept-encoding": "gzip"})
+        assert spy.misses == 2
+        assert r.status_code == 200
+        assert r.text == "Hello, world!"
+        assert r2.headers["Content-Encoding"] == "gzip"
+        assert "Expires" in r.headers
+        assert "Cache-Control" in r.headers
+
+
+class SetCookieMiddleware:
+    """Add a session cookie to responses, editing their headers in place."""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        async def send_with_cookie(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                user = Headers(scope=scope)["x-user"]
+                MutableHeaders(scope=message).append("Set-Cookie", f"session={user}")
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
+
+
+@pytest.mark.asyncio
+async def test_outer_middleware_edits_headers() -> None:
+    """
+    Headers added to the sent response by outer middleware should not be stored.
+    """
+    cache = Cache("locmem://null", ttl=2 * 60)
+    spy = CacheSpy(PlainTextResponse("Hello, world!"))
+    app = SetCookieMiddleware(CacheMiddleware(spy, cache=cache))
+    client = httpx.AsyncClient(app=app, base_url="http://testserver")
+
+    async with cache, client:
+        r = await client.get("/", headers={"X-User": "alice"})
+        assert r.headers.getlist("set-cookie") == ["session=alice"]
+        assert spy.misses == 1
+
+        r = await client.get("/", headers={"X-User": "bob"})
+        assert spy.misses == 1
+        assert r.headers.getlist("set-cookie") == ["session=bob"]
+
+
+@pytest.mark.asyncio
+async def test_cookies_in_response_and_cookieless_request() -> None:
+    """
+    Responses that set cookies shouldn't be cached
+    if the request doesn't have cookies.
+    """
+    cache = Cache("locmem://null")
+
+    async def app(scope: Scope, receive: Receive, send: Send) -> None:
+        response = PlainTextResponse("Hello, world!")
+        response.set_cookie("session_id", "1234")
+        await response(scope, receive, send)
+
+    spy = CacheSpy(app)
+    app = CacheMiddleware(spy, cache=cache)
+    client = httpx.AsyncClient(app=app, base_url="http://testserver")
+
+    async with cache, client:
+        r = await client.get("/")
+        assert r.status_code == 200
+        assert r.text == "Hello, world!"
+        assert spy.misses == 1
+
+        r = await client.get("/")
+        assert r.status_code == 200
+        assert r.text == "Hello, world!"
+        assert spy.misses == 2
+
+
+@pytest.mark.asyncio
+async def test_cache_not_connected() -> None:
+    cache = Cache("locmem://null", ttl=2 * 60)
+    app = CacheMiddleware(PlainTextResponse("Hello, world!"), cache=cache)
+    client = httpx.AsyncClient(app=app, base_url="http://testserver")
+
+    async with client:
+        with pytest.raises(CacheNotConnected) as ctx:
+            await client.get("/")
+
+    exc = ctx.value
+    assert exc.cache is cache
+    assert str(cache.url) in str(exc)
+
+
+@pytest.mark.asyncio
+async def test_duplicate_caching() -> None:
+    cache = Cache("locmem://default")
+    special_cache = Cache("locmem://special")
+
+    class DuplicateCache(HTTPEndpoint):
+        pass
+
+    app = Starlette(
+        routes=[
+            Route(
+                "/duplicate_cache", CacheMiddleware(DuplicateCache, cache=special_cache)
+            )
+        ],
+        middleware=[Middleware(CacheMiddleware, cache=cache)],
+    )
+
+    client = httpx.AsyncClient(app=app, base_url="http://testserver")
+
+    async with cache, special_cache, client:
+        with pytest.raises(DuplicateCaching):
+            await client.get("/duplicate_cache")
+
+
+@pytest.mark.asyncio
+async def test_single_flight() -> None:
+    """
+    Concurrent requests that miss on the same resource should result in
+    computing the response only once.
+    """
+    cache = Cache("locmem://null", ttl=2 * 60)
+    release = asyncio.Event()
+
+    async def app(scope: Scope, receive: Receive, send: Send) -> None:
+        await release.wait()
+        response = PlainTextResponse("Hello, world!")
+        await response(scope, receive, send)
+
+    spy = CacheSpy(app)
+    app = CacheMiddleware(spy, cache=cache, single_flight=True)
+    client = httpx.AsyncClient(app=app, base_url="http://testserver")
+
+    async def release_soon() -> None:
+        await asyncio.sleep(0.05)
+        release.set()
+
+    async with cache, client:
+        responses = await asyncio.gather(
+            client.get("/"), client.get("/"), client.get("/"), release_soon()
+        )
+        assert spy.misses == 1
+        for r in responses[:3]:
+            assert r.status_code == 200
+            assert r.text == "Hello, world!"
+            assert "Cache-Control" in r.headers
+
+
+@pytest.mark.asyncio
+async def test_single_flight_key_policy() -> None:
+    """
+    Concurrent requests to URLs that are equivalent as per the key policy
+    should share the computed response.
+    """
+    cache = Cache("locmem://null", ttl=2 * 60)
+    release = asyncio.Event()
+
+    async def app(scope: Scope, receive: Receive, send: Send) -> None:
+        await release.wait()
+        response = PlainTextResponse("Hello, world!")
+        await response(scope, receive, send)
+
+    spy = CacheSpy(app)
+    app = CacheMiddleware(
+        spy,
+        cache=cache,
+        single_flight=True,
+        key_policy=KeyPolicy(exclude_query=["utm_*"]),
+    )
+    client = httpx.AsyncClient(app=app, base_url="http://testserver")
+
+    async def release_soon() -> None:
+        await asyncio.sleep(0.05)
+        release.set()
+
+    async with cache, client:
+        responses = await asyncio.gather(
+            client.get("/?page=1"),
+            client.get("/?page=1&utm_source=newsletter"),
+            client.get("/?utm_medium=email&page=1"),
+            release_soon(),
+        )
+        assert spy.misses == 1
+        for r in responses[:3]:
+            assert r.status_code == 200
+            assert r.text == "Hello, world!"
+
+
+@pytest.mark.asyncio
+async def test_single_flight_writer() -> None:
+    """
+    With a background writer, concurrent requests should be served from
+    the cache once the response has been stored.
+    """
+    cache = Cache("locmem://null", ttl=2 * 60)
+    release = asyncio.Event()
+
+    async def app(scope: Scope, receive: Receive, send: Send) -> None:
+        await release.wait()
+        response = PlainTextResponse("Hello, world!")
+        await response(scope, receive, send)
+
+    spy = CacheSpy(app)
+    writer = CacheWriter()
+    app = CacheMiddleware(spy, cache=cache, single_flight=True, writer=writer)
+    client = httpx.AsyncClient(app=app, base_url="http://testserver")
+
+    async def release_soon() -> None:
+        await asyncio.sleep(0.05)
+        release.set()
+
+    async with cache, client:
+        responses = await asyncio.gather(
+            client.get("/"), client.get("/"), client.get("/"), release_soon()
+        )
+        assert spy.misses == 1
+        for r in responses[:3]:
+            assert r.status_code == 200
+            assert r.text == "Hello, world!"
+        await writer.drain()
+
+    assert writer.written == 1
+
+
+@pytest.mark.asyncio
+async def test_single_flight_not_cachable() -> None:
+    """
+    Concurrent requests waiting for a response that could not be cached
+    should fall through to the application.
+    """
+    cache = Cache("locmem://null", ttl=2 * 60)
+    release = asyncio.Event()
+
+    async def app(scope: Scope, receive: Receive, send: Send) -> None:
+        await release.wait()
+        response = PlainTextResponse("Error", status_code=500)
+        await response(scope, receive, send)
+
+    spy = CacheSpy(app)
+    app = CacheMiddleware(spy, cache=cache, single_flight=True)
+    client = httpx.AsyncClient(app=app, base_url="http://testserver")
+
+    async def release_soon() -> None:
+        await asyncio.sleep(0.05)
+        release.set()
+
+    async with cache, client:
+        responses = await asyncio.gather(
+            client.get("/"), client.get("/"), release_soon()
+        )
+        assert spy.misses == 2
+        for r in responses[:2]:
+            assert r.status_code == 500
+            assert "Cache-Control" not in r.headers
+
+
+@pytest.mark.parametrize(
+    "headers, max_body_size",
+    [([(b"set-cookie", b"session=123")], None), ([], 4)],
+    ids=["set_cookie", "body_too_large"],
+)
+@pytest.mark.asyncio
+async def test_single_flight_released_on_bypass(
+    headers: typing.List[typing.Tuple[bytes, bytes]],
+    max_body_size: typing.Optional[int],
+) -> None:
+    """
+    Concurrent requests should stop waiting as soon as the response is known
+    not to be cached, instead of waiting for the end of its body.
+    """
+    cache = Cache("locmem://null", ttl=2 * 60)
+    finish = asyncio.Event()
+    calls = 0
+
+    async def app(scope: Scope, receive: Receive, send: Send) -> None:
+        nonlocal calls
+        calls += 1
+        if calls > 1:
+            await PlainTextResponse("Hello, world!")(scope, receive, send)
+            return
+        # Stream a response until the concurrent request has been served.
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        await send({"type": "http.response.body", "body": b"Hello", "more_body": True})
+        await finish.wait()
+        await send({"type": "http.response.body", "body": b", world!"})
+
+    app = CacheMiddleware(
+        app, cache=cache, single_flight=True, max_body_size=max_body_size
+    )
+    client = httpx.AsyncClient(app=app, base_url="http://testserver")
+
+    async def concurrent_get() -> httpx.AsyncResponse:
+        await asyncio.sleep(0.05)
+        response = await asyncio.wait_for(client.get("/"), timeout=1)
+        finish.set()
+        return response
+
+    async with cache, client:
+        first, second = await asyncio.gather(client.get("/"), concurrent_get())
+        assert first.text == second.text == "Hello, world!"
+        assert calls == 2
+        assert app.inflight == {}
+
+
+@pytest.mark.asyncio
+async def test_stale_while_revalidate(monkeypatch: typing.Any) -> None:
+    """
+    Stale responses allowing `stale-while-revalidate` should be served right away,
+    while a single background request refreshes the cache.
+    """
+    cache = Cache("locmem://null", ttl=2 * 60)
+    calls = 0
+    release = asyncio.Event()
+
+    async def app(scope: Scope, receive: Receive, send: Send) -> None:
+        nonlocal calls
+        calls += 1
+        if calls > 1:
+            await release.wait()
+        response = PlainTextResponse(
+            f"Hello, {calls}!", headers={"Cache-Control": "stale-while-revalidate=60"}
+        )
+        await response(scope, receive, send)
+
+    cached_app = CacheMiddleware(app, cache=cache)
+    client = httpx.AsyncClient(app=cached_app, base_url="http://testserver")
+
+    async with cache, client:
+        r = await client.get("/")
+        assert r.text == "Hello, 1!"
+        assert calls == 1
+
+        travel(monkeypatch, 150)
+
+        r = await client.get("/")
+        assert r.text == "Hello, 1!"
+        assert len(cached_app.revalidating) == 1
+
+        # Revalidation is already in progress.
+        r = await client.head("/")
+        assert r.status_code == 200
+        assert len(cached_app.revalidating) == 1
+
+        release.set()
+        await asyncio.gather(*cached_app.revalidating.values())
+        assert not cached_app.revalidating
+        assert calls == 2
+
+        r = await client.get("/")
+        assert r.text == "Hello, 2!"
+        assert calls == 2
+
+
+@pytest.mark.asyncio
+async def test_stale_while_revalidate_failure(monkeypatch: typing.Any) -> None:
+    cache = Cache("locmem://null", ttl=2 * 60)
+    calls = 0
+
+    async def app(scope: Scope, receive: Receive, send: Send) -> None:
+        nonlocal calls
+        calls += 1
+        if calls > 1:
+            raise RuntimeError("Something went wrong")
+        response = PlainTextResponse(
+            "Hello, world!", headers={"Cache-Control": "stale-while-revalidate=60"}
+        )
+        await response(scope, receive, send)
+
+    cached_app = CacheMiddleware(app, cache=cache)
+    client = httpx.AsyncClient(app=cached_app, base_url="http://testserver")
+
+    async with cache, client:
+        await client.get("/")
+        travel(monkeypatch, 150)
+
+        r = await client.get("/")
+        assert r.text == "Hello, world!"
+        await asyncio.gather(*cached_app.revalidating.values())
+        assert not cached_app.revalidating
+        assert calls == 2
+
+        # The stale response is still there.
+        r = await client.get("/")
+        assert r.text == "Hello, world!"
+
+
+@pytest.mark.asyncio
+async def test_stale_if_error(monkeypatch: typing.Any) -> None:
+    """
+    Stale responses allowing `stale-if-error` should be served
+    if the application fails.
+    """
+    cache = Cache("locmem://null", ttl=2 * 60)
+    calls = 0
+
+    async def app(scope: Scope, receive: Receive, send: Send) -> None:
+        nonlocal calls
+        calls += 1
+        if calls == 2:
+            response = PlainTextResponse("Error", status_code=500)
+        elif calls == 3:
+            raise RuntimeError("Something went wrong")
+        else:
+            response = PlainTextResponse(
+                f"Hello, {calls}!", headers={"Cache-Control": "stale-if-error=60"}
+            )
+        await response(scope, receive, send)
+
+    client = httpx.AsyncClient(
+        app=CacheMiddleware(app, cache=cache), base_url="http://testserver"
+    )
+
+    async with cache, client:
+        r = await client.get("/")
+        assert r.text == "Hello, 1!"
+
+        travel(monkeypatch, 150)
+
+        r = await client.get("/")
+        assert r.status_code == 200
+        assert r.text == "Hello, 1!"
+        assert calls == 2
+
+        r = await client.get("/")
+        assert r.status_code == 200
+        assert r.text == "Hello, 1!"
+        assert calls == 3
+
+        r = await client.get("/")
+        assert r.text == "Hello, 4!"
+        assert calls == 4
+
+        r = await client.get("/")
+        assert r.text == "Hello, 4!"
+        assert calls == 4
+
+        # Past the 'stale-if-error' window, the response can't be used anymore.
+        travel(monkeypatch, 150 + 120 + 61)
+        r = await client.get("/")
+        assert r.text == "Hello, 5!"
+        assert calls == 5
+
+
+@pytest.mark.asyncio
+async def test_stale_if_error_response_started(monkeypatch: typing.Any) -> None:
+    """
+    Stale responses can't be used if the application failed after
+    starting to send its response.
+    """
+    cache = Cache("locmem://null", ttl=2 * 60)
+    calls = 0
+
+    async def app(scope: Scope, receive: Receive, send: Send) -> None:
+        nonlocal calls
+        calls += 1
+        if calls > 1:
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": b"He", "more_body": True})
+            raise RuntimeError("Something went wrong")
+        response = PlainTextResponse(
+            "Hello, world!", headers={"Cache-Control": "stale-if-error=60"}
+        )
+        await response(scope, receive, send)
+
+    cached_app = CacheMiddleware(app, cache=cache)
+    client = httpx.AsyncClient(app=cached_app, base_url="http://testserver")
+    scope: Scope = {
+        "type": "http",
+        "method": "GET",
+        "scheme": "http",
+        "server": ("testserver", 80),
+        "path": "/",
+        "query_string": b"",
+        "headers": [(b"host", b"testserver")],
+    }
+    messages: typing.List[Message] = []
+
+    async def send(message: Message) -> None:
+        messages.append(message)
+
+    async with cache, client:
+        await client.get("/")
+        travel(monkeypatch, 150)
+        with pytest.raises(RuntimeError):
+            await cached_app(scope, mock_receive, send)
+
+    assert [message["type"] for message in messages] == [
+        "http.response.start",
+        "http.response.body",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_revalidation_receive() -> None:
+    receive = make_revalidation_receive()
+    message = await receive()
+    assert message == {"type": "http.request", "body": b"", "more_body": False}
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(receive(), timeout=0.01)
@@ -0,0 +1,122 @@
+import sys
+import typing
+
+import pytest
+
+from asgi_caches.compression import (
+    BrotliCodec,
+    Codec,
+    DeflateCodec,
+    GzipCodec,
+    ZstdCodec,
+    accepts_encoding,
+    get_codec,
+    is_compressible,
+    select_codec,
+)
+
+
+@pytest.mark.parametrize(
+    "codec, name",
+    [
+        pytest.param(GzipCodec(), "gzip", id="gzip"),
+        pytest.param(DeflateCodec(), "deflate", id="deflate"),
+        pytest.param(BrotliCodec(), "br", id="br"),
+        pytest.param(ZstdCodec(), "zstd", id="zstd"),
+    ],
+)
+def test_codec(codec: Codec, name: str) -> None:
+    data = b"Hello, world!" * 100
+    compressed = codec.compress(data)
+    assert len(compressed) < len(data)
+    assert codec.name == name
+
+    decoder = get_codec(name)
+    assert decoder is not None
+    assert decoder.decompress(compressed) == data
+
+
+def test_gzip_codec_format() -> None:
+    import gzip
+    import zlib
+
+    data = b"Hello, world!"
+    assert gzip.decompress(GzipCodec().compress(data)) == data
+    assert zlib.decompress(DeflateCodec().compress(data)) == data
+
+
+def test_get_codec_unknown() -> None:
+    assert get_codec("compress") is None
+
+
+def test_get_codec_not_installed(monkeypatch: typing.Any) -> None:
+    monkeypatch.setitem(sys.modules, "brotli", None)
+    get_codec.cache_clear()
+    try:
+        assert get_codec("br") is None
+    finally:
+        get_codec.cache_clear()
+
+
+@pytest.mark.parametrize(
+    "headers, result",
+    [
+        pytest.param([], True, id="empty"),
+        pytest.param([(b"content-type", b"text/html")], True, id="plain"),
+        pytest.param([(b"content-encoding", b"identity")], True, id="identity"),
+        pytest.param([(b"content-encoding", b"gzip")], False, id="encoded"),
+        pytest.param(
+            [(b"cache-control", b"max-age=60, no-transform")], False, id="no-transform"
+        ),
+    ],
+)
+def test_is_compressible(
+    headers: typing.List[typing.Tuple[bytes, bytes]], result: bool
+) -> None:
+    assert is_compressible(headers) is result
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, result",
+    [
+        pytest.param(None, False, id="missing"),
+        pytest.param(b"gzip", True, id="exact"),
+        pytest.param(b"br, gzip;q=0.5", True, id="quality"),
+        pytest.param(b"gzip;q=0", False, id="refused"),
+        pytest.param(b"*", True, id="wildcard"),
+        pytest.param(b"*, gzip;q=0", False, id="wildcard-refused"),
+        pytest.param(b"br", False, id="other"),
+    ],
+)
+def test_accepts_encoding(
+    accept_encoding: typing.Optional[bytes], result: bool
+) -> None:
+    headers = [(b"host", b"testserver")]
+    if accept_encoding is not None:
+        headers.append((b"accept-encoding", accept_encoding))
+    assert accepts_encoding(headers, "gzip") is result
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, preferred, result",
+    [
+        pytest.param(None, None, None, id="missing"),
+        pytest.param(b"identity", None, None, id="identity"),
+        pytest.param(b"gzip", None, "gzip", id="single"),
+        pytest.param(b"gzip, br", None, "br", id="order"),
+        pytest.param(b"gzip, br;q=0.5", None, "gzip", id="quality"),
+        pytest.param(b"gzip, br", "gzip", "gzip", id="preferred"),
+        pytest.param(b"gzip;q=0.5, br", "gzip", "br", id="preferred-quality"),
+        pytest.param(b"gzip, br", "deflate", "br", id="preferred-unknown"),
+    ],
+)
+def test_select_codec(
+    accept_encoding: typing.Optional[bytes],
+    preferred: typing.Optional[str],
+    result: typing.Optional[str],
+) -> None:
+    headers = [(b"host", b"testserver")]
+    if accept_encoding is not None:
+        headers.append((b"accept-encoding", accept_encoding))
+    codec = select_codec([BrotliCodec(), GzipCodec()], headers, preferred)
+    assert (None if codec is None else codec.name) == result
@@ -0,0 +1,223 @@
+import math
+import time
+import typing
+
+import pytest
+from caches import Cache
+from starlette.requests import Request
+from starlette.types import Scope
+
+from asgi_caches import invalidation
+from asgi_caches.invalidation import (
+    generate_path_index_key,
+    generate_tag_index_key,
+    get_index_shard_keys,
+    get_path_prefixes,
+    get_tags,
+    index_cached_response,
+    invalidate,
+)
+from asgi_caches.local import LocalCache
+from asgi_caches.responses import CachedResponse
+from asgi_caches.utils.cache import get_cached_response, store_cached_response
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.fixture(name="cache")
+async def fixture_cache() -> typing.AsyncIterator[Cache]:
+    async with Cache("locmem://null") as cache:
+        yield cache
+
+
+def make_request(path: str, root_path: str = "") -> Request:
+    scope: Scope = {
+        "type": "http",
+        "method": "GET",
+        "root_path": root_path,
+        "path": path,
+        "headers": [],
+    }
+    return Request(scope)
+
+
+def make_response(
+    headers: typing.Sequence[typing.Tuple[bytes, bytes]] = (),
+    fresh_until: float = math.inf,
+) -> CachedResponse:
+    return CachedResponse(
+        status_code=200, headers=list(headers), body=b"Hello", fresh_until=fresh_until
+    )
+
+
+@pytest.mark.parametrize(
+    "header, tags",
+    [
+        (None, []),
+        (b"articles", ["articles"]),
+        (b"articles, article-1,,", ["articles", "article-1"]),
+    ],
+)
+async def test_get_tags(header: typing.Optional[bytes], tags: typing.List[str]) -> None:
+    headers = [] if header is None else [(b"cache-tag", header)]
+    assert get_tags(make_response(headers)) == tags
+
+
+@pytest.mark.parametrize(
+    "path, prefixes",
+    [
+        ("/", ["/"]),
+        ("/articles", ["/", "/articles"]),
+        ("/articles/1/", ["/", "/articles", "/articles/1"]),
+    ],
+)
+async def test_get_path_prefixes(path: str, prefixes: typing.List[str]) -> None:
+    assert get_path_prefixes(path) == prefixes
+
+
+async def test_generate_path_index_key() -> None:
+    assert generate_path_index_key("/articles/") == generate_path_index_key("/articles")
+
+
+async def test_invalidate_tags(cache: Cache) -> None:
+    local_cache = LocalCache()
+    requests = [make_request(f"/articles/{index}") for index in range(3)]
+
+    for index, request in enumerate(requests):
+        headers = [(b"cache-tag", f"article-{index}".encode())]
+        await store_cached_response(
+            make_response(headers, fresh_until=10 ** 10),
+            request=request,
+            cache=cache,
+            local_cache=local_cache,
+            tags=["articles"],
+        )
+
+    assert await invalidate(cache, tags=["article-1"], local_cache=local_cache) == 1
+    assert await get_cached_response(requests[1], cache=cache) is None
+    assert (
+        await get_cached_response(requests[1], cache=cache, local_cache=local_cache)
+        is None
+    )
+    assert await get_cached_response(requests[0], cache=cache) is not None
+
+    assert await invalidate(cache, tags=["articles", "unknown"]) == 3
+    for request in requests:
+        assert await get_cached_response(request, cache=cache) is None
+
+    # Indexes are deleted too.
+    assert await invalidate(cache, tags=["articles"]) == 0
+    assert await invalidate(cache) == 0
+
+
+async def test_invalidate_path_prefix(cache: Cache) -> None:
+    local_cache = LocalCache()
+    paths = ["/", "/articles", "/articles/1", "/articles/2", "/articlesfoo"]
+    for path in paths:
+        await store_cached_response(
+            make_response(),
+            request=make_request(path),
+            cache=cache,
+            local_cache=local_cache,
+            index_paths=True,
+        )
+    # Responses aren't all registered in a single index.
+    shard_keys = get_index_shard_keys(generate_path_index_key("/"))
+    assert not any((await cache.get_many(shard_keys)).values())
+
+    assert await invalidate(cache, path_prefix="/articles/1/") == 1
+    # NOTE: indexes of parent paths still list the deleted response.
+    assert await invalidate(cache, path_prefix="/articles") == 3
+    assert await get_cached_response(make_request("/articles"), cache=cache) is None
+    assert (
+        await get_cached_response(make_request("/articlesfoo"), cache=cache) is not None
+    )
+    # Responses are not indexed under '/', so it can't be invalidated.
+    local_size = len(local_cache)
+    for path_prefix in ("", "/", "//"):
+        with pytest.raises(ValueError):
+            await invalidate(cache, path_prefix=path_prefix, local_cache=local_cache)
+    assert len(local_cache) == local_size
+    assert await get_cached_response(make_request("/"), cache=cache) is not None
+
+
+async def test_invalidate_path_prefix_root_path(cache: Cache) -> None:
+    request = make_request("/articles/1", root_path="/blog")
+    await store_cached_response(
+        make_response(), request=request, cache=cache, index_paths=True
+    )
+
+    assert await invalidate(cache, path_prefix="/articles") == 0
+    assert await invalidate(cache, path_prefix="/blog/articles") == 1
+    assert await get_cached_response(request, cache=cache) is None
+
+
+async def test_index_shards(cache: Cache) -> None:
+    for index in range(100):
+        await index_cached_response(
+            f"key-{index}",
+            make_response(),
+            request=make_request("/"),
+            cache=cache,
+            tags=["tag"],
+        )
+
+    # Responses with the same tag are spread across shards of the index.
+    shards = await cache.get_many(get_index_shard_keys(generate_tag_index_key("tag")))
+    assert sum(len(shard) for shard in shards.values() if shard) == 100
+    assert max(len(shard) for shard in shards.values() if shard) < 100
+
+    assert await invalidate(cache, tags=["tag"]) == 100
+    assert not any((await cache.get_many(list(shards))).values())
+
+
+async def test_index_expiry(cache: Cache, monkeypatch: typing.Any) -> None:
+    # Register all keys in the same shard.
+    monkeypatch.setattr(invalidation, "INDEX_SHARDS", 1)
+    spy_ttls: typing.List[typing.Optional[int]] = []
+    set_many = cache.set_many
+
+    async def spy(mapping: dict, ttl: typing.Optional[int] = None) -> None:
+        spy_ttls.append(ttl)
+        await set_many(mapping, ttl=ttl)
+
+    monkeypatch.setattr(cache, "set_many", spy)
+    now = 10 ** 9
+    monkeypatch.setattr(time, "time", lambda: now)
+
+    await index_cached_response(
+        "a",
+        make_response(fresh_until=now + 60),
+        request=make_request("/"),
+        cache=cache,
+        tags=["tag"],
+    )
+    await index_cached_response(
+        "b",
+        make_response(fresh_until=now + 30),
+        request=make_request("/"),
+        cache=cache,
+        tags=["tag"],
+    )
+    # Indexes are kept as long as the longest-lived response.
+    assert spy_ttls == [60, 60]
+
+    # Expired keys are pruned.
+    monkeypatch.setattr(time, "time", lambda: now + 45)
+    await index_cached_response(
+        "c",
+        make_response(fresh_until=now + 50),
+        request=make_request("/"),
+        cache=cache,
+        tags=["tag"],
+    )
+    assert spy_ttls[-1] == 15
+    [shard_key] = get_index_shard_keys(generate_tag_index_key("tag"))
+    index = await cache.get(shard_key)
+    assert set(index) == {"a", "c"}
+
+    # Nothing to index.
+    await index_cached_response(
+        "d", make_response(), request=make_request("/"), cache=cache
+    )
+    assert len(spy_ttls) == 3
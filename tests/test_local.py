@@ -0,0 +1,91 @@
+import time
+import typing
+
+from asgi_caches.local import DEFAULT_TTL, ENTRY_OVERHEAD, LocalCache, get_size
+from asgi_caches.responses import CachedResponse
+from tests.utils import travel
+
+
+def test_local_cache() -> None:
+    local_cache = LocalCache()
+    assert local_cache.get("key") is None
+
+    local_cache.set("key", ["accept-encoding"])
+    assert local_cache.get("key") == ["accept-encoding"]
+    assert len(local_cache) == 1
+    assert local_cache.size == ENTRY_OVERHEAD + len("accept-encoding")
+
+    local_cache.set("key", [])
+    assert local_cache.get("key") == []
+    assert len(local_cache) == 1
+    assert local_cache.size == ENTRY_OVERHEAD
+
+    local_cache.delete("key")
+    assert local_cache.get("key") is None
+    assert local_cache.size == 0
+
+    local_cache.set("key", [])
+    local_cache.clear()
+    assert len(local_cache) == 0
+    assert local_cache.size == 0
+
+
+def test_local_cache_expiry(monkeypatch: typing.Any) -> None:
+    local_cache = LocalCache(ttl=60)
+    now = time.time()
+
+    local_cache.set("key", [], expires_at=now + 30)
+    local_cache.set("other", [], expires_at=now + 120)
+    travel(monkeypatch, 31)
+    assert local_cache.get("key") is None
+    assert local_cache.get("other") == []
+
+    # Entries are kept for at most 'ttl' seconds.
+    travel(monkeypatch, 61)
+    assert local_cache.get("other") is None
+    assert local_cache.size == 0
+
+
+def test_local_cache_default_ttl(monkeypatch: typing.Any) -> None:
+    # Entries may be replaced or invalidated by other processes.
+    local_cache = LocalCache()
+    local_cache.set("key", [])
+    travel(monkeypatch, DEFAULT_TTL + 1)
+    assert local_cache.get("key") is None
+
+    local_cache = LocalCache(ttl=None)
+    local_cache.set("key", [])
+    travel(monkeypatch, 365 * 24 * 60 * 60)
+    assert local_cache.get("key") == []
+
+
+def test_local_cache_eviction() -> None:
+    local_cache = LocalCache(max_size=3 * ENTRY_OVERHEAD)
+    for key in ("a", "b", "c"):
+        local_cache.set(key, [])
+    assert len(local_cache) == 3
+
+    # Least recently used entries are evicted first.
+    assert local_cache.get("a") == []
+    local_cache.set("d", [])
+    assert len(local_cache) == 3
+    assert local_cache.get("b") is None
+    assert local_cache.get("a") == []
+
+    local_cache.set("e", ["x" * ENTRY_OVERHEAD])
+    assert len(local_cache) == 2
+    assert local_cache.get("c") is None
+    assert local_cache.size <= local_cache.max_size
+
+    # Entries larger than the cache itself are not stored.
+    local_cache.set("f", ["x" * 3 * ENTRY_OVERHEAD])
+    assert local_cache.get("f") is None
+    assert len(local_cache) == 2
+
+
+def test_get_size() -> None:
+    response = CachedResponse(
+        status_code=200, headers=[(b"content-length", b"5")], body=b"Hello"
+    )
+    assert get_size(response) == ENTRY_OVERHEAD + 5 + len("content-length") + 1
+    assert get_size(["cookie", "accept"]) == ENTRY_OVERHEAD + 12
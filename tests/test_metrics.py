@@ -0,0 +1,151 @@
+import typing
+
+import prometheus_client
+import pytest
+from prometheus_client import CollectorRegistry
+from starlette.applications import Starlette
+from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import PlainTextResponse
+from starlette.routing import Mount, Route
+from starlette.types import Scope
+
+import asgi_caches.metrics
+from asgi_caches.metrics import (
+    LATENCY_BUCKETS,
+    UNKNOWN_ROUTE,
+    Histogram,
+    InMemoryMetrics,
+    PrometheusMetrics,
+    get_route_template,
+)
+
+
+async def endpoint(request: typing.Any) -> PlainTextResponse:
+    return PlainTextResponse("Hello, world!")  # pragma: no cover
+
+
+app = Starlette(
+    routes=[
+        Route("/", endpoint),
+        Route("/users/{id:int}", endpoint),
+        Mount(
+            "/api",
+            routes=[
+                Route("/items/{id}", endpoint),
+                Mount("/static", app=PlainTextResponse("Static")),
+            ],
+        ),
+    ]
+)
+
+
+def make_scope(path: str, **kwargs: typing.Any) -> Scope:
+    return {
+        "type": "http",
+        "method": "GET",
+        "path": path,
+        "root_path": "",
+        "headers": [],
+        "app": app,
+        **kwargs,
+    }
+
+
+@pytest.mark.parametrize(
+    "path, template",
+    [
+        ("/", "/"),
+        ("/users/1", "/users/{id:int}"),
+        ("/users/me", None),
+        ("/api/items/1", "/api/items/{id}"),
+        ("/api/static/style.css", "/api/static"),
+        ("/api/users/1", None),
+    ],
+)
+def test_get_route_template(path: str, template: typing.Optional[str]) -> None:
+    assert get_route_template(make_scope(path)) == template
+
+
+def test_get_route_template_no_app() -> None:
+    assert get_route_template(make_scope("/", app=None)) is None
+
+
+def test_get_route_template_wrapped_app() -> None:
+    # The application may not be in the scope yet, e.g. when wrapped in middleware.
+    middleware = CORSMiddleware(GZipMiddleware(app))
+    scope = make_scope("/users/1", app=None)
+    assert get_route_template(scope, middleware) == "/users/{id:int}"
+    endpoint_app = PlainTextResponse("Hello, world!")
+    assert get_route_template(scope, endpoint_app) is None
+    assert get_route_template(make_scope("/users/1"), endpoint_app) == "/users/{id:int}"
+
+
+def test_get_route(monkeypatch: typing.Any) -> None:
+    monkeypatch.setattr(asgi_caches.metrics, "MAX_MEMOIZED_ROUTES", 2)
+    metrics = InMemoryMetrics()
+    assert metrics.get_route(make_scope("/users/1")) == "/users/{id:int}"
+    assert metrics.get_route(make_scope("/users/1")) == "/users/{id:int}"
+    assert metrics.get_route(make_scope("/users/me")) == UNKNOWN_ROUTE
+    assert metrics.get_route(make_scope("/users/2")) == "/users/{id:int}"
+    assert len(metrics._routes) == 1
+
+
+def test_histogram() -> None:
+    histogram = Histogram([1, 10])
+    for value in (0.5, 1, 5, 100):
+        histogram.observe(value)
+    assert histogram.buckets == [2, 1, 1]
+    assert histogram.count == 4
+    assert histogram.sum == 106.5
+
+
+def test_in_memory_metrics() -> None:
+    metrics = InMemoryMetrics()
+    metrics.increment("hits", {"route": "/"})
+    metrics.increment("hits", {"route": "/"})
+    metrics.increment("hits", {"route": "/users/{id}"})
+    metrics.increment("bypasses", {"route": "/", "reason": "method"})
+    metrics.observe("lookup_seconds", 0.002, {"route": "/"})
+
+    assert metrics.get_count("hits") == 3
+    assert metrics.get_count("hits", route="/") == 2
+    assert metrics.get_count("bypasses", reason="method") == 1
+    assert metrics.get_count("bypasses", reason="status_code") == 0
+    assert metrics.get_count("misses") == 0
+
+    histogram = metrics.get_histogram("lookup_seconds", route="/")
+    assert histogram is not None
+    assert histogram.bounds == LATENCY_BUCKETS
+    assert histogram.count == 1
+    assert metrics.get_histogram("lookup_seconds", route="/users/{id}") is None
+
+
+def test_prometheus_metrics() -> None:
+    registry = CollectorRegistry()
+    metrics = PrometheusMetrics(registry=registry)
+    metrics.increment("hits", {"route": "/"})
+    metrics.increment("bypasses", {"route": "/", "reason": "method"})
+    metrics.observe("entry_size_bytes", 2048, {"route": "/"})
+
+    assert registry.get_sample_value("asgi_caches_hits_total", {"route": "/"}) == 1
+    assert (
+        registry.get_sample_value(
+            "asgi_caches_bypasses_total", {"route": "/", "reason": "method"}
+        )
+        == 1
+    )
+    assert (
+        registry.get_sample_value(
+            "asgi_caches_entry_size_bytes_bucket", {"route": "/", "le": "4096.0"}
+        )
+        == 1
+    )
+
+
+def test_prometheus_metrics_default_registry(monkeypatch: typing.Any) -> None:
+    registry = CollectorRegistry()
+    monkeypatch.setattr(prometheus_client, "REGISTRY", registry)
+    metrics = PrometheusMetrics(namespace="app_cache")
+    metrics.increment("misses", {"route": "/"})
+    assert registry.get_sample_value("app_cache_misses_total", {"route": "/"}) == 1
@@ -0,0 +1,202 @@
+import typing
+
+import pytest
+from starlette.types import Scope
+
+from asgi_caches.policies import (
+    AcceptEncodingNormalizer,
+    AcceptLanguageNormalizer,
+    AcceptNormalizer,
+    FrequencyAdmissionPolicy,
+    KeyPolicy,
+    Normalizer,
+    normalize_host,
+    parse_accept_header,
+)
+from asgi_caches.responses import CachedResponse
+from tests.utils import travel
+
+
+@pytest.mark.parametrize(
+    "policy, query_string, normalized",
+    [
+        (KeyPolicy(), b"", b""),
+        (KeyPolicy(), b"b=2&a=1", b"a=1&b=2"),
+        (KeyPolicy(), b"a=2&b=1&a=1", b"a=2&a=1&b=1"),
+        (KeyPolicy(), b"a&b=", b"a=&b="),
+        (KeyPolicy(), b"q=hello+world", b"q=hello+world"),
+        (KeyPolicy(), b"q=hello%20world", b"q=hello+world"),
+        (KeyPolicy(), b"id=%ff", b"id=%FF"),
+        (KeyPolicy(), b"id=%fe", b"id=%FE"),
+        (KeyPolicy(), b"q=caf%C3%A9", b"q=caf%C3%A9"),
+        (KeyPolicy(exclude_query=["caf\u00e9"]), b"caf%C3%A9=1&a=2", b"a=2"),
+        (KeyPolicy(sort_query=False), b"b=2&a=1", b"b=2&a=1"),
+        (KeyPolicy(sort_query=False, exclude_query=["b"]), b"b=2&a=1", b"a=1"),
+        (
+            KeyPolicy(exclude_query=["utm_*", "fbclid"]),
+            b"utm_source=x&page=2&fbclid=y&utm_medium=z",
+            b"page=2",
+        ),
+        (KeyPolicy(exclude_query=["utm_*"]), b"UTM_source=x", b"UTM_source=x"),
+        (
+            KeyPolicy(include_query=["page", "q*"]),
+            b"q=a&query=b&x=1&page=2",
+            b"page=2&q=a&query=b",
+        ),
+        (KeyPolicy(include_query=[]), b"a=1&b=2", b""),
+        (KeyPolicy(include_query=["*"], exclude_query=["_"]), b"_=123&a=1", b"a=1",),
+    ],
+)
+def test_normalize_query_string(
+    policy: KeyPolicy, query_string: bytes, normalized: bytes
+) -> None:
+    assert policy.normalize_query_string(query_string) == normalized
+
+
+def test_normalize_query_string_distinct_escapes() -> None:
+    # Invalid UTF-8 escapes must not collapse into the same cache key.
+    policy = KeyPolicy()
+    first = policy.normalize_query_string(b"id=%ff")
+    second = policy.normalize_query_string(b"id=%fe")
+    assert first != second
+
+
+@pytest.mark.parametrize(
+    "host, scheme, normalized",
+    [
+        (b"example.org", "http", b"example.org"),
+        (b"Example.ORG", "http", b"example.org"),
+        (b"example.org.", "http", b"example.org"),
+        (b"example.org:80", "http", b"example.org"),
+        (b"example.org.:443", "https", b"example.org"),
+        (b"example.org:443", "http", b"example.org:443"),
+        (b"Example.org.:8000", "http", b"example.org:8000"),
+        (b"[::1]", "http", b"[::1]"),
+        (b"[::1]:80", "http", b"[::1]"),
+        (b"[::1]:8000", "http", b"[::1]:8000"),
+    ],
+)
+def test_normalize_host(host: bytes, scheme: str, normalized: bytes) -> None:
+    assert normalize_host(host, scheme) == normalized
+
+
+def test_normalize_url() -> None:
+    url = ("https", b"Example.org:443", b"b=2&a=1")
+    assert KeyPolicy().normalize_url(*url) == ("https", b"Example.org:443", b"a=1&b=2")
+    assert KeyPolicy(normalize_host=True, ignore_scheme=True).normalize_url(*url) == (
+        "",
+        b"example.org",
+        b"a=1&b=2",
+    )
+
+
+def test_parse_accept_header() -> None:
+    assert parse_accept_header(b"") == []
+    assert parse_accept_header(b"GZIP, br;q=0.8 , ,*;Q=0, x;q=oops") == [
+        ("gzip", 1.0),
+        ("br", 0.8),
+        ("*", 0.0),
+        ("x", 0.0),
+    ]
+    assert parse_accept_header(b"text/html;level=1;q=0.5") == [("text/html", 0.5)]
+
+
+@pytest.mark.parametrize(
+    "normalizer, value, normalized",
+    [
+        (AcceptEncodingNormalizer(), b"", b"identity"),
+        (AcceptEncodingNormalizer(), b"gzip, deflate, br", b"br"),
+        (AcceptEncodingNormalizer(), b"br, gzip", b"br"),
+        (AcceptEncodingNormalizer(), b"gzip, deflate", b"gzip"),
+        (AcceptEncodingNormalizer(), b"br;q=0.5, gzip", b"gzip"),
+        (AcceptEncodingNormalizer(), b"*", b"br"),
+        (AcceptEncodingNormalizer(), b"*, br;q=0", b"gzip"),
+        (AcceptEncodingNormalizer(), b"deflate", b"identity"),
+        (AcceptEncodingNormalizer(["gzip"]), b"gzip, deflate, br", b"gzip"),
+        (AcceptLanguageNormalizer(["en", "fr"]), b"", b"en"),
+        (AcceptLanguageNormalizer(["en", "fr"]), b"fr-CH, fr;q=0.9, en;q=0.8", b"fr"),
+        (AcceptLanguageNormalizer(["en", "fr"]), b"de, en-US;q=0.5", b"en"),
+        (AcceptLanguageNormalizer(["en", "fr"]), b"de", b"en"),
+        (AcceptLanguageNormalizer(["en", "fr"]), b"*;q=0.1, fr", b"fr"),
+        (AcceptLanguageNormalizer(["en-GB", "en-US"]), b"en;q=0.5, en-us", b"en-us"),
+        (AcceptNormalizer(["application/json", "text/html"]), b"", b"application/json"),
+        (
+            AcceptNormalizer(["application/json", "text/html"]),
+            b"text/html,application/xhtml+xml,*/*;q=0.8",
+            b"text/html",
+        ),
+        (AcceptNormalizer(["application/json", "text/html"]), b"text/*", b"text/html"),
+        (AcceptNormalizer(["application/json", "text/html"]), b"image/png", b""),
+    ],
+)
+def test_normalizers(normalizer: Normalizer, value: bytes, normalized: bytes) -> None:
+    assert normalizer(value) == normalized
+
+
+def test_normalize_header() -> None:
+    policy = KeyPolicy(vary_normalizers={"Accept-Encoding": AcceptEncodingNormalizer()})
+    assert policy.normalize_header("accept-encoding", b"gzip, br") == b"br"
+    assert policy.normalize_header("user-agent", b"Mozilla/5.0") == b"Mozilla/5.0"
+
+
+def make_scope(path: str) -> Scope:
+    return {"type": "http", "scheme": "http", "path": path, "headers": []}
+
+
+def test_frequency_admission_policy(monkeypatch: typing.Any) -> None:
+    policy = FrequencyAdmissionPolicy(2, window=60)
+    scope = make_scope("/")
+    response = CachedResponse(status_code=200, headers=[], body=b"Hello, world!")
+
+    policy.record_access(scope)
+    assert policy.check(scope, response) == "infrequent"
+    policy.record_access(scope)
+    assert policy.check(scope, response) is None
+
+    # Accesses are counted per URL.
+    other_scope = make_scope("/other")
+    policy.record_access(other_scope)
+    assert policy.check(other_scope, response) == "infrequent"
+
+    # Accesses are forgotten once the window is over.
+    travel(monkeypatch, 61)
+    policy.record_access(scope)
+    assert policy.check(scope, response) == "infrequent"
+
+
+def test_frequency_admission_policy_key_policy() -> None:
+    policy = FrequencyAdmissionPolicy(2)
+    key_policy = KeyPolicy(exclude_query=["utm_*"])
+    response = CachedResponse(status_code=200, headers=[], body=b"Hello, world!")
+
+    scope = make_scope("/")
+    tracked_scope = {**scope, "query_string": b"utm_source=a"}
+
+    # Accesses to URLs sharing a cache key are counted together.
+    policy.record_access(tracked_scope, key_policy=key_policy)
+    policy.record_access(scope, key_policy=key_policy)
+    assert policy.check(tracked_scope, response, key_policy=key_policy) is None
+    assert policy.check(tracked_scope, response) == "infrequent"
+
+
+def test_frequency_admission_policy_min_size() -> None:
+    policy = FrequencyAdmissionPolicy(2, min_size=10)
+    scope = make_scope("/")
+    policy.record_access(scope)
+    small = CachedResponse(status_code=200, headers=[], body=b"Hello")
+    large = small._replace(body=b"Hello, world!")
+    assert policy.check(scope, small) is None
+    assert policy.check(scope, large) == "infrequent"
+
+
+def test_frequency_admission_policy_max_tracked() -> None:
+    policy = FrequencyAdmissionPolicy(1, max_tracked=2)
+    response = CachedResponse(status_code=200, headers=[], body=b"Hello")
+    for path in ("/a", "/b", "/a", "/c"):
+        policy.record_access(make_scope(path))
+
+    # The least recently requested URL was forgotten.
+    assert len(policy.accesses) == 2
+    assert policy.check(make_scope("/a"), response) is None
+    assert policy.check(make_scope("/b"), response) == "infrequent"
+    assert policy.check(make_scope("/c"), response) is None
@@ -0,0 +1,59 @@
+import typing
+
+import pytest
+
+from asgi_caches.compression import GzipCodec
+from asgi_caches.responses import CachedResponse, add_vary, add_vary_header
+
+
+@pytest.mark.parametrize(
+    "value, result",
+    [
+        pytest.param(b"", b"Accept-Encoding", id="empty"),
+        pytest.param(b"Cookie", b"Cookie, Accept-Encoding", id="append"),
+        pytest.param(b"cookie, accept-encoding", None, id="listed"),
+        pytest.param(b"*", b"*", id="wildcard"),
+    ],
+)
+def test_add_vary(value: bytes, result: typing.Optional[bytes]) -> None:
+    assert add_vary(value, b"Accept-Encoding") == (value if result is None else result)
+
+
+def test_add_vary_header() -> None:
+    headers = [(b"vary", b"Cookie"), (b"content-type", b"text/plain")]
+    assert add_vary_header(headers, b"Accept-Encoding") == [
+        (b"vary", b"Cookie, Accept-Encoding"),
+        (b"content-type", b"text/plain"),
+    ]
+    assert add_vary_header(headers[1:], b"Accept-Encoding") == [
+        (b"content-type", b"text/plain"),
+        (b"vary", b"Accept-Encoding"),
+    ]
+    assert headers[0] == (b"vary", b"Cookie")
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, encoded", [(b"gzip", True), (b"identity", False)]
+)
+def test_negotiate(accept_encoding: bytes, encoded: bool) -> None:
+    body = b"Hello, world!" * 100
+    compressed = GzipCodec().compress(body)
+    response = CachedResponse(
+        status_code=200,
+        headers=[(b"content-length", str(len(body)).encode()), (b"etag", b'"abc"')],
+        body=compressed,
+        encoding="gzip",
+    )
+    scope = {"headers": [(b"accept-encoding", accept_encoding)]}
+    headers, sent_body = response.negotiate(scope)
+    if encoded:
+        assert sent_body == compressed
+        assert headers == [
+            (b"content-length", str(len(compressed)).encode()),
+            (b"etag", b'W/"abc"'),
+            (b"vary", b"Accept-Encoding"),
+            (b"content-encoding", b"gzip"),
+        ]
+    else:
+        assert sent_body == body
+        assert headers == [*response.headers, (b"vary", b"Accept-Encoding")]
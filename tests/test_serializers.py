@@ -0,0 +1,126 @@
+import gzip
+import math
+import os
+import typing
+
+import pytest
+
+from asgi_caches.compression import GzipCodec
+from asgi_caches.responses import CachedResponse
+from asgi_caches.serializers import BinarySerializer, JSONSerializer, Serializer
+
+SERIALIZERS = [
+    pytest.param(BinarySerializer(), id="binary"),
+    pytest.param(JSONSerializer(), id="json"),
+]
+
+
+@pytest.mark.parametrize("serializer", SERIALIZERS)
+@pytest.mark.parametrize(
+    "body", [b"", b"Hello, world!", gzip.compress(b"Hello, world!")]
+)
+def test_serialize(serializer: Serializer, body: bytes) -> None:
+    response = CachedResponse(
+        status_code=200,
+        headers=[
+            (b"content-type", b"text/plain; charset=utf-8"),
+            (b"set-cookie", b"a=1"),
+            (b"set-cookie", b"b=2"),
+        ],
+        body=body,
+        fresh_until=1574500000.5,
+        stale_while_revalidate=30,
+        stale_if_error=60,
+    )
+    assert serializer.loads(serializer.dumps(response)) == response
+
+
+@pytest.mark.parametrize("serializer", SERIALIZERS)
+def test_serialize_compressed(serializer: Serializer) -> None:
+    body = b"Hello, world!" * 100
+    response = CachedResponse(status_code=200, headers=[], body=body)
+    compressed = BinarySerializer(codec=GzipCodec()).compress(response)
+    assert compressed.encoding == "gzip"
+    assert len(compressed.body) < len(body)
+    assert compressed.decode() == response
+    cached_response = serializer.loads(serializer.dumps(compressed))
+    assert cached_response is not None
+    assert cached_response.decode() == response
+
+
+@pytest.mark.parametrize(
+    "body, headers",
+    [
+        pytest.param(b"Hello, world!", [], id="small"),
+        pytest.param(os.urandom(2048), [], id="incompressible"),
+        pytest.param(
+            gzip.compress(b"Hello, world!" * 100),
+            [(b"content-encoding", b"gzip")],
+            id="encoded",
+        ),
+    ],
+)
+def test_binary_serializer_not_compressed(
+    body: bytes, headers: typing.List[typing.Tuple[bytes, bytes]]
+) -> None:
+    serializer = BinarySerializer(codec=GzipCodec())
+    response = CachedResponse(status_code=200, headers=headers, body=body)
+    value = serializer.dumps(response)
+    assert value.startswith("ac1:")
+    assert serializer.loads(value) == response
+
+
+def test_binary_serializer_compressed() -> None:
+    serializer = BinarySerializer(codec=GzipCodec(), min_size=0)
+    response = CachedResponse(status_code=200, headers=[], body=b"Hello" * 10)
+    value = serializer.dumps(response)
+    assert value.startswith("ac2:gzip:")
+
+    # Compressed values can be read whatever the codec of the reader.
+    cached_response = BinarySerializer().loads(value)
+    assert cached_response is not None
+    assert cached_response.encoding == "gzip"
+    assert cached_response.decode() == response
+    assert cached_response.to_response().body == response.body
+
+
+def test_binary_serializer_reads_json() -> None:
+    # Format stored by earlier versions.
+    value = {
+        "content": "SGVsbG8sIHdvcmxkIQ==\n",
+        "status_code": 200,
+        "headers": {"content-length": "13", "cache-control": "max-age=120"},
+    }
+    response = BinarySerializer().loads(value)
+    assert response == CachedResponse(
+        status_code=200,
+        headers=[(b"content-length", b"13"), (b"cache-control", b"max-age=120")],
+        body=b"Hello, world!",
+        fresh_until=math.inf,
+    )
+
+
+@pytest.mark.parametrize(
+    "serializer, value",
+    [
+        pytest.param(BinarySerializer(), "ac99:AAAA", id="binary-unknown-version"),
+        pytest.param(BinarySerializer(), 42, id="binary-unknown-type"),
+        pytest.param(BinarySerializer(), "ac2:lzma:AAAA", id="binary-unknown-codec"),
+        pytest.param(BinarySerializer(), "ac1:AAAA", id="binary-truncated"),
+        pytest.param(BinarySerializer(), "ac1:not base64!", id="binary-not-base64"),
+        pytest.param(
+            BinarySerializer(),
+            "ac1:AMgAAAAAAAAAAAAAAAAAAAAAAAAAAQ==",
+            id="binary-truncated-headers",
+        ),
+        pytest.param(JSONSerializer(), "ac1:AAAA", id="json-unknown-type"),
+        pytest.param(JSONSerializer(), {"headers": []}, id="json-missing-keys"),
+        pytest.param(
+            BinarySerializer(),
+            {"status_code": 200, "headers": [], "content": "not base64!"},
+            id="json-not-base64",
+        ),
+    ],
+)
+def test_unreadable_value(serializer: Serializer, value: object) -> None:
+    assert serializer.loads(value) is None
@@ -1,20 +1,37 @@
 import datetime as dt
+import time
 import typing
 
 import pytest
 from caches import Cache
+from starlette.datastructures import MutableHeaders
 from starlette.requests import Request
 from starlette.responses import PlainTextResponse
 from starlette.types import Scope
 
+import asgi_caches.utils.cache
+from asgi_caches.compression import BrotliCodec, GzipCodec
 from asgi_caches.exceptions import RequestNotCachable, ResponseNotCachable
+from asgi_caches.local import LocalCache
+from asgi_caches.responses import CachedResponse
+from asgi_caches.serializers import DEFAULT_SERIALIZER
 from asgi_caches.utils.cache import (
-    deserialize_response,
+    generate_etag,
     get_cache_key,
+    get_cached_response,
+    get_encoded_response,
+    get_freshness_lifetime,
     get_from_cache,
+    get_seconds_directive,
+    is_not_modified,
+    lookup_cached_response,
+    parse_cache_control,
+    prepare_cached_response,
+    store_cached_response,
     store_in_cache,
 )
-from tests.utils import ComparableStarletteResponse
+from asgi_caches.utils.misc import http_date, parse_http_date
+from tests.utils import ComparableStarletteResponse, travel
 
 pytestmark = pytest.mark.asyncio
 
@@ -75,8 +92,34 @@ async def test_store_in_cache(cache: Cache) -> None:
     key = await get_cache_key(request, method="GET", cache=cache)
     assert key is not None
 
-    cached_response = deserialize_response(await cache.get(key))
-    assert ComparableStarletteResponse(cached_response) == response
+    cached_response = DEFAULT_SERIALIZER.loads(await cache.get(key))
+    assert cached_response is not None
+    assert ComparableStarletteResponse(cached_response.to_response()) == response
+
+
+async def test_store_cached_response(short_cache: Cache) -> None:
+    scope: Scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/path",
+        "headers": [],
+    }
+    request = Request(scope)
+    headers = [(b"content-type", b"text/plain"), (b"content-length", b"13")]
+    cached_response = prepare_cached_response(
+        200, list(headers), request=request, cache=short_cache
+    )
+    assert cached_response.headers[:2] == headers
+    assert (b"cache-control", b"max-age=120") in cached_response.headers
+    assert cached_response.body == b""
+
+    cached_response = cached_response._replace(body=b"Hello, world!")
+    await store_cached_response(cached_response, request=request, cache=short_cache)
+    # An ETag is added to allow answering conditional requests.
+    etag = (b"etag", generate_etag(b"Hello, world!").encode("latin-1"))
+    assert await get_cached_response(
+        request, cache=short_cache
+    ) == cached_response._replace(headers=[*cached_response.headers, etag])
 
 
 @pytest.mark.parametrize(
@@ -95,6 +138,91 @@ async def test_non_cachable_status_codes(cache: Cache, status_code: int) -> None
         await store_in_cache(response, request=request, cache=cache)
 
 
+@pytest.mark.parametrize(
+    "status_code, headers, max_age",
+    [
+        (404, {}, 60),
+        (410, {"Cache-Control": "max-age=30"}, 30),
+        (301, {"Cache-Control": "max-age=31536000"}, 60),
+    ],
+)
+async def test_status_ttls(
+    cache: Cache, status_code: int, headers: typing.Dict[str, str], max_age: int
+) -> None:
+    scope: Scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/path",
+        "headers": [],
+    }
+    request = Request(scope)
+    cached_response = prepare_cached_response(
+        status_code,
+        MutableHeaders(headers).raw,
+        request=request,
+        cache=cache,
+        status_ttls={301: 60, 404: 60, 410: 60},
+    )
+    assert MutableHeaders(raw=cached_response.headers)["Cache-Control"] == (
+        f"max-age={max_age}"
+    )
+
+
+@pytest.mark.parametrize(
+    "status_code, headers",
+    [
+        (404, {"Set-Cookie": "session=123"}),
+        (404, {"Cache-Control": "private"}),
+        (403, {}),
+        (304, {}),
+    ],
+)
+async def test_status_ttls_non_cachable(
+    cache: Cache, status_code: int, headers: typing.Dict[str, str]
+) -> None:
+    scope: Scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/path",
+        "headers": [],
+    }
+    request = Request(scope)
+    response = PlainTextResponse("Not Found", status_code=status_code, headers=headers)
+    with pytest.raises(ResponseNotCachable):
+        await store_in_cache(
+            response,
+            request=request,
+            cache=cache,
+            cachable_status_codes={200},
+            status_ttls={404: 60},
+        )
+
+
+@pytest.mark.parametrize(
+    "headers",
+    [
+        {"Cache-Control": "no-store"},
+        {"Cache-Control": "private, max-age=60"},
+        {"Cache-Control": "max-age=0"},
+        {"Expires": "Wed, 20 Nov 2019 00:00:00 GMT"},
+        {"Expires": "0"},
+    ],
+)
+async def test_non_cachable_cache_control(
+    cache: Cache, headers: typing.Dict[str, str]
+) -> None:
+    scope: Scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/path",
+        "headers": [],
+    }
+    request = Request(scope)
+    response = PlainTextResponse("Hello, world!", headers=headers)
+    with pytest.raises(ResponseNotCachable):
+        await store_in_cache(response, request=request, cache=cache)
+
+
 async def test_non_cachable_zero_ttl(cache: Cache) -> None:
     """
     We shouldn't bother caching if the cache TTL is zero.
@@ -173,6 +301,122 @@ async def test_cache_ttl_max_age(short_cache: Cache) -> None:
     assert cached_response.headers["Cache-Control"] == f"max-age={short_cache.ttl}"
 
 
+class SetSpy:
+    def __init__(self, cache: Cache) -> None:
+        self.ttls: typing.Dict[str, typing.Optional[int]] = {}
+        self.set = cache.set
+
+    async def __call__(
+        self, key: str, value: typing.Any, ttl: typing.Optional[int] = None
+    ) -> typing.Any:
+        self.ttls[key] = ttl
+        return await self.set(key, value, ttl=ttl)
+
+    def ttls_by_kind(self) -> typing.Dict[str, typing.Set[typing.Optional[int]]]:
+        ttls: typing.Dict[str, typing.Set[typing.Optional[int]]] = {}
+        for key, ttl in self.ttls.items():
+            ttls.setdefault(key.split(".")[0].split(":")[-1], set()).add(ttl)
+        return ttls
+
+
+@pytest.mark.parametrize(
+    "headers, max_age, cache_control",
+    [
+        ({"Cache-Control": "max-age=30"}, 30, "max-age=30"),
+        # The response's lifetime takes precedence over the cache TTL.
+        ({"Cache-Control": "max-age=600"}, 600, "max-age=600"),
+        (
+            {"Cache-Control": "s-maxage=300, max-age=60"},
+            300,
+            "s-maxage=300, max-age=60",
+        ),
+        (
+            {"Date": http_date(time.time()), "Expires": http_date(time.time() + 90)},
+            90,
+            "max-age=90",
+        ),
+    ],
+)
+async def test_response_max_age(
+    short_cache: Cache,
+    monkeypatch: typing.Any,
+    headers: typing.Dict[str, str],
+    max_age: int,
+    cache_control: str,
+) -> None:
+    spy = SetSpy(short_cache)
+    monkeypatch.setattr(short_cache, "set", spy)
+    scope: Scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/path",
+        "headers": [],
+    }
+    request = Request(scope)
+    response = PlainTextResponse("Hello, world!", headers=headers)
+    await store_in_cache(response, request=request, cache=short_cache)
+    assert response.headers["Cache-Control"] == cache_control
+
+    cached_response = await get_cached_response(request, cache=short_cache)
+    assert cached_response is not None
+    assert cached_response.fresh_until - time.time() == pytest.approx(max_age, abs=1)
+    assert spy.ttls_by_kind() == {
+        "cache_page": {max_age},
+        "varying_headers": {4 * max_age},
+    }
+
+    if "Expires" not in headers:
+        expires = parse_http_date(response.headers["Expires"])
+        assert expires is not None
+        assert expires - time.time() == pytest.approx(max_age, abs=1)
+
+
+async def test_no_cache_ttl(cache: Cache, monkeypatch: typing.Any) -> None:
+    """Responses should expire from the cache even if it has no default TTL."""
+    spy = SetSpy(cache)
+    monkeypatch.setattr(cache, "set", spy)
+    scope: Scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/path",
+        "headers": [],
+    }
+    request = Request(scope)
+    response = PlainTextResponse("Hello, world!")
+    await store_in_cache(response, request=request, cache=cache)
+    assert spy.ttls_by_kind() == {
+        "cache_page": {365 * 24 * 60 * 60},
+        "varying_headers": {4 * 365 * 24 * 60 * 60},
+    }
+
+
+@pytest.mark.parametrize(
+    "headers, lifetime",
+    [
+        ({}, None),
+        ({"Cache-Control": "max-age=60"}, 60),
+        ({"Cache-Control": "s-maxage=120, max-age=60"}, 120),
+        ({"Cache-Control": "max-age=60", "Expires": "Invalid"}, 60),
+        ({"Cache-Control": "max-age=invalid"}, 0),
+        (
+            {
+                "Date": "Wed, 20 Nov 2019 00:00:00 GMT",
+                "Expires": "Wed, 20 Nov 2019 00:10:00 GMT",
+            },
+            600,
+        ),
+        ({"Expires": "Wed, 20 Nov 2019 00:00:00 GMT"}, 0),
+        ({"Expires": "Invalid"}, 0),
+    ],
+)
+async def test_get_freshness_lifetime(
+    headers: typing.Dict[str, str], lifetime: typing.Optional[int]
+) -> None:
+    response_headers = MutableHeaders(headers)
+    cache_control = parse_cache_control(response_headers.get("Cache-Control", ""))
+    assert get_freshness_lifetime(response_headers, cache_control) == lifetime
+
+
 async def test_get_from_cache_head(cache: Cache) -> None:
     scope: Scope = {
         "type": "http",
@@ -225,3 +469,597 @@ async def test_get_from_cache_vary(cache: Cache) -> None:
     other_request = Request(other_scope)
     cached_response = await get_from_cache(other_request, cache=cache)
     assert cached_response is None
+
+
+async def test_get_from_cache_stale(
+    short_cache: Cache, monkeypatch: typing.Any
+) -> None:
+    scope: Scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/path",
+        "headers": [],
+    }
+    request = Request(scope)
+    response = PlainTextResponse(
+        "Hello, world!", headers={"Cache-Control": "stale-if-error=30"}
+    )
+    await store_in_cache(response, request=request, cache=short_cache)
+
+    travel(monkeypatch, 130)
+    assert await get_from_cache(request, cache=short_cache) is None
+    cached_response = await get_cached_response(request, cache=short_cache)
+    assert cached_response is not None
+    assert cached_response.get_staleness() == pytest.approx(10, abs=1)
+    assert cached_response.stale_while_revalidate == 0
+    assert cached_response.stale_if_error == 30
+    assert ComparableStarletteResponse(cached_response.to_response()) == response
+
+    travel(monkeypatch, 200)
+    assert await get_cached_response(request, cache=short_cache) is None
+
+
+@pytest.mark.parametrize(
+    "header, value",
+    [
+        ("stale-if-error=30", 30),
+        ("max-age=60", 0),
+        ("stale-if-error", 0),
+        ("stale-if-error=soon", 0),
+        ("stale-if-error=-10", 0),
+    ],
+)
+async def test_get_seconds_directive(header: str, value: int) -> None:
+    cache_control = parse_cache_control(header)
+    assert get_seconds_directive(cache_control, "stale-if-error") == value
+
+
+class RoundTripsSpy:
+    def __init__(self, cache: Cache) -> None:
+        self.round_trips = 0
+        self.get_many = cache.get_many
+
+    async def __call__(self, *args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+        self.round_trips += 1
+        return await self.get_many(*args, **kwargs)
+
+
+async def test_get_from_cache_single_round_trip(
+    cache: Cache, monkeypatch: typing.Any
+) -> None:
+    scope: Scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/path",
+        "headers": [],
+    }
+    request = Request(scope)
+    response = PlainTextResponse("Hello, world!")
+    await store_in_cache(response, request=request, cache=cache)
+
+    spy = RoundTripsSpy(cache)
+    monkeypatch.setattr(cache, "get_many", spy)
+    monkeypatch.setattr(cache, "get", None)
+
+    cached_response = await get_from_cache(request, cache=cache)
+    assert cached_response is not None
+    assert spy.round_trips == 1
+
+
+async def test_get_from_cache_vary_round_trips(
+    cache: Cache, monkeypatch: typing.Any
+) -> None:
+    scope: Scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/path",
+        "headers": [[b"accept-encoding", b"gzip, deflate"]],
+    }
+    request = Request(scope)
+    response = PlainTextResponse("Hello, world!", headers={"Vary": "Accept-Encoding"})
+    await store_in_cache(response, request=request, cache=cache)
+
+    spy = RoundTripsSpy(cache)
+    monkeypatch.setattr(cache, "get_many", spy)
+
+    assert await get_from_cache(request, cache=cache) is not None
+    assert spy.round_trips == 1
+
+    # Varying headers weren't seen by this process yet (e.g. another process
+    # stored the response), so an extra round trip is needed the first time.
+    asgi_caches.utils.cache._varying_headers_hints.clear()
+    assert await get_from_cache(request, cache=cache) is not None
+    assert spy.round_trips == 3
+    assert await get_from_cache(request, cache=cache) is not None
+    assert spy.round_trips == 4
+
+
+async def test_varying_headers_hints_bounded(
+    cache: Cache, monkeypatch: typing.Any
+) -> None:
+    monkeypatch.setattr(asgi_caches.utils.cache, "MAX_VARYING_HEADERS_HINTS", 1)
+
+    for path in ("/path", "/other_path"):
+        scope: Scope = {
+            "type": "http",
+            "method": "GET",
+            "path": path,
+            "headers": [],
+        }
+        request = Request(scope)
+        response = PlainTextResponse("Hello, world!", headers={"Vary": "Cookie"})
+        await store_in_cache(response, request=request, cache=cache)
+        assert len(asgi_caches.utils.cache._varying_headers_hints[cache]) == 1
+
+
+async def test_varying_headers_stored_once(
+    short_cache: Cache, monkeypatch: typing.Any
+) -> None:
+    """Varying headers should only be stored again if they changed or expire."""
+    spy = SetSpy(short_cache)
+    monkeypatch.setattr(short_cache, "set", spy)
+    scope: Scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/path",
+        "headers": [],
+    }
+    request = Request(scope)
+    headers = {"Cache-Control": "max-age=60", "Vary": "Cookie"}
+
+    async def store(**kwargs: str) -> typing.List[str]:
+        spy.ttls.clear()
+        response = PlainTextResponse("Hello, world!", headers={**headers, **kwargs})
+        await store_in_cache(response, request=request, cache=short_cache)
+        return sorted(key.split(".")[0].split(":")[-1] for key in spy.ttls)
+
+    assert await store() == ["cache_page", "varying_headers"]
+    assert await store() == ["cache_page"]
+
+    # Varying headers are kept for longer than responses...
+    travel(monkeypatch, 90)
+    assert await get_cached_response(request, cache=short_cache) is None
+    assert await store() == ["cache_page"]
+
+    # ... but not forever.
+    travel(monkeypatch, 200)
+    assert await store() == ["cache_page", "varying_headers"]
+
+    assert await store(Vary="Accept-Encoding") == ["cache_page", "varying_headers"]
+    assert await store(Vary="Accept-Encoding") == ["cache_page"]
+
+    # Varying headers that have disappeared from the cache are stored again.
+    await short_cache.clear()
+    assert await get_cached_response(request, cache=short_cache) is None
+    assert await store(Vary="Accept-Encoding") == ["cache_page", "varying_headers"]
+
+
+async def test_varying_headers_per_url(cache: Cache) -> None:
+    """Responses for different query strings may vary on different headers."""
+
+    def make_request(query_string: bytes, cookie: bytes) -> Request:
+        scope: Scope = {
+            "type": "http",
+            "method": "GET",
+            "path": "/path",
+            "query_string": query_string,
+            "headers": [[b"cookie", cookie]],
+        }
+        return Request(scope)
+
+    for query_string, vary in ((b"a=1", "Cookie"), (b"a=2", "Accept-Encoding")):
+        response = PlainTextResponse("Hello, world!", headers={"Vary": vary})
+        await store_in_cache(
+            response, request=make_request(query_string, b"a"), cache=cache
+        )
+
+    assert await get_from_cache(make_request(b"a=1", b"a"), cache=cache) is not None
+    assert await get_from_cache(make_request(b"a=1", b"b"), cache=cache) is None
+    assert await get_from_cache(make_request(b"a=2", b"b"), cache=cache) is not None
+
+
+async def test_get_from_cache_unreadable(cache: Cache) -> None:
+    scope: Scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/path",
+        "headers": [],
+    }
+    request = Request(scope)
+    await store_in_cache(PlainTextResponse("Hello"), request=request, cache=cache)
+
+    # E.g. stored by a future version of asgi-caches.
+    key = await get_cache_key(request, method="GET", cache=cache)
+    assert key is not None
+    await cache.set(key, "ac99:AAAA")
+
+    assert await get_from_cache(request, cache=cache) is None
+
+
+async def test_get_cached_response_local_cache(
+    short_cache: Cache, monkeypatch: typing.Any
+) -> None:
+    scope: Scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/path",
+        "headers": [[b"accept-encoding", b"gzip, deflate"]],
+    }
+    request = Request(scope)
+    response = PlainTextResponse("Hello, world!", headers={"Vary": "Accept-Encoding"})
+    await store_in_cache(response, request=request, cache=short_cache)
+
+    spy = RoundTripsSpy(short_cache)
+    monkeypatch.setattr(short_cache, "get_many", spy)
+    local_cache = LocalCache()
+
+    # The local cache is populated from the cache...
+    cached_response = await get_cached_response(
+        request, cache=short_cache, local_cache=local_cache
+    )
+    assert cached_response is not None
+    assert spy.round_trips == 1
+    assert len(local_cache) == 2
+
+    # ... And is then looked up first.
+    other = await get_cached_response(
+        request, cache=short_cache, local_cache=local_cache
+    )
+    assert other is cached_response
+    assert spy.round_trips == 1
+
+    # Requests with other varying header values are looked up in the cache.
+    scope = {**scope, "headers": [[b"accept-encoding", b"identity"]]}
+    other_request = Request(scope)
+    assert (
+        await get_cached_response(
+            other_request, cache=short_cache, local_cache=local_cache
+        )
+        is None
+    )
+    assert spy.round_trips == 2
+
+    # Expired responses aren't served from the local cache.
+    travel(monkeypatch, 2 * 60 + 1)
+    assert (
+        await get_cached_response(request, cache=short_cache, local_cache=local_cache)
+        is None
+    )
+
+
+async def test_store_cached_response_local_cache(short_cache: Cache) -> None:
+    scope: Scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/path",
+        "headers": [],
+    }
+    request = Request(scope)
+    local_cache = LocalCache()
+    cached_response = prepare_cached_response(
+        200, [], request=request, cache=short_cache
+    )._replace(body=b"Hello, world!")
+
+    await store_cached_response(
+        cached_response, request=request, cache=short_cache, local_cache=local_cache
+    )
+    assert len(local_cache) == 2
+
+    stored = await get_cached_response(
+        request, cache=short_cache, local_cache=local_cache
+    )
+    other = await get_cached_response(
+        request, cache=short_cache, local_cache=local_cache
+    )
+    assert other is stored
+
+
+class CountingCodec(GzipCodec):
+    def __init__(self) -> None:
+        super().__init__()
+        self.compressions = 0
+
+    def compress(self, data: bytes) -> bytes:
+        self.compressions += 1
+        return super().compress(data)
+
+
+async def test_get_encoded_response(
+    short_cache: Cache, monkeypatch: typing.Any
+) -> None:
+    scope: Scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/path",
+        "headers": [(b"accept-encoding", b"gzip, deflate")],
+    }
+    request = Request(scope)
+    body = b"Hello, world!" * 100
+    await store_in_cache(PlainTextResponse(body), request=request, cache=short_cache)
+    cached_response, cache_key, _ = await lookup_cached_response(
+        request.scope, cache=short_cache
+    )
+    assert cached_response is not None
+    assert cache_key is not None
+
+    codec = CountingCodec()
+    spy = SetSpy(short_cache)
+    monkeypatch.setattr(short_cache, "set", spy)
+    local_cache = LocalCache()
+
+    # The body is compressed on first demand, and stored for as long as the response.
+    encoded = await get_encoded_response(
+        request.scope,
+        cached_response,
+        [codec],
+        cache=short_cache,
+        cache_key=cache_key,
+        local_cache=local_cache,
+    )
+    assert encoded.encoding == "gzip"
+    assert encoded.headers == cached_response.headers
+    assert encoded.decode() == cached_response
+    assert codec.compressions == 1
+    assert spy.ttls_by_kind() == {"encoded_body": {2 * 60}}
+    assert len(local_cache) == 1
+
+    # It is then read from the local cache...
+    other = await get_encoded_response(
+        request.scope,
+        cached_response,
+        [codec],
+        cache=short_cache,
+        cache_key=cache_key,
+        local_cache=local_cache,
+    )
+    assert other == encoded
+
+    # ... Or from the cache.
+    other = await get_encoded_response(
+        request.scope, cached_response, [codec], cache=short_cache, cache_key=cache_key
+    )
+    assert other == encoded
+    assert codec.compressions == 1
+    assert len(spy.ttls) == 1
+
+    # Bodies compressed with the selected encoding already are returned as-is.
+    assert (
+        await get_encoded_response(
+            request.scope, encoded, [codec], cache=short_cache, cache_key=cache_key
+        )
+        is encoded
+    )
+
+
+async def test_get_encoded_response_prefetched(
+    short_cache: Cache, monkeypatch: typing.Any
+) -> None:
+    scope: Scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/path",
+        "headers": [(b"accept-encoding", b"gzip")],
+    }
+    request = Request(scope)
+    codec = CountingCodec()
+    body = b"Hello, world!" * 100
+    await store_in_cache(PlainTextResponse(body), request=request, cache=short_cache)
+    lookup = await lookup_cached_response(
+        request.scope, cache=short_cache, codecs=[codec]
+    )
+    assert lookup.response is not None
+    assert lookup.cache_key is not None
+    assert lookup.encoded_bodies == {}
+    encoded = await get_encoded_response(
+        request.scope,
+        lookup.response,
+        [codec],
+        cache=short_cache,
+        cache_key=lookup.cache_key,
+        encoded_bodies=lookup.encoded_bodies,
+    )
+
+    # Compressed bodies are fetched along with the response.
+    async def unexpected_get(*args: typing.Any, **kwargs: typing.Any) -> None:
+        raise AssertionError("Unexpected round trip")  # pragma: no cover
+
+    monkeypatch.setattr(short_cache, "get", unexpected_get)
+    lookup = await lookup_cached_response(
+        request.scope, cache=short_cache, codecs=[codec]
+    )
+    assert lookup.response is not None
+    assert lookup.cache_key is not None
+    assert len(lookup.encoded_bodies) == 1
+    other = await get_encoded_response(
+        request.scope,
+        lookup.response,
+        [codec],
+        cache=short_cache,
+        cache_key=lookup.cache_key,
+        encoded_bodies=lookup.encoded_bodies,
+    )
+    assert other == encoded
+    assert codec.compressions == 1
+    monkeypatch.undo()
+
+    # Compressed bodies of replaced responses aren't served.
+    await store_in_cache(
+        PlainTextResponse(body[::-1]), request=request, cache=short_cache
+    )
+    lookup = await lookup_cached_response(
+        request.scope, cache=short_cache, codecs=[codec]
+    )
+    assert lookup.response is not None
+    assert lookup.cache_key is not None
+    local_cache = LocalCache()
+    for _ in range(2):
+        other = await get_encoded_response(
+            request.scope,
+            lookup.response,
+            [codec],
+            cache=short_cache,
+            cache_key=lookup.cache_key,
+            local_cache=local_cache,
+            encoded_bodies=lookup.encoded_bodies,
+        )
+        assert other.decode().body == body[::-1]
+    assert codec.compressions == 2
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, headers, status_code, body",
+    [
+        pytest.param(b"gzip", {}, 200, b"Hello, world!", id="small"),
+        pytest.param(
+            b"gzip",
+            {"Cache-Control": "no-transform"},
+            200,
+            b"Hello, world!" * 100,
+            id="no-transform",
+        ),
+        pytest.param(b"gzip", {}, 304, b"", id="not-modified"),
+    ],
+)
+async def test_get_encoded_response_not_encoded(
+    cache: Cache,
+    accept_encoding: bytes,
+    headers: typing.Dict[str, str],
+    status_code: int,
+    body: bytes,
+) -> None:
+    scope: Scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/path",
+        "headers": [(b"accept-encoding", accept_encoding)],
+    }
+    request = Request(scope)
+    cached_response = prepare_cached_response(
+        status_code, MutableHeaders(headers).raw, request=request, cache=cache
+    )._replace(body=body)
+    await store_cached_response(cached_response, request=request, cache=cache)
+    stored, cache_key, _ = await lookup_cached_response(request.scope, cache=cache)
+    assert stored is not None
+    assert cache_key is not None
+
+    assert (
+        await get_encoded_response(
+            request.scope,
+            stored,
+            [GzipCodec()],
+            cache=cache,
+            cache_key=cache_key,
+            min_size=1024,
+        )
+        is stored
+    )
+
+
+async def test_get_encoded_response_not_accepted(cache: Cache) -> None:
+    scope: Scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/path",
+        "headers": [(b"accept-encoding", b"br")],
+    }
+    body = b"Hello, world!" * 100
+    cached_response = CachedResponse(
+        status_code=200, headers=[(b"etag", generate_etag(body).encode())], body=body
+    )
+    encoded = await get_encoded_response(
+        scope, cached_response, [GzipCodec()], cache=cache, cache_key="key"
+    )
+    assert encoded == cached_response._replace(
+        headers=[*cached_response.headers, (b"vary", b"Accept-Encoding")]
+    )
+
+
+async def test_get_encoded_response_recompressed(cache: Cache) -> None:
+    scope: Scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/path",
+        "headers": [(b"accept-encoding", b"br")],
+    }
+    body = b"Hello, world!" * 100
+    cached_response = CachedResponse(
+        status_code=200,
+        headers=[(b"etag", generate_etag(body).encode())],
+        body=GzipCodec().compress(body),
+        encoding="gzip",
+    )
+    encoded = await get_encoded_response(
+        scope,
+        cached_response,
+        [GzipCodec(), BrotliCodec()],
+        cache=cache,
+        cache_key="key",
+    )
+    assert encoded.encoding == "br"
+    assert encoded.decode().body == body
+
+
+@pytest.mark.parametrize(
+    "request_headers, response_headers, not_modified",
+    [
+        ({}, {"ETag": '"abc"'}, False),
+        ({"If-None-Match": '"abc"'}, {"ETag": '"abc"'}, True),
+        ({"If-None-Match": '"xyz", "abc"'}, {"ETag": '"abc"'}, True),
+        ({"If-None-Match": 'W/"abc"'}, {"ETag": '"abc"'}, True),
+        ({"If-None-Match": '"abc"'}, {"ETag": 'W/"abc"'}, True),
+        ({"If-None-Match": "*"}, {"ETag": '"abc"'}, True),
+        ({"If-None-Match": '"xyz"'}, {"ETag": '"abc"'}, False),
+        ({"If-None-Match": '"abc"'}, {}, False),
+        (
+            {"If-Modified-Since": "Wed, 20 Nov 2019 00:00:00 GMT"},
+            {"Last-Modified": "Tue, 19 Nov 2019 00:00:00 GMT"},
+            True,
+        ),
+        (
+            {"If-Modified-Since": "Wed, 20 Nov 2019 00:00:00 GMT"},
+            {"Last-Modified": "Wed, 20 Nov 2019 00:00:00 GMT"},
+            True,
+        ),
+        (
+            {"If-Modified-Since": "Wed, 20 Nov 2019 00:00:00 GMT"},
+            {"Last-Modified": "Thu, 21 Nov 2019 00:00:00 GMT"},
+            False,
+        ),
+        ({"If-Modified-Since": "Wed, 20 Nov 2019 00:00:00 GMT"}, {}, False),
+        (
+            {"If-Modified-Since": "Invalid"},
+            {"Last-Modified": "Tue, 19 Nov 2019 00:00:00 GMT"},
+            False,
+        ),
+        # 'If-None-Match' takes precedence over 'If-Modified-Since'.
+        (
+            {
+                "If-None-Match": '"xyz"',
+                "If-Modified-Since": "Wed, 20 Nov 2019 00:00:00 GMT",
+            },
+            {"ETag": '"abc"', "Last-Modified": "Tue, 19 Nov 2019 00:00:00 GMT"},
+            False,
+        ),
+    ],
+)
+async def test_is_not_modified(
+    request_headers: dict, response_headers: dict, not_modified: bool
+) -> None:
+    scope: Scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/path",
+        "headers": [
+            (key.lower().encode("latin-1"), value.encode("latin-1"))
+            for key, value in request_headers.items()
+        ],
+    }
+    response = CachedResponse(
+        status_code=200,
+        headers=[
+            (key.lower().encode("latin-1"), value.encode("latin-1"))
+            for key, value in response_headers.items()
+        ],
+        body=b"Hello, world!",
+    )
+    assert is_not_modified(scope, response) is not_modified
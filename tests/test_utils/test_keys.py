@@ -0,0 +1,125 @@
+import typing
+
+import pytest
+from starlette.types import Scope
+
+from asgi_caches.policies import AcceptEncodingNormalizer, KeyPolicy
+from asgi_caches.utils.keys import (
+    _hash_url_without_query,
+    get_host,
+    get_path,
+    hash_header_values,
+    hash_url,
+)
+
+
+def make_scope(**kwargs: typing.Any) -> Scope:
+    scope: Scope = {
+        "type": "http",
+        "method": "GET",
+        "scheme": "http",
+        "server": ("testserver", 80),
+        "root_path": "",
+        "path": "/path",
+        "query_string": b"",
+        "headers": [],
+    }
+    scope.update(kwargs)
+    return scope
+
+
+@pytest.mark.parametrize(
+    "scope, host",
+    [
+        (make_scope(), b"testserver"),
+        (make_scope(server=("testserver", 8000)), b"testserver:8000"),
+        (make_scope(scheme="https", server=("testserver", 443)), b"testserver"),
+        (make_scope(headers=[(b"host", b"example.org")]), b"example.org"),
+        (make_scope(server=None), b""),
+    ],
+)
+def test_get_host(scope: Scope, host: bytes) -> None:
+    assert get_host(scope) == host
+
+
+def test_get_path() -> None:
+    assert get_path(make_scope(root_path="/api")) == "/api/path"
+
+
+def test_hash_url() -> None:
+    url_hash = hash_url(make_scope())
+    assert hash_url(make_scope()) == url_hash
+    assert len(url_hash) == 32
+
+    for scope in (
+        make_scope(scheme="https"),
+        make_scope(server=("other", 80)),
+        make_scope(root_path="/api"),
+        make_scope(path="/other"),
+        make_scope(query_string=b"a=1"),
+    ):
+        assert hash_url(scope) != url_hash
+
+
+def test_hash_url_key_policy() -> None:
+    policy = KeyPolicy(exclude_query=["utm_*"], normalize_host=True)
+    url_hash = hash_url(make_scope(query_string=b"a=1&b=2"), policy)
+    assert url_hash == hash_url(make_scope(query_string=b"a=1&b=2"))
+
+    for scope in (
+        make_scope(query_string=b"b=2&a=1"),
+        make_scope(query_string=b"a=1&utm_source=x&b=2"),
+        make_scope(query_string=b"a=1&b=2", headers=[(b"host", b"TESTSERVER:80")]),
+    ):
+        assert hash_url(scope, policy) == url_hash
+        assert hash_url(scope) != url_hash
+
+    assert hash_url(make_scope(query_string=b"a=1&b=3"), policy) != url_hash
+
+
+def test_hash_url_memo() -> None:
+    _hash_url_without_query.cache_clear()
+    hash_url(make_scope(query_string=b"page=1"))
+    hash_url(make_scope(query_string=b"page=2"))
+    info = _hash_url_without_query.cache_info()
+    assert info.misses == 1
+    assert info.hits == 1
+
+
+def test_hash_header_values() -> None:
+    scope = make_scope(
+        headers=[
+            (b"accept-encoding", b"gzip"),
+            (b"accept-language", b"en"),
+            (b"accept-encoding", b"br"),
+        ]
+    )
+    empty = hash_header_values(scope, [])
+    assert hash_header_values(make_scope(), []) == empty
+
+    names = ["accept-encoding", "accept-language"]
+    values_hash = hash_header_values(scope, names)
+    assert values_hash != empty
+    # The first value of each header is used.
+    headers = [(b"accept-encoding", b"gzip"), (b"accept-language", b"en")]
+    assert hash_header_values(make_scope(headers=headers), names) == values_hash
+    headers = [(b"accept-encoding", b"gzipen")]
+    assert hash_header_values(make_scope(headers=headers), names) != values_hash
+    # Missing headers are considered empty.
+    assert hash_header_values(make_scope(), ["cookie"]) == hash_header_values(
+        make_scope(headers=[(b"cookie", b"")]), ["cookie"]
+    )
+
+
+def test_hash_header_values_key_policy() -> None:
+    policy = KeyPolicy(vary_normalizers={"accept-encoding": AcceptEncodingNormalizer()})
+    names = ["accept-encoding", "user-agent"]
+    scope = make_scope(headers=[(b"accept-encoding", b"br")])
+    values_hash = hash_header_values(scope, names, policy)
+
+    scope = make_scope(headers=[(b"accept-encoding", b"gzip, deflate, br")])
+    assert hash_header_values(scope, names, policy) == values_hash
+    assert hash_header_values(scope, names) != values_hash
+
+    scope = make_scope(headers=[(b"accept-encoding", b"gzip")])
+    assert hash_header_values(scope, names, policy) != values_hash
@@ -1,14 +1,25 @@
+import logging
 import typing
 
 import httpx
 import pytest
 from caches import Cache
+from starlette.requests import Request
 from starlette.responses import PlainTextResponse
 
 from asgi_caches.middleware import CacheMiddleware
+from asgi_caches.utils.cache import get_cache_key
+from asgi_caches.utils.logging import TRACE_LOG_LEVEL, get_logger
 from tests.utils import override_log_level
 
 
+class Unformattable:
+    def __repr__(self) -> str:
+        raise AssertionError("Should not have been formatted")  # pragma: no cover
+
+    __str__ = __repr__
+
+
 @pytest.mark.asyncio
 async def test_logs_debug(capsys: typing.Any) -> None:
     cache = Cache("locmem://null", ttl=2 * 60)
@@ -41,3 +52,63 @@ async def test_logs_trace(capsys: typing.Any) -> None:
     stderr = capsys.readouterr().err
     assert "cache_lookup MISS" in stderr
     assert "get_from_cache request.url='http://testserver/" in stderr
+
+
+def test_disabled_levels_do_not_format() -> None:
+    logger = get_logger("asgi_caches.tests")
+    logger.setLevel(logging.INFO)
+    try:
+        logger.trace("value=%r", Unformattable())
+        logger.trace_event("event", value=Unformattable())
+        logger.debug_event("event", value=Unformattable())
+    finally:
+        logger.setLevel(logging.NOTSET)
+
+
+def test_log_events(caplog: typing.Any) -> None:
+    logger = get_logger("asgi_caches.tests")
+
+    with caplog.at_level(TRACE_LOG_LEVEL, logger="asgi_caches.tests"):
+        logger.trace("hello %s", "world")
+        logger.trace_event("patch_cache_control", max_age=30, private=True)
+        logger.debug_event("store_in_cache", max_age=120)
+
+    trace_record, trace_event_record, debug_event_record = caplog.records
+    assert trace_record.levelno == TRACE_LOG_LEVEL
+    assert trace_record.getMessage() == "hello world"
+
+    assert trace_event_record.levelno == TRACE_LOG_LEVEL
+    assert trace_event_record.getMessage() == (
+        "patch_cache_control max_age=30 private=True"
+    )
+    assert trace_event_record.event == "patch_cache_control"
+    assert trace_event_record.fields == {"max_age": 30, "private": True}
+
+    assert debug_event_record.levelno == logging.DEBUG
+    assert debug_event_record.getMessage() == "store_in_cache max_age=120"
+    assert debug_event_record.event == "store_in_cache"
+    assert debug_event_record.fields == {"max_age": 120}
+
+
+@pytest.mark.asyncio
+async def test_get_cache_key_logs_trace(caplog: typing.Any) -> None:
+    cache = Cache("locmem://null")
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "scheme": "https",
+        "server": ("www.example.org", 443),
+        "path": "/",
+        "headers": [],
+    }
+    request = Request(scope)
+
+    async with cache:
+        with caplog.at_level(TRACE_LOG_LEVEL, logger="asgi_caches"):
+            assert await get_cache_key(request, method="GET", cache=cache) is None
+
+    assert any(
+        record.getMessage()
+        == "get_cache_key request.url='https://www.example.org/' method='GET'"
+        for record in caplog.records
+    )
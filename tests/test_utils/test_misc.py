@@ -5,7 +5,7 @@ from starlette.requests import Request
 from starlette.responses import Response
 from starlette.types import Receive, Scope, Send
 
-from asgi_caches.utils.misc import is_asgi3
+from asgi_caches.utils.misc import http_date, is_asgi3, parse_http_date
 
 
 class CallableClass:
@@ -45,3 +45,9 @@ async def view(request: Request) -> Response:
 )
 def test_is_asgi3(app: typing.Any, output: bool) -> None:
     assert is_asgi3(app) == output
+
+
+def test_parse_http_date() -> None:
+    assert parse_http_date(http_date(1574208000)) == 1574208000
+    assert parse_http_date("Wed, 20 Nov 2019 00:00:00 GMT") == 1574208000
+    assert parse_http_date("Not a date") is None
@@ -0,0 +1,238 @@
+import io
+import time
+import typing
+
+import pytest
+from caches import Cache
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response
+from starlette.routing import Route
+from starlette.types import Receive, Scope, Send
+
+from asgi_caches.middleware import CacheMiddleware
+from asgi_caches.warming import (
+    Lifespan,
+    WarmingResult,
+    import_app,
+    main,
+    make_scope,
+    warm,
+)
+from asgi_caches.writer import CacheWriter
+
+cache = Cache("locmem://warming", ttl=2 * 60)
+
+
+async def home(request: Request) -> Response:
+    return PlainTextResponse("Hello, world!")
+
+
+async def greeting(request: Request) -> Response:
+    language = request.headers.get("accept-language", "en")
+    text = "Bonjour" if language == "fr" else "Hello"
+    return PlainTextResponse(text, headers={"Vary": "Accept-Language"})
+
+
+async def error(request: Request) -> Response:
+    return PlainTextResponse("Oops", status_code=500)
+
+
+async def crash(request: Request) -> Response:
+    raise RuntimeError("Crashed")
+
+
+app = Starlette(
+    routes=[
+        Route("/", home),
+        Route("/greeting", greeting),
+        Route("/error", error),
+        Route("/crash", crash),
+    ],
+    middleware=[Middleware(CacheMiddleware, cache=cache)],
+    on_startup=[cache.connect],
+    on_shutdown=[cache.disconnect],
+)
+
+
+@pytest.mark.asyncio
+async def test_warm() -> None:
+    async with Lifespan(app):
+        report = await warm(
+            app,
+            ["/", "/greeting", "/error"],
+            headers=[{"Accept-Language": "en"}, {"Accept-Language": "fr"}],
+            concurrency=1,
+        )
+        assert report.populated == [
+            WarmingResult("/", {"Accept-Language": "en"}, "stored"),
+            WarmingResult("/", {"Accept-Language": "fr"}, "hit"),
+            WarmingResult("/greeting", {"Accept-Language": "en"}, "stored"),
+            WarmingResult("/greeting", {"Accept-Language": "fr"}, "stored"),
+        ]
+        assert report.failed == [
+            WarmingResult("/error", {"Accept-Language": "en"}, "status_code"),
+            WarmingResult("/error", {"Accept-Language": "fr"}, "status_code"),
+        ]
+
+        report = await warm(
+            app, ["http://localhost/greeting"], headers=[{"Accept-Language": "fr"}]
+        )
+        assert report.populated == [
+            WarmingResult("http://localhost/greeting", {"Accept-Language": "fr"}, "hit")
+        ]
+
+
+@pytest.mark.asyncio
+async def test_warm_lazy_urls() -> None:
+    consumed: typing.List[str] = []
+
+    def generate_urls() -> typing.Iterator[str]:
+        for url in ["/a", "/b", "/c"]:
+            consumed.append(url)
+            yield url
+
+    requested: typing.List[typing.Tuple[str, int]] = []
+
+    async def spy_app(scope: Scope, receive: Receive, send: Send) -> None:
+        requested.append((scope["path"], len(consumed)))
+        await PlainTextResponse("Hello, world!")(scope, receive, send)
+
+    await warm(spy_app, generate_urls(), headers=[{}, {}], concurrency=1)
+    # URLs are consumed as requests are made, not all upfront.
+    assert requested == [
+        ("/a", 1),
+        ("/a", 1),
+        ("/b", 2),
+        ("/b", 2),
+        ("/c", 3),
+        ("/c", 3),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_warm_failures() -> None:
+    async def not_cached(scope: Scope, receive: Receive, send: Send) -> None:
+        await PlainTextResponse("Hello, world!")(scope, receive, send)
+
+    report = await warm(not_cached, ["/"])
+    assert report.failed == [WarmingResult("/", {}, "not_cached")]
+
+    async with Lifespan(app):
+        report = await warm(app, ["/crash"])
+    assert report.failed == [
+        WarmingResult("/crash", {}, "error: RuntimeError('Crashed')")
+    ]
+
+
+@pytest.mark.asyncio
+async def test_warm_writer() -> None:
+    writer = CacheWriter()
+    async with Cache("locmem://null") as cache:
+        report = await warm(
+            CacheMiddleware(PlainTextResponse("Hello"), cache=cache, writer=writer),
+            ["/"],
+        )
+        await writer.drain()
+    assert report.populated == [WarmingResult("/", {}, "queued")]
+
+    # Writes dropped because the queue is full aren't reported as populated.
+    writer = CacheWriter(max_pending=1, concurrency=1)
+    async with Cache("locmem://null") as cache:
+        report = await warm(
+            CacheMiddleware(PlainTextResponse("Hello"), cache=cache, writer=writer),
+            ["/a", "/b"],
+            concurrency=2,
+        )
+        await writer.drain()
+    assert report.populated == [WarmingResult("/a", {}, "queued")]
+    assert report.failed == [WarmingResult("/b", {}, "write_dropped")]
+
+
+@pytest.mark.asyncio
+async def test_warm_rate() -> None:
+    async with Cache("locmem://null") as cache:
+        spy_app = CacheMiddleware(PlainTextResponse("Hello"), cache=cache)
+        start = time.perf_counter()
+        report = await warm(spy_app, ["/a", "/b", "/c"], concurrency=3, rate=50)
+        elapsed = time.perf_counter() - start
+    assert len(report.populated) == 3
+    assert elapsed >= 2 / 50
+
+
+def test_make_scope() -> None:
+    scope = make_scope(
+        "https://example.org:8443/caf%C3%A9?q=1",
+        {"Accept-Language": "fr", "Host": "ignored"},
+    )
+    assert scope["scheme"] == "https"
+    assert scope["server"] == ("example.org", 8443)
+    assert scope["path"] == "/café"
+    assert scope["raw_path"] == b"/caf%C3%A9"
+    assert scope["query_string"] == b"q=1"
+    assert scope["headers"] == [
+        (b"host", b"example.org:8443"),
+        (b"accept-language", b"fr"),
+    ]
+
+    scope = make_scope("?q=1", {}, base_url="https://example.org")
+    assert scope["server"] == ("example.org", 443)
+    assert scope["path"] == "/"
+
+
+@pytest.mark.asyncio
+async def test_lifespan_errors() -> None:
+    async def no_lifespan(scope: Scope, receive: Receive, send: Send) -> None:
+        assert scope["type"] == "http"
+
+    with pytest.raises(AssertionError):
+        async with Lifespan(no_lifespan):
+            pass  # pragma: no cover
+
+    async def ignore_lifespan(scope: Scope, receive: Receive, send: Send) -> None:
+        pass
+
+    with pytest.raises(RuntimeError, match="does not support lifespan"):
+        async with Lifespan(ignore_lifespan):
+            pass  # pragma: no cover
+
+    async def fail_startup() -> None:
+        raise ValueError("Startup failed")
+
+    failing_app = Starlette(on_startup=[fail_startup])
+    with pytest.raises(RuntimeError, match="Startup failed"):
+        async with Lifespan(failing_app):
+            pass  # pragma: no cover
+
+
+def test_main(tmp_path: typing.Any, capsys: typing.Any) -> None:
+    urls = tmp_path / "urls.txt"
+    urls.write_text("/\n\n/greeting\n")
+    argv = ["tests.test_warming:app", str(urls), "-H", "Accept-Language: fr"]
+    assert main(argv) == 0
+    assert capsys.readouterr().out == "Populated: 2, failed: 0\n"
+
+
+def test_main_failed(monkeypatch: typing.Any, capsys: typing.Any) -> None:
+    monkeypatch.setattr("sys.stdin", io.StringIO("/error\n"))
+    assert main(["tests.test_warming:app", "-"]) == 1
+    out, err = capsys.readouterr()
+    assert out == "Populated: 0, failed: 1\n"
+    assert err == "FAILED /error {} status_code\n"
+
+
+def test_main_no_lifespan(monkeypatch: typing.Any, capsys: typing.Any) -> None:
+    monkeypatch.setattr("sys.stdin", io.StringIO("/\n"))
+    assert main(["tests.test_warming:not_cached_app", "-", "--no-lifespan"]) == 1
+    assert capsys.readouterr().out == "Populated: 0, failed: 1\n"
+
+
+not_cached_app = PlainTextResponse("Hello, world!")
+
+
+def test_main_invalid_arguments() -> None:
+    with pytest.raises(ValueError):
+        import_app("tests.test_warming")
+    with pytest.raises(SystemExit):
+        main(["tests.test_warming:app", "-", "-H", "Accept-Language"])
@@ -0,0 +1,87 @@
+import asyncio
+import typing
+
+import pytest
+
+from asgi_caches.writer import CacheWriter
+
+
+@pytest.mark.asyncio
+async def test_writer() -> None:
+    writer = CacheWriter()
+    written: typing.List[int] = []
+
+    def make_write(value: int) -> typing.Callable[[], typing.Awaitable[None]]:
+        async def write() -> None:
+            await asyncio.sleep(0)
+            written.append(value)
+
+        return write
+
+    futures = [writer.submit(make_write(value)) for value in range(3)]
+    assert writer.pending == 3
+    assert written == []
+
+    first = futures[0]
+    assert first is not None
+    await first
+    assert 0 in written
+
+    await writer.drain()
+    assert sorted(written) == [0, 1, 2]
+    assert all(future is not None and future.done() for future in futures)
+    assert writer.pending == 0
+    assert writer.written == 3
+    assert writer.dropped == 0
+    assert writer.failed == 0
+
+    # The writer can be reused after being drained.
+    writer.submit(make_write(3))
+    await writer.drain()
+    assert written[-1] == 3
+    assert writer.written == 4
+
+
+@pytest.mark.asyncio
+async def test_writer_drop_on_overflow() -> None:
+    writer = CacheWriter(max_pending=2, concurrency=1)
+    written: typing.List[int] = []
+
+    def make_write(value: int) -> typing.Callable[[], typing.Awaitable[None]]:
+        async def write() -> None:
+            written.append(value)
+
+        return write
+
+    assert writer.submit(make_write(0)) is not None
+    assert writer.submit(make_write(1)) is not None
+    assert writer.submit(make_write(2)) is None
+    assert writer.dropped == 1
+
+    await writer.drain()
+    assert written == [0, 1]
+    assert writer.written == 2
+    assert writer.dropped == 1
+
+
+@pytest.mark.asyncio
+async def test_writer_failed_write() -> None:
+    writer = CacheWriter()
+
+    async def write() -> None:
+        raise RuntimeError("Cache is down")
+
+    future = writer.submit(write)
+    assert future is not None
+    await future
+    assert writer.failed == 1
+    assert writer.written == 0
+
+    await writer.drain()
+
+
+@pytest.mark.asyncio
+async def test_writer_drain_unused() -> None:
+    writer = CacheWriter()
+    await writer.drain()
+    assert writer.pending == 0
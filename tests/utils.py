@@ -1,6 +1,7 @@
 import contextlib
 import logging
 import os
+import time
 import typing
 
 import httpx
@@ -9,6 +10,8 @@ from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 import asgi_caches.utils.logging
 
+_real_time = time.time
+
 
 async def mock_receive() -> Message:
     raise NotImplementedError  # pragma: no cover
@@ -73,3 +76,8 @@ def override_log_level(log_level: str) -> typing.Iterator[None]:
     finally:
         # Reset the logger so we don't have verbose output in all unit tests
         logging.getLogger("asgi_caches").handlers = []
+
+
+def travel(monkeypatch: typing.Any, seconds: float) -> None:
+    """Make `time.time()` return a time `seconds` from now."""
+    monkeypatch.setattr(time, "time", lambda: _real_time() + seconds)